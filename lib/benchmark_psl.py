@@ -0,0 +1,87 @@
+"""
+Benchmarks the line by line PSL parser (pslIterator) against the bulk parser
+(pslBulkIterator, readPsl and readPslTable).
+
+Usage: python lib/benchmark_psl.py [file.psl] [--lines 1000000]
+Without a PSL file, a random one with --lines alignments is written to a temporary directory.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+#the repository root, so that lib is importable as a package like everywhere else
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lib.psl_lib as psl_lib
+
+
+def write_random_psl(path, n, seed=1):
+    """ Writes <n> random alignments with 1 to 12 blocks each to <path>.
+    """
+    r = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in xrange(n):
+            sizes = [r.randint(50, 300) for _ in xrange(r.randint(1, 12))]
+            qStarts, tStarts = [], []
+            q, t = 0, r.randint(0, 10 ** 8)
+            for s in sizes:
+                qStarts.append(q)
+                tStarts.append(t)
+                q += s
+                t += s + r.randint(100, 5000)
+            f.write("\t".join(map(str, [q - 5, 3, 0, 2, 1, 10, len(sizes) - 1, 1000, r.choice("+-"),
+                    "ENSMUST{:011d}.1-0".format(i), q + 20, 0, q, "chr{}".format(r.randint(1, 19)),
+                    2 * 10 ** 8, tStarts[0], t - r.randint(100, 5000), len(sizes),
+                    ",".join(map(str, sizes)) + ",", ",".join(map(str, qStarts)) + ",",
+                    ",".join(map(str, tStarts)) + ","])) + "\n")
+
+
+def line_by_line_rows(path):
+    with open(path) as f:
+        return list(psl_lib.pslIterator(f))
+
+
+def line_by_line_table(path):
+    with open(path) as f:
+        return psl_lib.PslTable.fromRows(psl_lib.pslIterator(f))
+
+
+def bulk_rows(path):
+    with open(path) as f:
+        return list(psl_lib.pslBulkIterator(f))
+
+
+benchmarks = [("pslIterator -> PslRows", line_by_line_rows),
+              ("pslBulkIterator -> PslRows", bulk_rows),
+              ("readPsl (bulk) -> PslRows", psl_lib.readPsl),
+              ("pslIterator -> PslTable", line_by_line_table),
+              ("readPslTable (bulk) -> PslTable", psl_lib.readPslTable)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('psl', nargs="?", default=None)
+    parser.add_argument('--lines', type=int, default=1000000)
+    args = parser.parse_args()
+    tmpDir = None
+    if args.psl is None:
+        tmpDir = tempfile.mkdtemp()
+        args.psl = os.path.join(tmpDir, "benchmark.psl")
+        write_random_psl(args.psl, args.lines)
+    try:
+        for name, f in benchmarks:
+            start = time.time()
+            n = len(f(args.psl))
+            elapsed = time.time() - start
+            print ("{:<35}{:>10} rows {:>8.2f}s {:>12.0f} rows/sec".format(name, n, elapsed, n / elapsed))
+    finally:
+        if tmpDir is not None:
+            shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Persistent on-disk cache of parsed input files.
+
+Parsing PSL, BED and attribute files back into PslRow/Transcript/Attribute objects is
+repeated by every job that needs them. This library stores the parsed records as flat
+tuples in marshal format in a cache directory. Loading them back only has to rebuild the
+objects, skipping the tokenizing, int conversion and coordinate mapping done by the parsers.
+
+Each cache entry records the path, size, mtime and md5 of the file it was built from.
+The md5 is only checked when the size or mtime changed, so a touched or copied file keeps
+its entry. An entry whose source file no longer matches is rebuilt automatically.
+"""
+
+import os
+import hashlib
+import marshal
+
+import lib.psl_lib as psl_lib
+import lib.sequence_lib as seq_lib
+
+#file extensions picked up by prebuildCache
+cache_extensions = {".psl": "psl", ".bed": "bed", ".psl.gz": "psl", ".bed.gz": "bed"}
+
+
+def fileHash(path, blockSize=2 ** 20):
+    """
+    Returns the md5 hex digest of the contents of a file.
+    """
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if block == "":
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def cachePath(path, kind, cacheDir):
+    """
+    Returns the path to the cache entry for a input file of a given kind.
+    """
+    name = hashlib.sha1("{}:{}".format(os.path.abspath(path), kind)).hexdigest()
+    return os.path.join(cacheDir, "{}.{}.cache".format(name, kind))
+
+
+def fileKey(path):
+    """
+    Returns the (path, size, mtime) part of the key for a input file.
+    """
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime
+
+
+def readEntry(path, kind, cacheDir):
+    """
+    Returns (records, digest) for the cache entry of <path>. records is None if there is
+    no valid entry. The file is only hashed if its size and mtime no longer match the
+    entry, in which case the entry is still used if the md5 is unchanged; digest is the
+    md5 if it was computed and None otherwise, so that a caller can pass it on to writeCache.
+    """
+    cache = cachePath(path, kind, cacheDir)
+    if not os.path.exists(cache):
+        return None, None
+    with open(cache, 'rb') as f:
+        try:
+            key, digest = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None, None
+        current = None
+        if key != fileKey(path):
+            current = fileHash(path)
+            if digest != current:
+                return None, current
+        try:
+            records = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return None, current
+    return _decoders[kind](records), current
+
+
+def readCache(path, kind, cacheDir):
+    """
+    Returns the records stored in the cache for <path>, or None if there is no entry
+    or if the entry is stale.
+    """
+    return readEntry(path, kind, cacheDir)[0]
+
+
+def writeCache(path, kind, cacheDir, records, digest=None):
+    """
+    Stores parsed records in the cache. digest is the md5 of <path> if the caller already
+    has it. The entry is written to a temporary file and renamed so that concurrent jobs
+    never see a partial entry.
+    """
+    if not os.path.exists(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError:
+            #another job made it first
+            pass
+    key = fileKey(path)
+    if digest is None:
+        digest = fileHash(path)
+    cache = cachePath(path, kind, cacheDir)
+    tmp = "{}.{}.tmp".format(cache, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            marshal.dump((key, digest), f)
+            marshal.dump(_encoders[kind](records), f)
+        os.rename(tmp, cache)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def encodePsl(alignments):
+    """
+    Flattens a list of PslRow objects into tuples of their slots.
+    """
+    slots = psl_lib.PslRow.__slots__
+    return [tuple(getattr(a, x) for x in slots) for a in alignments]
+
+
+def decodePsl(records):
+    """
+    Rebuilds PslRow objects from the output of encodePsl without parsing.
+    """
+    alignments = []
+    new = psl_lib.PslRow.__new__
+    for r in records:
+        a = new(psl_lib.PslRow)
+        (a.matches, a.misMatches, a.repMatches, a.nCount, a.qNumInsert, a.qBaseInsert,
+                a.tNumInsert, a.tBaseInsert, a.strand, a.qName, a.qSize, a.qStart, a.qEnd,
+                a.tName, a.tSize, a.tStart, a.tEnd, a.blockCount, a.blockSizes, a.qStarts,
+                a.tStarts) = r
+        alignments.append(a)
+    return alignments
+
+
+def encodeTranscripts(transcripts):
+    """
+    Flattens a list of Transcript objects into tuples. The chromosome and strand are
+    shared by every interval of a transcript and the introns can be derived from the
+    exons, so only the exon coordinates and the Exon mappings are stored.
+    """
+    records = []
+    for t in transcripts:
+        exonIntervals = tuple((e.start, e.stop) for e in t.exonIntervals)
+        exons = tuple((e.start, e.stop, e.chromStart, e.chromStop, e.cdsStart, e.cdsStop, e.cdsPos)
+                for e in t.exons)
+        records.append((t.name, t.strand, t.score, t.thickStart, t.thickStop, t.start, t.stop,
+                t.rgb, t.chromosomeInterval.chromosome, exonIntervals, exons))
+    return records
+
+
+def _interval(chrom, start, stop, strand):
+    """
+    Builds a ChromosomeInterval without the type checking done by its constructor.
+    """
+    i = seq_lib.ChromosomeInterval.__new__(seq_lib.ChromosomeInterval)
+    i.chromosome, i.start, i.stop, i.strand = chrom, start, stop, strand
+    return i
+
+
+def decodeTranscripts(records):
+    """
+    Rebuilds Transcript objects from the output of encodeTranscripts.
+    """
+    transcripts = []
+    newTranscript, newExon = seq_lib.Transcript.__new__, seq_lib.Exon.__new__
+    for (name, strand, score, thickStart, thickStop, start, stop, rgb, chrom, exonIntervals,
+            exons) in records:
+        t = newTranscript(seq_lib.Transcript)
+        t.name, t.strand, t.score, t.thickStart, t.thickStop = name, strand, score, thickStart, thickStop
+        t.start, t.stop, t.rgb = start, stop, rgb
+        t.chromosomeInterval = _interval(chrom, start, stop, strand)
+        t.exonIntervals = [_interval(chrom, s, e, strand) for s, e in exonIntervals]
+        t.intronIntervals = [_interval(chrom, exonIntervals[i][1], exonIntervals[i + 1][0], strand)
+                for i in xrange(len(exonIntervals) - 1)]
+        t.exons = []
+        for (s, e, chromStart, chromStop, cdsStart, cdsStop, cdsPos) in exons:
+            x = newExon(seq_lib.Exon)
+            x.start, x.stop, x.strand, x.chromStart, x.chromStop = s, e, strand, chromStart, chromStop
+            x.cdsStart, x.cdsStop, x.cdsPos = cdsStart, cdsStop, cdsPos
+            t.exons.append(x)
+        transcripts.append(t)
+    return transcripts
+
+
+def encodeAttributes(attribute_dict):
+    """
+    Flattens a attribute dict into tuples of Attribute fields.
+    """
+    return [(a.geneID, a.geneName, a.geneType, a.transcriptID, a.transcriptType)
+            for a in attribute_dict.itervalues()]
+
+
+def decodeAttributes(records):
+    """
+    Rebuilds a attribute dict from the output of encodeAttributes.
+    """
+    return dict((r[3], seq_lib.Attribute(*r)) for r in records)
+
+
+_encoders = {"psl": encodePsl, "bed": encodeTranscripts, "attributes": encodeAttributes}
+_decoders = {"psl": decodePsl, "bed": decodeTranscripts, "attributes": decodeAttributes}
+
+
+def loadCached(path, kind, parser, cacheDir):
+    """
+    Returns parser(path), using the cache in <cacheDir> if it holds a valid entry.
+    If cacheDir is None the file is always parsed.
+    """
+    if cacheDir is None:
+        return parser(path)
+    records, digest = readEntry(path, kind, cacheDir)
+    if records is None:
+        records = parser(path)
+        writeCache(path, kind, cacheDir, records, digest)
+    return records
+
+
+def readPsl(infile, cacheDir=None):
+    """
+    Cached version of psl_lib.readPsl
+    """
+    return loadCached(infile, "psl", psl_lib.readPsl, cacheDir)
+
+
+def getTranscripts(bedFile, cacheDir=None):
+    """
+    Cached version of seq_lib.getTranscripts
+    """
+    return loadCached(bedFile, "bed", seq_lib.getTranscripts, cacheDir)
+
+
+def getTranscriptAttributeDict(attributeFile, cacheDir=None):
+    """
+    Cached version of seq_lib.getTranscriptAttributeDict
+    """
+    return loadCached(attributeFile, "attributes", seq_lib.getTranscriptAttributeDict, cacheDir)
+
+
+_loaders = {"psl": readPsl, "bed": getTranscripts, "attributes": getTranscriptAttributeDict}
+
+
+def prebuildCache(dataDir, cacheDir, extraFiles=None):
+    """
+    Builds cache entries for every PSL and BED file in <dataDir>. extraFiles is a
+    optional list of (path, kind) pairs for inputs that live elsewhere, such as the
+    annotation BED and the attribute map. Entries that are already valid are left alone.
+    """
+    files = []
+    for f in sorted(os.listdir(dataDir)):
+        for ext, kind in cache_extensions.iteritems():
+            if f.endswith(ext):
+                files.append((os.path.join(dataDir, f), kind))
+    if extraFiles is not None:
+        files.extend(extraFiles)
+    for path, kind in files:
+        _loaders[kind](path, cacheDir)
@@ -0,0 +1,207 @@
+"""
+Transparent reading of gzip and BGZF compressed text inputs.
+
+openInput returns a file-like object for a plain, gzip or BGZF file, chosen from the
+first bytes of the file rather than its name. BGZF files (bgzip/samtools/tabix output)
+are a series of independent gzip blocks of at most 64kb, so they are read with
+BgzfReader, which can decompress batches of blocks in a thread pool. zlib releases the
+GIL while it inflates, so the threads decompress in parallel.
+
+BgzfReader also supports tell/seek with BGZF virtual offsets, so the qName index of
+psl_lib works on BGZF compressed PSL files. Plain gzip files can only be streamed.
+"""
+
+import zlib
+import gzip
+import struct
+from bisect import bisect_right
+from multiprocessing.pool import ThreadPool
+
+gzip_magic = "\x1f\x8b"
+#gzip header of a BGZF block up to the extra field: magic, deflate, FEXTRA flag
+bgzf_magic = "\x1f\x8b\x08\x04"
+#number of blocks handed to the thread pool at a time
+bgzf_batch_size = 64
+
+
+def isGzip(path):
+    """ Is the file at <path> gzip compressed? BGZF files are gzip files too.
+    """
+    with open(path, 'rb') as f:
+        return f.read(2) == gzip_magic
+
+
+def isBgzf(path):
+    """ Is the file at <path> BGZF compressed? Checks the BC extra subfield of the first block.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == bgzf_magic and header[12:14] == "BC"
+
+
+def openInput(path, threads=1):
+    """ Opens a plain, gzip or BGZF file for reading. BGZF files are decompressed with
+    <threads> threads.
+    """
+    if isBgzf(path):
+        return BgzfReader(path, threads)
+    elif isGzip(path):
+        return gzip.GzipFile(path, 'rb')
+    return open(path, 'rb')
+
+
+def _inflateBlock(block):
+    """ Decompresses the raw deflate data of a BGZF block, checking its length and CRC32.
+    """
+    data, size, crc = block
+    data = zlib.decompress(data, -15)
+    if len(data) != size:
+        raise RuntimeError("BGZF block decompressed to {} bytes, expected {}".format(len(data), size))
+    if zlib.crc32(data) & 0xffffffff != crc:
+        raise RuntimeError("BGZF block failed its CRC32 check")
+    return data
+
+
+class BgzfReader(object):
+    """ File-like reader for BGZF files. Supports read, readline, iteration and tell/seek
+    with virtual offsets, (compressed block start << 16) | offset within the block.
+    With threads > 1 batches of bgzf_batch_size blocks are decompressed in a thread pool.
+    """
+    def __init__(self, path, threads=1):
+        self.f = open(path, 'rb')
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        #decompressed blocks not yet returned, as (compressed start, data)
+        self.pending = []
+        self.blockStart = 0
+        self.buf = ''
+        self.pos = 0
+        #compressed start of every block read so far, and the uncompressed offset it starts at.
+        #Only kept while the file is read sequentially from the start
+        self.sequential = True
+        self.blockStarts = []
+        self.uncompressedStarts = []
+        self.uncompressed = 0
+
+    def _readRawBlock(self):
+        """ Reads the next block from disk. Returns (compressed start, (deflate data, size, crc))
+        or None at the end of the file.
+        """
+        start = self.f.tell()
+        header = self.f.read(18)
+        if len(header) == 0:
+            return None
+        if len(header) != 18 or header[:4] != bgzf_magic:
+            raise RuntimeError("Not a BGZF block at offset {}".format(start))
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = header[12:] + self.f.read(xlen - 6)
+        bsize = None
+        i = 0
+        while i < len(extra):
+            si, slen = extra[i:i + 2], struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if si == "BC":
+                bsize = struct.unpack("<H", extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise RuntimeError("BGZF block at offset {} has no BC field".format(start))
+        data = self.f.read(bsize - xlen - 19)
+        crc, size = struct.unpack("<II", self.f.read(8))
+        return start, (data, size, crc)
+
+    def _nextBlock(self):
+        """ Loads the next non empty decompressed block into the buffer. Returns False at
+        the end of the file.
+        """
+        while True:
+            if len(self.pending) == 0:
+                raw = []
+                for i in xrange(bgzf_batch_size if self.pool is not None else 1):
+                    block = self._readRawBlock()
+                    if block is None:
+                        break
+                    raw.append(block)
+                if len(raw) == 0:
+                    return False
+                blocks = [x[1] for x in raw]
+                if self.pool is not None:
+                    data = self.pool.map(_inflateBlock, blocks)
+                else:
+                    data = map(_inflateBlock, blocks)
+                self.pending = zip([x[0] for x in raw], data)[::-1]
+            self.blockStart, self.buf = self.pending.pop()
+            self.pos = 0
+            if self.sequential is True:
+                self.blockStarts.append(self.blockStart)
+                self.uncompressedStarts.append(self.uncompressed)
+                self.uncompressed += len(self.buf)
+            if len(self.buf) > 0:
+                return True
+
+    def read(self, size=-1):
+        """ Reads up to <size> bytes, or the rest of the file.
+        """
+        parts = []
+        while size < 0 or size > 0:
+            if self.pos == len(self.buf) and not self._nextBlock():
+                break
+            stop = len(self.buf) if size < 0 else min(len(self.buf), self.pos + size)
+            parts.append(self.buf[self.pos:stop])
+            if size > 0:
+                size -= stop - self.pos
+            self.pos = stop
+        return ''.join(parts)
+
+    def readline(self):
+        parts = []
+        while True:
+            if self.pos == len(self.buf) and not self._nextBlock():
+                break
+            i = self.buf.find('\n', self.pos)
+            stop = len(self.buf) if i == -1 else i + 1
+            parts.append(self.buf[self.pos:stop])
+            self.pos = stop
+            if i != -1:
+                break
+        return ''.join(parts)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if line == '':
+                return
+            yield line
+
+    def tell(self):
+        """ Returns the virtual offset of the next byte to be read.
+        """
+        return self.blockStart << 16 | self.pos
+
+    def seek(self, offset):
+        """ Moves to a virtual offset from tell or virtualOffset.
+        """
+        self.sequential = False
+        self.pending = []
+        self.f.seek(offset >> 16)
+        self.buf, self.pos, self.blockStart = '', 0, offset >> 16
+        if self._nextBlock() and self.blockStart == offset >> 16:
+            self.pos = offset & 0xFFFF
+
+    def virtualOffset(self, offset):
+        """ Converts a offset in the uncompressed stream, within the part of the file
+        already read, to a virtual offset. Only possible before the first seek.
+        """
+        if self.sequential is False:
+            raise RuntimeError("virtualOffset needs a BgzfReader that has only been read sequentially")
+        i = bisect_right(self.uncompressedStarts, offset) - 1
+        return self.blockStarts[i] << 16 | (offset - self.uncompressedStarts[i])
+
+    def close(self):
+        self.f.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
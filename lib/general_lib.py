@@ -10,6 +10,8 @@ With contributions from Dent Earl
 import os
 import argparse
 
+import numpy as np
+
 
 class FullPaths(argparse.Action):
         """
@@ -26,6 +28,17 @@ def formatRatio(numerator, denominator):
         return float(numerator)/denominator
 
 
+def formatRatioArray(numerator, denominator):
+        """
+        Elementwise formatRatio over two integer arrays. Gives the same float64
+        values as calling formatRatio on each pair, including nan for a zero denominator.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+                r = np.true_divide(numerator, denominator)
+        r[denominator == 0] = float("nan")
+        return r
+
+
 def DirType(d):
     """ given a string path to a directory, D, verify it can be used.
     """
@@ -4,15 +4,50 @@ Original author: Dent Earl
 Modified by: Ian Fiddes
 
 """
+from collections import defaultdict
 from glob import glob
 import os
+import random
+import re
 import shutil
 import string
 import subprocess
 import sys
+import threading
 import unittest
+import gzip
+import itertools
+import json
+import logging
+import marshal
+import math
+import struct
+import zlib
+from StringIO import StringIO
+import numpy as np
 import sequence_lib as seq_lib
 import psl_lib as psl_lib
+import twobit
+import sqlite3 as sql
+import sqlite_lib as sql_lib
+import compression_lib
+import cache_lib
+import general_lib
+#the classifiers need jobTree, which the library tests otherwise do not
+try:
+    import src.end_stop as endStop
+    import src.in_frame_stop as inFrameStop
+    import src.alignment_identity as alignmentIdentity
+    import src.alignment_coverage as alignmentCoverage
+    import src.alignment_partial_map as alignmentPartialMap
+    import src.alignment_abuts_left as alignmentAbutsLeft
+    import src.alignment_abuts_right as alignmentAbutsRight
+    import src.export_columns as exportColumns
+    import src.abstract_classifier as abstractClassifier
+    import src.classifier_runner as classifierRunner
+    import src.main as pipeline
+except ImportError:
+    endStop = inFrameStop = None
 
 def makeTempDirParent():
     """ 
@@ -149,6 +184,32 @@ def createSequenceFile(sequences, tmpDir, filename='seq.fa'):
     return seqfile
 
 
+def createTwoBitFile(sequences, tmpDir, filename='seq.2bit'):
+    """
+    given a list of (name, sequence) pairs return path to a 2bit temp file. Runs of N
+    are stored as N blocks.
+    """
+    code = {'T': 0, 'C': 1, 'A': 2, 'G': 3, 'N': 0}
+    index, records = [], []
+    offset = 16 + sum(1 + len(name) + 4 for name, sequence in sequences)
+    for name, sequence in sequences:
+        nBlocks = [(m.start(), m.end() - m.start()) for m in re.finditer('N+', sequence)]
+        record = struct.pack('<II', len(sequence), len(nBlocks))
+        record += ''.join(struct.pack('<I', x[0]) for x in nBlocks)
+        record += ''.join(struct.pack('<I', x[1]) for x in nBlocks)
+        record += struct.pack('<II', 0, 0)
+        padded = sequence + 'T' * (-len(sequence) % 4)
+        record += ''.join(chr(reduce(lambda b, c: b << 2 | code[c], padded[i:i + 4], 0))
+                for i in xrange(0, len(padded), 4))
+        index.append(chr(len(name)) + name + struct.pack('<I', offset))
+        records.append(record)
+        offset += len(record)
+    twoBitFile = os.path.join(tmpDir, filename)
+    with open(twoBitFile, 'wb') as f:
+        f.write(struct.pack('<IIII', 0x1A412743, 0, len(sequences), 0) + ''.join(index) + ''.join(records))
+    return twoBitFile
+
+
 def createAlignmentFile(alignments, tmpDir):
     """
     given a list of alignments, return path to a temp file.
@@ -1247,5 +1308,1359 @@ class ComplicatedTranscript2(unittest.TestCase):
         self.assertEqual(self.t.getIntronSequences(self.chrom_seq), self.introns)
 
 
+class SpliceSitesTests(unittest.TestCase):
+    """
+    Tests the motif evaluation of SpliceSites on a hand built table of introns.
+    """
+
+    def setUp(self):
+        CDS, UTR = seq_lib.SpliceSites.CDS, seq_lib.SpliceSites.UTR
+        self.sites = seq_lib.SpliceSites(np.array(['A', 'B', 'C'], dtype=object),
+                np.array([0, 0, 1, 1, 2], dtype=np.int32),
+                np.array([100, 100, 100, 10, 100], dtype=np.int32),
+                np.array([CDS, UTR, CDS, CDS, UTR], dtype=np.int8),
+                np.array(['GT', 'GC', 'GT', 'GT', 'AT'], dtype='S2'),
+                np.array(['AG', 'AC', 'AC', 'AC', 'AG'], dtype='S2'))
+
+    def test_bad_splices(self):
+        canonical = {"GT": "AG"}
+        known = {"GT": "AG", "GC": "AG", "AT": "AC"}
+        self.assertEqual(self.sites.badSplices(canonical, seq_lib.SpliceSites.CDS, 30), set(['B']))
+        self.assertEqual(self.sites.badSplices(canonical, seq_lib.SpliceSites.CDS, 0), set(['B']))
+        self.assertEqual(self.sites.badSplices(canonical, seq_lib.SpliceSites.UTR, 30), set())
+        self.assertEqual(self.sites.badSplices(known, seq_lib.SpliceSites.UTR, 30), set(['A', 'C']))
+
+class GetSpliceSitesTests(unittest.TestCase):
+    """
+    Tests getSpliceSites on a 2bit file against slicing the chromosome string, for
+    transcripts on both strands.
+    """
+
+    def setUp(self):
+        r = random.Random(3)
+        self.chroms = dict((c, ''.join(r.choice('ACGT') for i in xrange(1000))) for c in ('chr1', 'chr2'))
+        self.tmp = makeTempDir('get_splice_sites')
+        self.addCleanup(removeDir, self.tmp)
+        self.twoBit = twobit.TwoBitFile(createTwoBitFile(sorted(self.chroms.items()), self.tmp))
+        #three CDS introns; a UTR and a mixed intron; on the negative strand a CDS intron
+        #followed by a mixed one in chromosome order; a single exon; a negative strand UTR intron
+        beds = [bedLine('chr1', 10, 200, 'P', 0, '+', 30, 170, '0', 3, '30,40,40', '0,70,150'),
+                bedLine('chr1', 300, 460, 'Q', 0, '+', 430, 450, '0', 3, '20,30,40', '0,50,120'),
+                bedLine('chr1', 500, 720, 'M', 0, '-', 510, 610, '0', 3, '30,50,20', '0,100,200'),
+                bedLine('chr2', 10, 50, 'S', 0, '-', 20, 30, '0', 1, '40', '0'),
+                bedLine('chr2', 100, 400, 'U', 0, '-', 100, 100, '0', 2, '50,50', '0,250')]
+        self.transcripts = [seq_lib.Transcript(x.split()) for x in beds]
+
+    def tearDown(self):
+        self.twoBit.close()
+
+    def expected(self, t):
+        """
+        Introns in chromosome order as (length, tag, donor, acceptor), computed from the
+        chromosome string and the thick coordinates
+        """
+        seq = self.chroms[t.chromosomeInterval.chromosome]
+        rc = lambda x: x.translate(string.maketrans('ACGT', 'TGCA'))[::-1]
+        exons = t.exonIntervals
+        introns = []
+        for i in xrange(len(exons) - 1):
+            start, stop = exons[i].stop, exons[i + 1].start
+            cds = [e.start < t.thickStop and e.stop > t.thickStart for e in (exons[i], exons[i + 1])]
+            tag = seq_lib.SpliceSites.CDS if all(cds) else seq_lib.SpliceSites.UTR if not any(cds) else \
+                    seq_lib.SpliceSites.NONE
+            if t.strand is True:
+                introns.append((stop - start, tag, seq[start:start + 2], seq[stop - 2:stop]))
+            else:
+                introns.append((stop - start, tag, rc(seq[stop - 2:stop]), rc(seq[start:start + 2])))
+        return introns
+
+    def test_get_splice_sites(self):
+        sites = seq_lib.getSpliceSites(self.transcripts, self.twoBit)
+        found = defaultdict(list)
+        for i, j in enumerate(sites.transcript):
+            found[sites.names[j]].append((sites.length[i], sites.tag[i], sites.donor[i], sites.acceptor[i]))
+        self.assertEqual(sorted(found), ['M', 'P', 'Q', 'U'])
+        for t in self.transcripts:
+            self.assertEqual(found.get(t.name, []), self.expected(t))
+        self.assertEqual([x[1] for x in found['M']], [seq_lib.SpliceSites.CDS, seq_lib.SpliceSites.NONE])
+
+
+class TranscriptSequenceTests(unittest.TestCase):
+    """
+    Tests getMRna, getCds and getIntronSequences on a 2bit file against slicing the
+    chromosome string, for transcripts on both strands.
+    """
+
+    def setUp(self):
+        r = random.Random(7)
+        self.chroms = dict((c, ''.join(r.choice('ACGT') for i in xrange(800))) for c in ('chr1', 'chr2'))
+        self.tmp = makeTempDir('transcript_sequence')
+        self.addCleanup(removeDir, self.tmp)
+        self.twoBit = twobit.TwoBitFile(createTwoBitFile(sorted(self.chroms.items()), self.tmp))
+        #CDS starting and ending inside exons; CDS inside one exon; a single exon; non-coding
+        beds = [bedLine('chr1', 10, 200, 'P', 0, '+', 30, 170, '0', 3, '30,40,40', '0,70,150'),
+                bedLine('chr1', 500, 720, 'M', 0, '-', 510, 610, '0', 3, '30,50,20', '0,100,200'),
+                bedLine('chr2', 300, 460, 'Q', 0, '-', 430, 450, '0', 3, '20,30,40', '0,50,120'),
+                bedLine('chr2', 10, 50, 'S', 0, '+', 20, 30, '0', 1, '40', '0'),
+                bedLine('chr2', 600, 780, 'U', 0, '-', 0, 0, '0', 2, '50,50', '0,130')]
+        self.transcripts = [seq_lib.Transcript(x.split()) for x in beds]
+
+    def tearDown(self):
+        self.twoBit.close()
+
+    def test_sequences(self):
+        rc = lambda x: x.translate(string.maketrans('ACGT', 'TGCA'))[::-1]
+        for t in self.transcripts:
+            seq = self.chroms[t.chromosomeInterval.chromosome]
+            exons = t.exonIntervals
+            mRna = ''.join(seq[e.start:e.stop] for e in exons)
+            cds = ''.join(seq[max(e.start, t.thickStart):min(e.stop, t.thickStop)] for e in exons
+                    if e.start < t.thickStop and e.stop > t.thickStart)
+            introns = [seq[exons[i].stop:exons[i + 1].start] for i in xrange(len(exons) - 1)]
+            if t.strand is False:
+                mRna, cds, introns = rc(mRna), rc(cds), [rc(x) for x in introns[::-1]]
+            self.assertEqual(t.getMRna(self.twoBit), mRna)
+            self.assertEqual(t.getCds(self.twoBit), cds)
+            self.assertEqual(t.getIntronSequences(self.twoBit), introns)
+            self.assertEqual(len(t.getCds(self.twoBit)), t.getCdsLength())
+        self.assertEqual([len(t.getCds(self.twoBit)) for t in self.transcripts], [60, 30, 20, 10, 0])
+
+
+def oldCodonToAminoAcid(c):
+    """ codonToAminoAcid as it was before the codon lookup table.
+    """
+    c = c.upper()
+    if c in seq_lib._codonTable:
+        return seq_lib._codonTable[c]
+    return '?'
+
+
+def oldTranslateSequence(sequence):
+    """ translateSequence as it was before the codon lookup table.
+    """
+    sequence = sequence[:len(sequence) - len(sequence) % 3]
+    return "".join(oldCodonToAminoAcid(sequence[i : i + 3]) for i in xrange(0, len(sequence), 3))
+
+
+def oldCdsCoordinateToAminoAcid(cds, p):
+    """ Transcript.cdsCoordinateToAminoAcid as it was before the integer arithmetic.
+    """
+    if p >= len(cds) or p < 0:
+        return None
+    start, stop = int(math.floor(p / 3.0) * 3),  int(math.ceil((p + 0.1) / 3.0) * 3)
+    if stop - start != 3:
+        return None
+    return oldCodonToAminoAcid(cds[start : stop])
+
+
+class InFrameStopTests(unittest.TestCase):
+    """
+    Tests the codon lookup, findInFrameStops and the EndStop and InFrameStop classifiers
+    against the codon by codon translation they replaced, on sequences with N and lower
+    case bases and partial trailing codons.
+    """
+
+    def setUp(self):
+        self.r = random.Random(13)
+        #N runs of 1-3 bases so that some codons hold a N
+        chrom = ''.join(self.r.choice(['A', 'C', 'G', 'T'] * 12 + ['N', 'NN', 'NNN']) for i in xrange(3000))
+        self.transcripts = []
+        for i in xrange(300):
+            start = self.r.randint(0, 2500)
+            sizes, starts, pos = [], [], 0
+            for j in xrange(self.r.randint(1, 4)):
+                sizes.append(self.r.randint(5, 60))
+                starts.append(pos)
+                pos += sizes[-1] + self.r.randint(5, 40)
+            stop = start + starts[-1] + sizes[-1]
+            if i % 10 == 0:
+                thickStart = thickStop = 0
+            else:
+                #the CDS starts and ends on exon bases
+                bases = [start + x + k for x, size in zip(starts, sizes) for k in xrange(size)]
+                thickStart, thickStop = sorted(self.r.sample(bases, 2))
+                thickStop += 1
+            bed = bedLine('chr1', start, stop, 'T{}'.format(i), 0, self.r.choice('+-'), thickStart,
+                    thickStop, '0', len(sizes), ','.join(map(str, sizes)), ','.join(map(str, starts)))
+            self.transcripts.append(seq_lib.Transcript(bed.split()))
+        self.tmp = makeTempDir('in_frame_stop')
+        self.addCleanup(removeDir, self.tmp)
+        self.twoBit = twobit.TwoBitFile(createTwoBitFile([('chr1', chrom)], self.tmp))
+
+    def tearDown(self):
+        self.twoBit.close()
+
+    def test_codons(self):
+        for n in xrange(4):
+            for codon in itertools.product('ACGTNacgtnX', repeat=n):
+                codon = ''.join(codon)
+                self.assertEqual(seq_lib.codonToAminoAcid(codon), oldCodonToAminoAcid(codon))
+        for i in xrange(200):
+            seq = ''.join(self.r.choice('ACGTNacgtn') for j in xrange(self.r.randint(0, 40)))
+            self.assertEqual(seq_lib.translateSequence(seq), oldTranslateSequence(seq))
+
+    def test_find_in_frame_stops(self):
+        for i in xrange(500):
+            seq = ''.join(self.r.choice('ACGTNacgt') for j in xrange(self.r.randint(0, 60)))
+            start = self.r.randint(0, 5)
+            stop = self.r.choice([None, self.r.randint(0, 70)])
+            expected = [p for p in xrange(start, len(seq) if stop is None else stop, 3)
+                    if oldCodonToAminoAcid(seq[p : p + 3]) == '*']
+            self.assertEqual(seq_lib.findInFrameStops(seq, start, stop), expected)
+            self.assertEqual(seq_lib.findInFrameStops(seq, start, stop, firstOnly=True), expected[:1])
+
+    def test_transcripts(self):
+        seqDict = self.twoBit
+        for t in self.transcripts:
+            cds = t.getCds(seqDict)
+            for p in xrange(-1, len(cds) + 2):
+                self.assertEqual(t.cdsCoordinateToAminoAcid(p, seqDict), oldCdsCoordinateToAminoAcid(cds, p))
+            self.assertEqual(t.getProteinSequence(seqDict),
+                    oldTranslateSequence(cds) if len(cds) >= 3 else "")
+        lengths = [len(t.getCds(seqDict)) for t in self.transcripts]
+        #partial trailing codons, N codons and stops are all covered
+        self.assertEqual(set(x % 3 for x in lengths), set([0, 1, 2]))
+        self.assertTrue(any('N' in t.getCds(seqDict) for t in self.transcripts))
+        self.assertTrue(sum(len(seq_lib.findInFrameStops(t.getCds(seqDict))) for t in self.transcripts) > 50)
+
+    @unittest.skipIf(endStop is None, "the classifiers need jobTree")
+    def test_classifiers(self):
+        transcriptDict = seq_lib.transcriptListToDict(self.transcripts, noDuplicates=True)
+        #EndStop and InFrameStop as they were, codon by codon
+        expectedEndStop, expectedInFrameStop = {}, {}
+        for a, t in transcriptDict.iteritems():
+            cds = t.getCds(self.twoBit)
+            s = oldTranslateSequence(cds) if len(cds) >= 3 else ""
+            expectedEndStop[a] = 1 if len(s) > 0 and s[-1] != "*" else 0
+            cdsSize = t.getCdsLength()
+            if cdsSize >= 9:
+                for i in xrange(3, cdsSize - 3, 3):
+                    if oldCdsCoordinateToAminoAcid(cds, i) == "*":
+                        expectedInFrameStop[a] = i
+            else:
+                expectedInFrameStop[a] = -1
+        for classifier, expected in ((endStop.EndStop, expectedEndStop),
+                (inFrameStop.InFrameStop, expectedInFrameStop)):
+            c = classifier.__new__(classifier)
+            c.transcript_dict, c.seq_dict = transcriptDict, self.twoBit
+            result = {}
+            c.upsert_dict_wrapper = result.update
+            c.run()
+            self.assertEqual(result, expected)
+        self.assertTrue(0 < sum(expectedEndStop.values()) < len(expectedEndStop))
+        self.assertTrue(len([x for x in expectedInFrameStop.values() if x > 0]) > 10)
+
+
+##############################################################################
+##############################################################################
+#
+#The classes below test functions and classes in the psl_lib library
+#
+##############################################################################
+##############################################################################
+
+class PslTableTests(unittest.TestCase):
+    """
+    Tests the column store PslTable and its PslTableRow views against PslRow.
+    """
+
+    def setUp(self):
+        self.rows = [simplePsl('+', 20, 2, 18, 100, 10, 40, [6, 10], [2, 8], [10, 30], qName='A-0'),
+                simplePsl('-', 15, 0, 15, 50, 0, 15, [15], [0], [0], qName='B-0', tName='other'),
+                simplePsl('+', 30, 0, 30, 100, 60, 100, [10, 5, 15], [0, 10, 15], [60, 75, 85],
+                        qName='C-1')]
+        self.table = psl_lib.PslTable.fromRows(self.rows)
+
+    def test_columns(self):
+        """
+        Scalar columns are typed arrays and blocks are stored flat with offsets
+        """
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(list(self.table.qSize), [20, 15, 30])
+        self.assertEqual(list(self.table.offsets), [0, 2, 3, 6])
+        self.assertEqual(list(self.table.tStarts), [10, 30, 0, 60, 75, 85])
+        self.assertEqual(list(self.table.tName), ['target', 'other', 'target'])
+        self.assertEqual(self.table.tNames, ['target', 'other'])
+
+    def test_row_views(self):
+        """
+        Row views must look like the PslRow they were built from
+        """
+        for r, v in zip(self.rows, self.table):
+            self.assertEqual(r.pslString(), v.pslString())
+            self.assertEqual(r.hashkey(), v.hashkey())
+            self.assertEqual(r.qName, v.qName)
+            self.assertEqual(r.tName, v.tName)
+            self.assertEqual(list(r.qStarts), list(v.qStarts))
+            for p in xrange(r.tStart - 2, r.tEnd + 2):
+                self.assertEqual(r.targetCoordinateToQuery(p), v.targetCoordinateToQuery(p))
+            for p in xrange(-2, r.qSize + 2):
+                self.assertEqual(r.queryCoordinateToTarget(p), v.queryCoordinateToTarget(p))
+        self.assertEqual(self.table[-1].qName, 'C-1')
+        self.assertRaises(IndexError, self.table.__getitem__, 3)
+
+    def test_to_rows(self):
+        """
+        Round trip back to PslRow objects
+        """
+        for r, x in zip(self.rows, self.table.toRows()):
+            self.assertEqual(r.pslString(), x.pslString())
+
+
+class PslCoordinateTests(unittest.TestCase):
+    """
+    Tests the block searching coordinate conversions of PslRow and their batch versions.
+    """
+
+    def setUp(self):
+        self.rows = [simplePsl('+', 30, 0, 30, 100, 60, 100, [10, 5, 15], [0, 10, 15], [60, 75, 85]),
+                simplePsl('-', 30, 0, 24, 100, 10, 60, [10, 4, 10], [6, 16, 20], [10, 30, 50])]
+
+    def test_single_positions(self):
+        r = self.rows[1]
+        self.assertEqual([r.targetCoordinateToQuery(p) for p in (9, 10, 19, 20, 30, 33, 34, 59, 60)],
+                [None, 23, 14, None, 13, 10, None, 0, None])
+        self.assertEqual([r.queryCoordinateToTarget(p) for p in (23, 14, 13, 10, 9, 0, 24)],
+                [10, 19, 30, 33, 50, None, None])
+
+    def test_batch_positions(self):
+        for r in self.rows + list(psl_lib.PslTable.fromRows(self.rows)):
+            positions = range(-2, 105)
+            self.assertEqual(r.targetCoordinatesToQuery(positions),
+                    [r.targetCoordinateToQuery(p) for p in positions])
+            self.assertEqual(r.queryCoordinatesToTarget(positions),
+                    [r.queryCoordinateToTarget(p) for p in positions])
+        self.assertEqual(self.rows[0].targetCoordinatesToQuery([]), [])
+        self.assertRaises(RuntimeError, self.rows[0].targetCoordinatesToQuery, [70, 65])
+
+
+class PslIntervalIndexTests(unittest.TestCase):
+    """
+    Tests overlap queries of the target interval index against a brute force search.
+    """
+
+    def setUp(self):
+        r = random.Random(5)
+        self.rows = []
+        for i in xrange(300):
+            tName = r.choice(['chr1', 'chr2'])
+            #mostly short spans, some crossing bin boundaries at each level
+            start = r.randint(0, 3 * 10 ** 8)
+            size = r.choice([1, 100, 10 ** 4, 2 * 10 ** 5, 10 ** 7, 2 * 10 ** 8])
+            self.rows.append(simplePsl('+', size, 0, size, 10 ** 9, start, start + size, [size], [0], [start],
+                    qName='q{}'.format(i), tName=tName))
+
+    def brute_force(self, tName, start, end):
+        return [i for i, a in enumerate(self.rows) if a.tName == tName and a.tStart < end and a.tEnd > start]
+
+    def test_query(self):
+        r = random.Random(6)
+        for index in (psl_lib.PslIntervalIndex.fromAlignments(self.rows),
+                psl_lib.PslIntervalIndex.fromAlignments(psl_lib.PslTable.fromRows(self.rows))):
+            index = psl_lib.PslIntervalIndex.fromString(index.toString())
+            self.assertEqual(len(index), 300)
+            for i in xrange(200):
+                start = r.randint(0, 3 * 10 ** 8)
+                end = start + r.choice([1, 1000, 10 ** 6, 10 ** 8])
+                tName = r.choice(['chr1', 'chr2'])
+                self.assertEqual(index.query(tName, start, end), self.brute_force(tName, start, end))
+            a = self.rows[7]
+            self.assertIn(7, index.queryAlignment(a))
+            self.assertEqual(index.query('chrUn', 0, 100), [])
+            self.assertEqual(index.query('chr1', 100, 100), [])
+
+    def test_sidecar(self):
+        tmp = makeTempDir('psl_interval_index')
+        self.addCleanup(removeDir, tmp)
+        path = os.path.join(tmp, "test.psl")
+        with open(path, "w") as f:
+            f.write("".join(a.pslString() + "\n" for a in self.rows))
+        index = psl_lib.loadPslIntervalIndex(path)
+        self.assertTrue(os.path.exists(psl_lib.pslIntervalIndexPath(path)))
+        self.assertEqual(psl_lib.loadPslIntervalIndex(path).query('chr2', 0, 10 ** 8),
+                index.query('chr2', 0, 10 ** 8))
+        self.assertEqual(index.query('chr2', 0, 10 ** 8), self.brute_force('chr2', 0, 10 ** 8))
+
+
+class AlignmentBatchTests(unittest.TestCase):
+    """
+    Tests that formatRatioArray and the batch() of the alignment metric classifiers give
+    bit for bit the values of the per PslRow loops they replaced.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('alignment_batch')
+        self.addCleanup(removeDir, self.tmp)
+        r = random.Random(17)
+        lines = []
+        for i in xrange(400):
+            blockCount = r.choice([1, 1, 2, 5])
+            sizes = [r.randint(1, 20) for j in xrange(blockCount)]
+            qSize = sum(sizes) + r.choice([0, 0, 3])
+            qStart = r.choice([0, qSize - sum(sizes)])
+            tSize = 1000
+            tStart = r.choice([0, 0, r.randint(1, 500)])
+            tStarts = [tStart + sum(sizes[:j]) + 2 * j for j in xrange(blockCount)]
+            tEnd = tStarts[-1] + sizes[-1]
+            if r.random() < 0.3:
+                #move the alignment to the end of the target
+                tStarts = [x + tSize - tEnd for x in tStarts]
+                tStart, tEnd = tStarts[0], tSize
+            qStarts = [qStart + sum(sizes[:j]) for j in xrange(blockCount)]
+            #zero denominators, zero matches and large counts
+            matches, misMatches, qNumInsert = r.choice([(0, 0, 0), (0, 3, 1), (sum(sizes), 0, 0),
+                    (r.randint(0, 10 ** 9), r.randint(0, 10 ** 6), r.randint(0, 7))])
+            lines.append('\t'.join(map(str, [matches, misMatches, 0, 0, qNumInsert, 0, blockCount - 1, 0,
+                    r.choice('+-'), 'A{}-0'.format(i), qSize, qStart, qStarts[-1] + sizes[-1], 'chr1', tSize,
+                    tStart, tEnd, blockCount, ','.join(map(str, sizes)) + ',',
+                    ','.join(map(str, qStarts)) + ',', ','.join(map(str, tStarts)) + ','])))
+        self.psl = createAlignmentFile(lines, self.tmp)
+
+    def bits(self, d):
+        return dict((k, struct.pack('<d', v)) for k, v in d.iteritems())
+
+    def test_format_ratio_array(self):
+        numerator = np.array([0, 1, 2, 0, 10 ** 9 + 7, 3])
+        denominator = np.array([0, 3, 0, 5, 3 * 10 ** 9 + 1, 3])
+        expected = [general_lib.formatRatio(n, d) for n, d in zip(numerator.tolist(), denominator.tolist())]
+        result = general_lib.formatRatioArray(numerator, denominator).tolist()
+        self.assertEqual([struct.pack('<d', x) for x in result], [struct.pack('<d', x) for x in expected])
+
+    @unittest.skipIf(endStop is None, "the classifiers need jobTree")
+    def test_batches(self):
+        rows = psl_lib.readPsl(self.psl)
+        table = psl_lib.readPslTable(self.psl)
+        names = table.qName.tolist()
+        identity = alignmentIdentity.AlignmentIdentity.batch(table).tolist()
+        coverage = alignmentCoverage.AlignmentCoverage.batch(table).tolist()
+        self.assertEqual(self.bits(dict(zip(names, identity))), self.bits(dict((a.qName,
+                general_lib.formatRatio(a.matches, a.matches + a.misMatches + a.qNumInsert)) for a in rows)))
+        self.assertEqual(self.bits(dict(zip(names, coverage))), self.bits(dict((a.qName,
+                general_lib.formatRatio(a.matches + a.misMatches, a.matches + a.misMatches + a.qNumInsert))
+                for a in rows)))
+        self.assertTrue(any(math.isnan(x) for x in identity))
+        partial = [a.qName for a in rows if a.qSize != a.qEnd - a.qStart]
+        left = [a.qName for a in rows if (a.strand == "+" and a.tStart == 0 and a.qStart != 0) or
+                (a.strand == "-" and a.tEnd == a.tSize and a.qEnd != a.qSize)]
+        right = [a.qName for a in rows if (a.strand == "+" and a.tEnd == a.tSize and a.qEnd != a.qSize) or
+                (a.strand == "-" and a.tStart == 0 and a.qStart != 0)]
+        for classifier, expected in ((alignmentPartialMap.AlignmentPartialMap, partial),
+                (alignmentAbutsLeft.AlignmentAbutsLeft, left), (alignmentAbutsRight.AlignmentAbutsRight, right)):
+            self.assertTrue(len(expected) > 0)
+            self.assertEqual(table.qName[classifier.batch(table)].tolist(), expected)
+        #the same values from a table built from rows, as with --singleLoad
+        self.assertEqual(self.bits(dict(zip(names, alignmentIdentity.AlignmentIdentity.batch(
+                psl_lib.PslTable.fromRows(rows)).tolist()))), self.bits(dict(zip(names, identity))))
+
+    @unittest.skipIf(endStop is None, "the classifiers need jobTree")
+    def test_cached_alignment_table(self):
+        cacheDir = os.path.join(self.tmp, "cache")
+        c = alignmentPartialMap.AlignmentPartialMap.__new__(alignmentPartialMap.AlignmentPartialMap)
+        c.alnPsl, c.cache_dir = self.psl, cacheDir
+        c.get_alignment_table()
+        self.assertNotEqual(cache_lib.readCache(self.psl, "psl", cacheDir), None)
+        self.assertEqual([a.pslString() for a in c.alignment_table],
+                [a.pslString() for a in psl_lib.readPsl(self.psl)])
+
+
+class PslBulkParserTests(unittest.TestCase):
+    """
+    Tests that the bulk PSL parser gives the same rows as PslRow, skipping headers and
+    blank lines.
+    """
+
+    def setUp(self):
+        self.rows = [simplePsl('+', 20, 2, 18, 100, 10, 40, [6, 10], [2, 8], [10, 30], qName='A-0'),
+                simplePsl('-', 15, 0, 15, 50, 0, 15, [15], [0], [0], qName='B-0', tName='other'),
+                simplePsl('+', 30, 0, 30, 100, 60, 100, [10, 5, 15], [0, 10, 15], [60, 75, 85],
+                        qName='C-1')]
+        lines = ['\t'.join(r.pslString().split()) for r in self.rows]
+        #one line separated by spaces and without trailing commas
+        lines[1] = self.rows[1].pslString()
+        self.text = 'psLayout version 3\n\nmatch\tmis-\n-------\n' + '\n\n'.join(lines) + '\n'
+
+    def test_bulk_iterator(self):
+        for chunkSize in (7, 64, 1 << 20):
+            rows = list(psl_lib.pslBulkIterator(StringIO(self.text), chunkSize))
+            self.assertEqual([r.pslString() for r in rows], [r.pslString() for r in self.rows])
+            self.assertEqual(rows[2].tStarts, [60, 75, 85])
+
+    def test_bulk_table(self):
+        c = psl_lib.parsePslLines(list(psl_lib.pslLineChunks(StringIO(self.text)))[0])
+        table = psl_lib.PslTable.fromColumns([c])
+        self.assertEqual([r.pslString() for r in table], [r.pslString() for r in self.rows])
+        self.assertEqual(list(table.offsets), [0, 2, 3, 6])
+        self.assertRaises(RuntimeError, psl_lib.parsePslLines, ['1\t2\t3'])
+
+    def test_malformed_lines(self):
+        lines = ['\t'.join(r.pslString().split()) for r in self.rows]
+        #a float qSize, a empty field and a block list shorter than blockCount
+        for field, value, error in ((10, '1e2', ValueError), (1, '', ValueError), (20, '60,75', RuntimeError)):
+            data = lines[1].split('\t') if field != 20 else lines[2].split('\t')
+            data[field] = value
+            bad = lines[:]
+            bad[1 if field != 20 else 2] = '\t'.join(data)
+            self.assertRaises(error, psl_lib.parsePslLines, bad)
+            self.assertRaises(error, list, psl_lib.pslBulkIterator(StringIO('\n'.join(bad))))
+        #empty block entries are accepted, as by PslRow
+        data = lines[2].split('\t')
+        data[18] = ',10,,5,15,'
+        rows = psl_lib.pslRowsFromColumns(psl_lib.parsePslLines(lines[:2] + ['\t'.join(data)]))
+        self.assertEqual([r.pslString() for r in rows], [r.pslString() for r in self.rows])
+
+    def test_qname_index(self):
+        tmp = makeTempDir('psl_index')
+        self.addCleanup(removeDir, tmp)
+        path = os.path.join(tmp, "test.psl")
+        with open(path, "w") as f:
+            f.write(self.text + self.rows[0].pslString() + "\n")
+        index = psl_lib.loadPslIndex(path)
+        self.assertTrue(os.path.exists(psl_lib.pslIndexPath(path)))
+        self.assertEqual(index[0], ['A-0', 'A-0', 'B-0', 'C-1'])
+        rows = psl_lib.getPslRows(path, ['C-1', 'A-0', 'missing'])
+        self.assertEqual([r.qName for r in rows], ['A-0', 'C-1', 'A-0'])
+        self.assertEqual(rows[1].pslString(), self.rows[2].pslString())
+        self.assertEqual(psl_lib.getPslRowsByName(path, 'B-0')[0].pslString(), self.rows[1].pslString())
+        #a changed file invalidates the stored index
+        with open(path, "w") as f:
+            f.write(self.rows[1].pslString() + "\n")
+        os.utime(path, (0, 0))
+        self.assertEqual(psl_lib.loadPslIndex(path), (['B-0'], [0]))
+
+    def test_read_names(self):
+        tmp = makeTempDir('psl_names')
+        self.addCleanup(removeDir, tmp)
+        path = os.path.join(tmp, "test.psl")
+        with open(path, "w") as f:
+            f.write("psLayout version 3\n\n" + self.text)
+        self.assertEqual(psl_lib.readPslNames(path), [r.qName for r in self.rows])
+
+
+def writeBgzf(path, text, blockSize=65280):
+    """ Writes <text> to <path> as BGZF blocks of <blockSize> uncompressed bytes, followed
+    by the empty end of file block.
+    """
+    with open(path, 'wb') as f:
+        for i in range(0, len(text), blockSize) + [len(text)]:
+            data = text[i:i + blockSize]
+            c = zlib.compressobj(6, zlib.DEFLATED, -15)
+            deflated = c.compress(data) + c.flush()
+            f.write("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00")
+            f.write(struct.pack("<H", len(deflated) + 25))
+            f.write(deflated)
+            f.write(struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class CompressedInputTests(unittest.TestCase):
+    """
+    Tests reading gzip and BGZF compressed PSL files against the plain file.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('compressed_input')
+        self.addCleanup(removeDir, self.tmp)
+        rows = [simplePsl('+', 20 + i, 0, 20 + i, 100, i, 20 + 2 * i, [10, 10 + i], [0, 10], [i, 10 + 2 * i],
+                qName='A{}-0'.format(i % 40)) for i in xrange(100)]
+        self.text = 'psLayout version 3\n\n' + ''.join('\t'.join(a.pslString().split()) + '\n' for a in rows)
+        self.plain = os.path.join(self.tmp, "test.psl")
+        self.gzip = self.plain + ".gz"
+        self.bgzf = os.path.join(self.tmp, "test.bgzf.psl.gz")
+        with open(self.plain, 'w') as f:
+            f.write(self.text)
+        g = gzip.GzipFile(self.gzip, 'wb')
+        g.write(self.text)
+        g.close()
+        #small blocks so that lines span blocks
+        writeBgzf(self.bgzf, self.text, 500)
+
+
+    def test_open_input(self):
+        self.assertFalse(compression_lib.isGzip(self.plain))
+        self.assertFalse(compression_lib.isBgzf(self.gzip))
+        self.assertTrue(compression_lib.isBgzf(self.bgzf))
+        for path in (self.plain, self.gzip, self.bgzf):
+            for threads in (1, 3):
+                with compression_lib.openInput(path, threads) as f:
+                    self.assertEqual(f.read(7) + f.read(), self.text)
+                with compression_lib.openInput(path, threads) as f:
+                    self.assertEqual(list(f), self.text.splitlines(True))
+
+    def test_bgzf_crc(self):
+        with open(self.bgzf, 'rb') as f:
+            data = bytearray(f.read())
+        #flip a bit of the CRC32 of the second block
+        start = struct.unpack("<H", str(data[16:18]))[0] + 1
+        crc = start + struct.unpack("<H", str(data[start + 16:start + 18]))[0] + 1 - 8
+        data[crc] ^= 1
+        corrupt = os.path.join(self.tmp, "corrupt.psl.gz")
+        with open(corrupt, 'wb') as f:
+            f.write(data)
+        for threads in (1, 3):
+            with compression_lib.openInput(corrupt, threads) as f:
+                self.assertRaises(RuntimeError, f.read)
+
+    def test_read_psl(self):
+        expected = [a.pslString() for a in psl_lib.readPsl(self.plain)]
+        for path in (self.gzip, self.bgzf):
+            self.assertEqual([a.pslString() for a in psl_lib.readPsl(path, threads=2)], expected)
+            self.assertEqual([a.pslString() for a in psl_lib.readPslTable(path)], expected)
+
+    def test_bgzf_random_access(self):
+        expected = [a.pslString() for a in psl_lib.getPslRows(self.plain, ['A3-0', 'A39-0'])]
+        self.assertEqual(len(expected), 5)
+        self.assertEqual([a.pslString() for a in psl_lib.getPslRows(self.bgzf, ['A3-0', 'A39-0'])], expected)
+        self.assertRaises(RuntimeError, psl_lib.loadPslIndex, self.gzip)
+
+
+##############################################################################
+##############################################################################
+#
+#The classes below test functions and classes in the cache_lib library
+#
+##############################################################################
+##############################################################################
+
+def slotValues(x):
+    """ Returns the values of every set slot of <x>, recursing into lists, dicts and
+    slotted objects, so that parsed and decoded records can be compared field by field.
+    """
+    if hasattr(x, '__slots__'):
+        return [(s, slotValues(getattr(x, s))) for s in x.__slots__ if hasattr(x, s)]
+    if isinstance(x, dict):
+        return sorted((k, slotValues(v)) for k, v in x.iteritems())
+    if isinstance(x, (list, tuple)):
+        return [slotValues(y) for y in x]
+    return x
+
+
+class InputCacheTests(unittest.TestCase):
+    """
+    Tests that cache entries decode to the same records as a fresh parse, and that
+    entries are dropped when their source file changes.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('input_cache')
+        self.addCleanup(removeDir, self.tmp)
+        self.cacheDir = os.path.join(self.tmp, "cache")
+        rows = [simplePsl('+', 20, 2, 18, 100, 10, 40, [6, 10], [2, 8], [10, 30], qName='A-0'),
+                simplePsl('-', 15, 0, 15, 50, 0, 15, [15], [0], [0], qName='B-0', tName='other')]
+        self.psl = createAlignmentFile(rows, self.tmp)
+        self.bed = createBedFile([
+                bedLine('chr1', 10, 60, 'T1', 0, '+', 15, 50, '0,128,0', 2, '20,15', '0,35'),
+                bedLine('chr2', 0, 40, 'T2', 0, '-', 0, 0, '0', 3, '10,5,10', '0,15,30')],
+                'test.bed', self.tmp)
+        self.attributes = os.path.join(self.tmp, "attrs.tsv")
+        with open(self.attributes, 'w') as f:
+            f.write('geneId\tgeneName\tgeneType\tgeneStatus\ttranscriptId\ttranscriptName\t'
+                    'transcriptType\ttranscriptStatus\thavanaGeneId\thavanaTranscriptId\tccdsId\t'
+                    'level\ttranscriptClass\n')
+            for i in xrange(3):
+                f.write('G{0}\tgene{0}\tprotein_coding\tKNOWN\tT{0}\tname{0}\tprotein_coding\t'
+                        'KNOWN\tH{0}\tHT{0}\t\t2\tcoding\n'.format(i))
+
+
+    def test_round_trip(self):
+        for path, kind, parser in ((self.psl, "psl", cache_lib.psl_lib.readPsl),
+                (self.bed, "bed", cache_lib.seq_lib.getTranscripts),
+                (self.attributes, "attributes", cache_lib.seq_lib.getTranscriptAttributeDict)):
+            expected = parser(path)
+            self.assertTrue(len(expected) > 0)
+            self.assertEqual(cache_lib.readCache(path, kind, self.cacheDir), None)
+            cached = cache_lib.loadCached(path, kind, parser, self.cacheDir)
+            self.assertEqual(slotValues(cached), slotValues(expected))
+            decoded = cache_lib.readCache(path, kind, self.cacheDir)
+            self.assertEqual(slotValues(decoded), slotValues(expected))
+
+    def test_stale_entries(self):
+        cache_lib.readPsl(self.psl, self.cacheDir)
+        self.assertNotEqual(cache_lib.readCache(self.psl, "psl", self.cacheDir), None)
+        #touching the file changes its mtime but not its md5, so the entry is kept
+        st = os.stat(self.psl)
+        os.utime(self.psl, (st.st_atime, st.st_mtime + 10))
+        records, digest = cache_lib.readEntry(self.psl, "psl", self.cacheDir)
+        self.assertNotEqual(records, None)
+        self.assertEqual(digest, cache_lib.fileHash(self.psl))
+        #a edit of the same size with a new mtime is caught by the md5
+        with open(self.psl) as f:
+            text = f.read()
+        with open(self.psl, 'w') as f:
+            f.write(text.replace('A-0', 'C-0'))
+        os.utime(self.psl, (st.st_atime, st.st_mtime + 20))
+        self.assertEqual(os.path.getsize(self.psl), st.st_size)
+        self.assertEqual(cache_lib.readCache(self.psl, "psl", self.cacheDir), None)
+        self.assertEqual([a.qName for a in cache_lib.readPsl(self.psl, self.cacheDir)], ['C-0', 'B-0'])
+        #a unchanged size and mtime is trusted without hashing
+        self.assertEqual(cache_lib.readEntry(self.psl, "psl", self.cacheDir)[1], None)
+
+    def test_broken_entries(self):
+        cache_lib.readPsl(self.psl, self.cacheDir)
+        cache = cache_lib.cachePath(self.psl, "psl", self.cacheDir)
+        with open(cache, 'rb') as f:
+            contents = f.read()
+        #a entry cut off after its key is a miss
+        with open(cache, 'wb') as f:
+            f.write(contents[:len(marshal.dumps(marshal.loads(contents)))])
+        self.assertEqual(cache_lib.readCache(self.psl, "psl", self.cacheDir), None)
+        self.assertEqual(len(cache_lib.readPsl(self.psl, self.cacheDir)), 2)
+        #a failed write leaves neither a entry nor a temporary file behind
+        os.remove(cache)
+        self.assertRaises(ValueError, cache_lib.writeCache, self.attributes, "attributes", self.cacheDir,
+                {"T0": cache_lib.seq_lib.Attribute("G0", "gene0", object(), "T0", "protein_coding")})
+        self.assertEqual(os.listdir(self.cacheDir), [])
+
+
+##############################################################################
+##############################################################################
+#
+#The classes below test functions and classes in the twobit library
+#
+##############################################################################
+##############################################################################
+
+class TwoBitNIndexTests(unittest.TestCase):
+    """
+    Tests the N block queries of TwoBitSequence against a explicit sequence.
+    The queries only use the N block index, so no 2bit file is needed.
+    """
+
+    def setUp(self):
+        self.seq = "ACGT" * 5 + "N" * 10 + "N" * 5 + "AC" + "N" * 3 + "GGTT" * 4 + "N" * 12 + "A"
+        self.s = twobit.TwoBitSequence(None)
+        self.s.size = len(self.seq)
+        #the first run is stored as two adjacent blocks
+        self.s.n_block_starts = [20, 30, 37, 56]
+        self.s.n_block_sizes = [10, 5, 3, 12]
+
+    def test_count_n(self):
+        for start in xrange(-2, len(self.seq) + 2):
+            for end in xrange(start - 2, len(self.seq) + 4):
+                self.assertEqual(self.s.count_n(start, end),
+                        self.seq[max(start, 0):max(end, 0)].count("N"))
+        self.assertEqual(self.s.count_n_many([(0, 20), (0, 100), (21, 38)]), [0, 30, 15])
+
+    def test_has_n_run(self):
+        for start in xrange(0, len(self.seq)):
+            for end in xrange(start, len(self.seq) + 2):
+                for size in (1, 3, 12, 15, 16):
+                    self.assertEqual(self.s.has_n_run(start, end, size),
+                            "N" * size in self.seq[start:end])
+        self.assertEqual(self.s.has_n_run_many([(0, 40), (30, 56)], 15), [True, False])
+
+    def test_many(self):
+        r = random.Random(17)
+        intervals = [(r.randint(-5, len(self.seq) + 5), r.randint(-5, len(self.seq) + 5)) for i in xrange(500)]
+        intervals += [(s, e + 40) for s, e in intervals[:50]] + [(0, 0), (70, 80)]
+        self.assertEqual(self.s.n_runs_many(intervals), [self.s.n_runs(s, e) for s, e in intervals])
+        self.assertEqual(self.s.count_n_many(intervals), [self.s.count_n(s, e) for s, e in intervals])
+        for size in (1, 3, 12, 15, 16):
+            self.assertEqual(self.s.has_n_run_many(intervals, size),
+                    [self.s.has_n_run(s, e, size) for s, e in intervals])
+        self.assertEqual(self.s.count_n_many([]), [])
+
+
+class TwoBitMmapTests(unittest.TestCase):
+    """
+    Tests that a memory mapped TwoBitFile reads the same sequence as a plain one, also
+    from several threads at once.
+    """
+
+    def setUp(self):
+        r = random.Random(11)
+        self.chroms = [('chr{}'.format(i), ''.join(r.choice('ACGT') for j in xrange(400 + 37 * i)) + 'N' * 25 +
+                ''.join(r.choice('ACGT') for j in xrange(101))) for i in xrange(4)]
+        self.tmp = makeTempDir('twobit_mmap')
+        self.addCleanup(removeDir, self.tmp)
+        self.path = createTwoBitFile(self.chroms, self.tmp)
+
+
+    def test_mmap_reads(self):
+        plain = twobit.TwoBitFile(self.path)
+        mapped = twobit.TwoBitFile(self.path, use_mmap=True)
+        try:
+            r = random.Random(1)
+            for name, seq in self.chroms * 3:
+                self.assertEqual(len(mapped[name]), len(seq))
+                self.assertEqual(mapped[name][0:len(seq)], seq)
+                for i in xrange(50):
+                    start = r.randint(0, len(seq) - 1)
+                    end = start + r.randint(1, 60)
+                    self.assertEqual(mapped[name][start:end], plain[name][start:end])
+                    self.assertEqual(mapped[name].get(start, end), seq[start:end])
+        finally:
+            plain.close()
+            mapped.close()
+
+    def test_concurrent_readers(self):
+        mapped = twobit.TwoBitFile(self.path, use_mmap=True, max_loaded=2)
+        errors = []
+        def reader(seed):
+            r = random.Random(seed)
+            try:
+                for i in xrange(300):
+                    name, seq = r.choice(self.chroms)
+                    start = r.randint(0, len(seq) - 1)
+                    end = start + r.randint(1, 80)
+                    if mapped[name][start:end] != seq[start:end]:
+                        errors.append((name, start, end))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=reader, args=(i,)) for i in xrange(8)]
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            mapped.close()
+        self.assertEqual(errors, [])
+        self.assertEqual(mapped.hits + mapped.misses, 8 * 300)
+
+
+class TwoBitLruTests(unittest.TestCase):
+    """
+    Tests the LRU of loaded sequence headers of TwoBitFile and its hit/miss counters.
+    """
+
+    def setUp(self):
+        self.chroms = [('a', 'ACGT' * 10), ('b', 'GGCC' * 12), ('c', 'TTAA' * 9)]
+        self.tmp = makeTempDir('twobit_lru')
+        self.addCleanup(removeDir, self.tmp)
+        self.path = createTwoBitFile(self.chroms, self.tmp)
+
+
+    def loaded(self, f):
+        return sorted(x for x in f.keys() if f.index[x].loaded)
+
+    def test_eviction(self):
+        f = twobit.TwoBitFile(self.path, max_loaded=2)
+        try:
+            a = f['a']
+            f['b']
+            f['a']
+            self.assertEqual((f.hits, f.misses), (1, 2))
+            #b is now the least recently used
+            f['c']
+            self.assertEqual(self.loaded(f), ['a', 'c'])
+            self.assertEqual(f.lru.keys(), ['a', 'c'])
+            f['b']
+            self.assertEqual(self.loaded(f), ['b', 'c'])
+            self.assertEqual((f.hits, f.misses), (1, 4))
+            #a evicted sequence can still be read by a caller holding it
+            self.assertEqual(a[0:8], 'ACGTACGT')
+            self.assertEqual(f['a'][4:12], 'ACGTACGT')
+            self.assertEqual((f.hits, f.misses), (1, 5))
+        finally:
+            f.close()
+
+    def test_single_slot(self):
+        f = twobit.TwoBitFile(self.path, max_loaded=1)
+        try:
+            for name, seq in self.chroms * 2:
+                self.assertEqual(f[name][0:len(seq)], seq)
+                self.assertEqual(self.loaded(f), [name])
+            self.assertEqual((f.hits, f.misses), (0, 6))
+        finally:
+            f.close()
+        for maxLoaded in (0, -1):
+            self.assertRaises(ValueError, twobit.TwoBitFile, self.path, max_loaded=maxLoaded)
+
+
+class TwoBitFetchManyTests(unittest.TestCase):
+    """
+    Tests TwoBitSequence.fetch_many on a 2bit file against slicing the sequence string.
+    """
+
+    def setUp(self):
+        r = random.Random(5)
+        self.seq = ''.join(r.choice('ACGT') for i in xrange(300)) + 'N' * 40 + \
+                ''.join(r.choice('ACGT') for i in xrange(301))
+        self.tmp = makeTempDir('fetch_many')
+        self.addCleanup(removeDir, self.tmp)
+        self.twoBit = twobit.TwoBitFile(createTwoBitFile([('chr1', self.seq)], self.tmp))
+        self.intervals = [(r.randint(-20, 650), r.randint(0, 100)) for i in xrange(200)]
+        self.intervals = [(s, s + l) for s, l in self.intervals] + [(10, 5), (-30, -10), (630, 700)]
+
+    def tearDown(self):
+        self.twoBit.close()
+
+    def expected(self, start, end):
+        start, end = max(start, 0), min(end, len(self.seq))
+        return self.seq[start:end] if end > start else ""
+
+    def test_fetch_many(self):
+        rc = lambda x: x.translate(string.maketrans('ACGT', 'TGCA'))[::-1]
+        sequence = self.twoBit['chr1']
+        expected = [self.expected(s, e) for s, e in self.intervals]
+        for maxGap in (0, 10, 4096):
+            self.assertEqual(sequence.fetch_many(self.intervals, max_gap=maxGap), expected)
+            self.assertEqual(sequence.fetch_many(self.intervals, strand="-", max_gap=maxGap),
+                    [rc(x) for x in expected])
+        self.assertEqual(sequence.fetch_many([]), [])
+
+    def test_coalescing(self):
+        reads = []
+        read = twobit._twobit.read
+        def countingRead(f, seq, start, end, mask):
+            reads.append((start, end))
+            return read(f, seq, start, end, mask)
+        sequence = self.twoBit['chr1']
+        twobit._twobit.read = countingRead
+        try:
+            #out of order, overlapping, 5, 30 and 20 apart
+            intervals = [(200, 210), (100, 150), (140, 160), (165, 170), (230, 240)]
+            result = sequence.fetch_many(intervals, max_gap=10)
+            self.assertEqual(reads, [(100, 170), (200, 210), (230, 240)])
+            del reads[:]
+            self.assertEqual(sequence.fetch_many(intervals, max_gap=30), result)
+            self.assertEqual(reads, [(100, 240)])
+        finally:
+            twobit._twobit.read = read
+        self.assertEqual(result, [self.expected(s, e) for s, e in intervals])
+
+
+##############################################################################
+##############################################################################
+#
+#The classes below test functions in the sqlite library
+#
+##############################################################################
+##############################################################################
+
+class BulkUpsertTests(unittest.TestCase):
+    """
+    Tests the bulk column writes and the shard writes of the sqlite library.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('bulk_upsert')
+        self.addCleanup(removeDir, self.tmp)
+        self.db = os.path.join(self.tmp, "test.db")
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            sql_lib.initializeTable(cur, "G", [["A", "TEXT"], ["B", "TEXT"]], "AlignmentID")
+            sql_lib.upsert(cur, "G", "AlignmentID", "x", "A", "old")
+
+
+    def test_bulk_upsert(self):
+        rows = [("x", "1"), ("y", "2"), ("z", "3")]
+        with sql_lib.ExclusiveSqlConnection(self.db, journalMode="WAL", synchronous="NORMAL") as cur:
+            self.assertEqual(sql_lib.bulkUpsert(cur, "G", "AlignmentID", "B", iter(rows)), 3)
+            self.assertEqual(sql_lib.bulkUpsert(cur, "G", "AlignmentID", "A", [("z", "4")]), 1)
+        con = sql.connect(self.db)
+        self.assertEqual(sorted(con.execute("SELECT AlignmentID, A, B FROM G").fetchall()),
+                [("x", "old", "1"), ("y", None, "2"), ("z", "4", "3")])
+        self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    def test_merge_attached(self):
+        con = sql.connect(self.db)
+        with con:
+            con.execute("CREATE INDEX G_A ON G (A)")
+        merged = os.path.join(self.tmp, "merged.db")
+        for i in xrange(2):
+            with sql_lib.ExclusiveSqlConnection(merged, attach={"genome": self.db}) as cur:
+                self.assertEqual(sql_lib.mergeAttached(cur, "genome"), ["G"])
+        con = sql.connect(merged)
+        self.assertEqual(con.execute("SELECT * FROM G").fetchall(), [("x", "old", None)])
+        self.assertEqual(con.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL")
+                .fetchall(), [("G_A",)])
+
+    def test_merge_attached_compact(self):
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            sql_lib.bulkUpsert(cur, "G", "AlignmentID", "B", [("x", "b"), ("y", "b"), ("z", None)])
+        merged = os.path.join(self.tmp, "merged.db")
+        with sql_lib.ExclusiveSqlConnection(merged, attach={"genome": self.db}) as cur:
+            self.assertEqual(sql_lib.mergeAttachedCompact(cur, "genome", "G", "AlignmentID", ["B"]), ["B"])
+        con = sql.connect(merged)
+        self.assertEqual(con.execute("SELECT * FROM G ORDER BY AlignmentID").fetchall(),
+                [("x", "old", "b"), ("y", None, "b"), ("z", None, None)])
+        self.assertEqual(con.execute("SELECT * FROM B_values").fetchall(), [(1, "b")])
+        self.assertEqual(con.execute("SELECT typeof(AlignmentID), B FROM G_compact").fetchall()[0],
+                ("integer", 1))
+
+    def test_merge_attached_compact_joined_view(self):
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            cur.executemany("INSERT INTO G VALUES (?, ?, ?)", [("y", "new", "b"), ("z", None, "c")])
+        merged = os.path.join(self.tmp, "merged.db")
+        with sql_lib.ExclusiveSqlConnection(merged, attach={"genome": self.db}) as cur:
+            sql_lib.initializeTable(cur, "attributes", [["C", "TEXT"]], "A")
+            cur.executemany("INSERT INTO attributes VALUES (?, ?)", [("old", "c1"), ("other", "c2")])
+            sql_lib.mergeAttachedCompact(cur, "genome", "G", "AlignmentID",
+                    joinedView=["G_view", "attributes", "A", ["C"]])
+            sql_lib.createJoinedView(cur, "G_decoded_view", "G", "attributes", "A", ["C"])
+            sql_lib.createIndexes(cur, "G_compact", ["A"])
+            sql_lib.createIndexes(cur, "attributes", ["C"])
+        con = sql.connect(merged)
+        #matched, unmatched and NULL keys all appear, as with createJoinedView
+        expected = con.execute("SELECT * FROM G_decoded_view ORDER BY AlignmentID").fetchall()
+        self.assertEqual(expected, [("x", "old", None, "c1"), ("y", "new", "b", None), ("z", None, "c", None)])
+        self.assertEqual(con.execute("SELECT * FROM G_view ORDER BY AlignmentID").fetchall(), expected)
+        self.assertEqual(con.execute("SELECT AlignmentID FROM G_view WHERE C='c1'").fetchall(), [("x",)])
+        plan = " ".join(str(x[-1]) for x in con.execute("EXPLAIN QUERY PLAN SELECT * FROM G_view WHERE C='c1'"))
+        self.assertTrue("attributes_C" in plan)
+        self.assertFalse(re.search("SCAN (TABLE )?compact", plan))
+
+    def test_create_joined_view(self):
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            sql_lib.initializeTable(cur, "attributes", [["C", "TEXT"]], "A")
+            cur.execute("INSERT INTO attributes VALUES ('old', 'c')")
+            sql_lib.upsert(cur, "G", "AlignmentID", "y", "A", "new")
+            sql_lib.createJoinedView(cur, "G_view", "G", "attributes", "A", ["C"])
+        con = sql.connect(self.db)
+        self.assertEqual(con.execute("SELECT * FROM G_view ORDER BY AlignmentID").fetchall(),
+                [("x", "old", None, "c"), ("y", "new", None, None)])
+
+    def test_indexes_and_union_view(self):
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            sql_lib.initializeTable(cur, "H", [["A", "TEXT"], ["B", "TEXT"]], "AlignmentID")
+            sql_lib.upsert(cur, "H", "AlignmentID", "x", "B", "h")
+            sql_lib.createIndexes(cur, "G", ["A", "B"])
+            sql_lib.createIndexes(cur, "G", ["A"])
+            sql_lib.createUnionView(cur, "both", [["g", "G"], ["h", "H"]], "Genome")
+        con = sql.connect(self.db)
+        self.assertEqual(con.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL")
+                .fetchall(), [("G_A",), ("G_B",)])
+        self.assertEqual(con.execute("SELECT * FROM both WHERE AlignmentID='x'").fetchall(),
+                [("g", "x", "old", None), ("h", "x", None, "h")])
+
+    def test_merge_attached_packed_flags(self):
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            sql_lib.initializeTable(cur, "F", [["X", "INTEGER"], ["Y", "INTEGER"], ["N", "REAL"]],
+                    "AlignmentID")
+            cur.executemany("INSERT INTO F VALUES (?, ?, ?, ?)", [("a", 1, None, 0.5), ("b", 0, 1, None),
+                    ("c", None, None, 1.5)])
+        merged = os.path.join(self.tmp, "merged.db")
+        with sql_lib.ExclusiveSqlConnection(merged, attach={"genome": self.db}) as cur:
+            sql_lib.mergeAttachedCompact(cur, "genome", "F", "AlignmentID", [], ["X", "Y"], encodeKeys=False)
+        con = sql.connect(merged)
+        self.assertEqual(con.execute("SELECT * FROM F ORDER BY AlignmentID").fetchall(),
+                [("a", 1, 0, 0.5, 1), ("b", 0, 1, None, 2), ("c", 0, 0, 1.5, 0)])
+        self.assertEqual(con.execute("SELECT * FROM F_compact WHERE Flags & 3 != 0").fetchall(),
+                [("a", 0.5, 1), ("b", None, 2)])
+        self.assertEqual(con.execute("SELECT * FROM flag_bits").fetchall(), [("X", 0), ("Y", 1)])
+
+    def test_to_sql_value(self):
+        self.assertEqual(sql_lib.toSqlValue(True, "INTEGER"), 1)
+        self.assertEqual(sql_lib.toSqlValue(1, "REAL"), 1.0)
+        self.assertIsNone(sql_lib.toSqlValue(float("nan"), "REAL"))
+        self.assertIsNone(sql_lib.toSqlValue(None, "TEXT"))
+        self.assertRaises(ValueError, sql_lib.toSqlValue, "chr1", "INTEGER")
+
+    def test_convert_column_types(self):
+        con = sql.connect(self.db)
+        with con:
+            con.execute("CREATE TABLE old (AlignmentID TEXT PRIMARY KEY, N INTEGER, R REAL, T TEXT)")
+            con.executemany("INSERT INTO old VALUES (?, CAST(? AS TEXT), CAST(? AS TEXT), ?)",
+                    [("x", "None", "0.5", "None"), ("y", "chr1", "nan", "3"), ("z", "", "", "")])
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            self.assertEqual(sql_lib.convertColumnTypes(cur, "old"), 5)
+        #an empty string is only a NULL in the numeric columns
+        self.assertEqual(con.execute("SELECT N, R, T FROM old ORDER BY AlignmentID").fetchall(),
+                [(None, 0.5, None), ("chr1", None, "3"), (None, None, "")])
+
+    def test_insert_rows_bulk_update(self):
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            sql_lib.insertRows(cur, "G", "AlignmentID", set(["z", "x", "y"]))
+            self.assertEqual(sql_lib.bulkUpdate(cur, "G", "AlignmentID", "B", [("y", "2"), ("x", "1"),
+                    ("w", "0")]), 2)
+            self.assertEqual(sql_lib.bulkUpdate(cur, "G", "AlignmentID", "A", []), 0)
+        con = sql.connect(self.db)
+        self.assertEqual(sorted(con.execute("SELECT AlignmentID, A, B FROM G").fetchall()),
+                [("x", "old", "1"), ("y", None, "2"), ("z", None, None)])
+
+    def test_exclusive_transaction(self):
+        other = sql.connect(self.db, timeout=0)
+        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+            cur.execute("CREATE TABLE H (x TEXT)")
+            #DDL must not end the exclusive transaction
+            self.assertRaises(sql.OperationalError, other.execute, "CREATE TABLE I (x TEXT)")
+            cur.execute("DROP TABLE H")
+        other.close()
+        try:
+            with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+                cur.execute("CREATE TABLE H (x TEXT)")
+                sql_lib.upsert(cur, "G", "AlignmentID", "y", "A", "new")
+                raise ValueError
+        except ValueError:
+            pass
+        con = sql.connect(self.db)
+        self.assertEqual(con.execute("SELECT name FROM sqlite_master WHERE name='H'").fetchall(), [])
+        self.assertEqual(con.execute("SELECT AlignmentID FROM G").fetchall(), [("x",)])
+
+    def test_locked(self):
+        other = sql.connect(self.db, isolation_level=None)
+        other.execute("BEGIN EXCLUSIVE")
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        sql_lib.logger.addHandler(handler)
+        self.addCleanup(sql_lib.logger.removeHandler, handler)
+        with self.assertRaises(sql.OperationalError):
+            with sql_lib.ExclusiveSqlConnection(self.db, timeout=0) as cur:
+                pass
+        other.execute("ROLLBACK")
+        other.close()
+        self.assertEqual(messages, ["Database {} still locked after 0 seconds.".format(self.db)])
+
+    def test_assemble_shards(self):
+        a, b = os.path.join(self.tmp, "A.db"), os.path.join(self.tmp, "B.db")
+        self.assertEqual(sql_lib.writeShard(a, "TEXT", [("x", "1"), ("y", "2")]), 2)
+        sql_lib.writeShard(b, "TEXT", iter([("z", "3")]))
+        self.assertEqual(sql_lib.readShard(b), {"z": "3"})
+        shards = [["A", a], ["B", b], ["C", os.path.join(self.tmp, "missing.db")]]
+        connection = sql_lib.ExclusiveSqlConnection(self.db, shards=shards)
+        with connection as cur:
+            self.assertEqual(connection.shardColumns, ["A", "B"])
+            self.assertEqual(sql_lib.assembleShards(cur, "G", "AlignmentID", connection.shardColumns), 3)
+        con = sql.connect(self.db)
+        self.assertEqual(sorted(con.execute("SELECT AlignmentID, A, B FROM G").fetchall()),
+                [("x", "1", None), ("y", "2", None), ("z", None, "3")])
+        #columns and rows a shard does not cover are left untouched
+        with sql_lib.ExclusiveSqlConnection(self.db, shards=[["B", a]]) as cur:
+            self.assertEqual(sql_lib.assembleShards(cur, "G", "AlignmentID", ["B"]), 2)
+        self.assertEqual(sorted(con.execute("SELECT AlignmentID, A, B FROM G").fetchall()),
+                [("x", "1", "1"), ("y", "2", "2"), ("z", None, "3")])
+
+
+
+##############################################################################
+##############################################################################
+#
+#The classes below test the scripts in src, which need jobTree
+#
+##############################################################################
+##############################################################################
+
+@unittest.skipIf(endStop is None, "the scripts need jobTree")
+class ExportColumnsTests(unittest.TestCase):
+    """
+    Tests that export_columns round trips a <genome>_view through the npz and manifest.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('export_columns')
+        self.addCleanup(removeDir, self.tmp)
+        self.db = os.path.join(self.tmp, "results.db")
+        self.rows = [("a-0", "chr1", 0.5, 3, None), ("b-0", None, None, None, 1), ("c-0", "chr2", 1.0, -2, 0),
+                ("d-0", "chr1", float("nan"), 7, 1), ("e-1", u"chr\xe9", 0.25, 0, None),
+                ("f-1", "chr1", 2.5, 10 ** 12, 0)]
+        con = sql.connect(self.db)
+        with con:
+            con.execute("""CREATE TABLE G (AlignmentID TEXT PRIMARY KEY, Chrom TEXT, Score REAL,
+                    Count INTEGER, Flag)""")
+            con.executemany("INSERT INTO G VALUES (?, ?, ?, ?, ?)", self.rows)
+            con.execute("CREATE VIEW g1_view AS SELECT * FROM G")
+        self.expected = con.execute("SELECT * FROM G").fetchall()
+        con.close()
+
+    def load(self, exportDir, genome):
+        """ Rebuilds the rows of a genome from the export as lists of python values.
+        """
+        with open(os.path.join(exportDir, "manifest.json")) as f:
+            manifest = json.load(f)
+        entry = manifest["genomes"][genome]
+        archive = np.load(os.path.join(exportDir, entry["file"]))
+        columns = []
+        for c in entry["columns"]:
+            values, mask = archive[c["name"]], archive[c["name"] + ".mask"]
+            self.assertEqual(c["nulls"], int(mask.sum()))
+            if c["encoding"] == "dictionary":
+                labels = [x.decode("utf-8") for x in archive[c["name"] + ".categories"]]
+                values = [labels[x] for x in values]
+            elif c["type"] == "TEXT":
+                values = [x.decode("utf-8") for x in values]
+            else:
+                values = values.tolist()
+            columns.append([None if m else v for v, m in zip(values, mask)])
+        return entry, zip(*columns)
+
+    def test_round_trip(self):
+        exportDir = os.path.join(self.tmp, "export")
+        manifest = exportColumns.export_database(self.db, exportDir, chunkSize=4, maxCategories=3)
+        self.assertEqual(manifest["genomes"].keys(), ["g1"])
+        entry, rows = self.load(exportDir, "g1")
+        self.assertEqual(entry["rows"], 6)
+        #the nan REAL comes back as NULL, like a NULL
+        expected = [tuple(None if isinstance(v, float) and math.isnan(v) else v for v in r) for r in self.expected]
+        self.assertEqual(rows, expected)
+        encodings = dict((c["name"], (c["encoding"], c["dtype"])) for c in entry["columns"])
+        self.assertEqual(encodings, {"AlignmentID": ("plain", "string24"), "Chrom": ("dictionary", "int32"),
+                "Score": ("plain", "float64"), "Count": ("plain", "int64"), "Flag": ("plain", "int64")})
+        #with fewer categories allowed Chrom falls back to plain strings
+        exportColumns.export_database(self.db, exportDir, ["g1"], chunkSize=1, maxCategories=2)
+        entry, rows = self.load(exportDir, "g1")
+        self.assertEqual(dict((c["name"], c["encoding"]) for c in entry["columns"])["Chrom"], "plain")
+        self.assertEqual([r[1] for r in rows], [r[1] for r in expected])
+
+
+@unittest.skipIf(endStop is None, "the scripts need jobTree")
+class ClassifierRunnerTests(unittest.TestCase):
+    """
+    Tests that ClassifierRunner loads the inputs of a genome once and hands the same
+    objects to every classifier.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('classifier_runner')
+        self.addCleanup(removeDir, self.tmp)
+        r = random.Random(13)
+        self.twoBit = createTwoBitFile([('chr1', ''.join(r.choice('ACGT') for i in xrange(300)))], self.tmp)
+        self.bed = createBedFile([bedLine('chr1', 10, 200, 'T1', 0, '+', 30, 170, '0', 3, '30,40,40',
+                '0,70,150')], 'test.bed', self.tmp)
+        self.psl = createAlignmentFile([simplePsl('+', 110, 0, 110, 300, 10, 200, [30, 40, 40], [0, 30, 70],
+                [10, 80, 160], qName='T1-0', tName='chr1')], self.tmp)
+        self.attributes = os.path.join(self.tmp, "attrs.tsv")
+        with open(self.attributes, 'w') as f:
+            f.write('geneId\tgeneName\tgeneType\tgeneStatus\ttranscriptId\ttranscriptName\t'
+                    'transcriptType\ttranscriptStatus\thavanaGeneId\thavanaTranscriptId\tccdsId\t'
+                    'level\ttranscriptClass\n')
+            f.write('G1\tgene1\tprotein_coding\tKNOWN\tT1\tname1\tprotein_coding\tKNOWN\tH1\tHT1\t\t2\tcoding\n')
+        #count every read of a input file made through the loaders the classifiers use
+        self.reads = defaultdict(int)
+        for module, name in ((abstractClassifier.cache_lib, "readPsl"),
+                (abstractClassifier.cache_lib, "getTranscripts"),
+                (abstractClassifier.cache_lib, "getTranscriptAttributeDict"),
+                (abstractClassifier.seq_lib, "readTwoBit"), (abstractClassifier.psl_lib, "readPslTable"),
+                (abstractClassifier.psl_lib, "readPslNames")):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, self.counted(name, getattr(module, name)))
+
+    def counted(self, name, f):
+        def wrapper(*args, **kwargs):
+            self.reads[name] += 1
+            return f(*args, **kwargs)
+        return wrapper
+
+    def test_shared_inputs(self):
+        seen = []
+
+        class First(abstractClassifier.AbstractClassifier):
+            def run(self):
+                self.get_alignment_table()
+                self.get_original_transcript_dict()
+                self.get_transcript_attributes()
+                seen.append(self)
+
+        class Second(First):
+            pass
+
+        runner = classifierRunner.ClassifierRunner([First, Second], "g1", self.psl, self.twoBit, self.bed,
+                self.attributes, self.bed, self.tmp, "ref", "AlignmentID")
+        runner.run()
+        self.assertEqual([type(c) for c in seen], [First, Second])
+        for name in ['alignments', 'alignment_dict', 'alignment_table', 'transcript_dict',
+                'original_transcript_dict', 'seq_dict', 'splice_sites', 'attribute_dict']:
+            self.assertIs(getattr(seen[0], name), getattr(runner, name))
+            self.assertIs(getattr(seen[1], name), getattr(runner, name))
+        self.assertEqual(runner.alignment_dict.keys(), ['T1-0'])
+        self.assertEqual(runner.attribute_dict.keys(), ['T1'])
+        #the PSL, both BEDs and the 2bit are read once by the runner, the attribute map once by the first classifier
+        self.assertEqual(dict(self.reads), {"readPsl": 1, "getTranscripts": 2, "readTwoBit": 1,
+                "getTranscriptAttributeDict": 1})
+        runner.seq_dict.close()
+
+
+
+@unittest.skipIf(endStop is None, "the scripts need jobTree")
+class LoadAttributesTests(unittest.TestCase):
+    """
+    Tests that load_attributes fills the attributes table of the merged database and that
+    the <genome>_view made by merge_genome exposes the gene columns, in every merge mode.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('load_attributes')
+        self.addCleanup(removeDir, self.tmp)
+        self.attributes = os.path.join(self.tmp, "attrs.tsv")
+        with open(self.attributes, 'w') as f:
+            f.write('geneId\tgeneName\tgeneType\tgeneStatus\ttranscriptId\ttranscriptName\t'
+                    'transcriptType\ttranscriptStatus\thavanaGeneId\thavanaTranscriptId\tccdsId\t'
+                    'level\ttranscriptClass\n')
+            for i in xrange(3):
+                f.write('G{0}\tgene{0}\tprotein_coding\tKNOWN\tT{0}\tname{0}\tnonsense_mediated_decay\t'
+                        'KNOWN\tH{0}\tHT{0}\t\t2\tcoding\n'.format(i))
+        pipeline.initialize_sql_columns("g1", self.tmp, "AlignmentID")
+        con = sql.connect(os.path.join(self.tmp, "g1.db"))
+        with con:
+            con.executemany("INSERT INTO g1 (AlignmentID, TranscriptID, EndStop) VALUES (?, ?, ?)",
+                    [("T0-0", "T0", 1), ("T2-0", "T2", 0), ("T2-1", "T2", None), ("X-0", "X", 1)])
+        con.close()
+
+    def test_load_attributes(self):
+        for compact, packFlags in ((False, False), (True, False), (False, True), (True, True)):
+            mergedDb = os.path.join(self.tmp, "merged.db")
+            if os.path.exists(mergedDb):
+                os.remove(mergedDb)
+            pipeline.load_attributes(self.attributes, mergedDb)
+            #loading again replaces the table
+            pipeline.load_attributes(self.attributes, mergedDb)
+            pipeline.merge_genome(os.path.join(self.tmp, "g1.db"), mergedDb, "g1", "AlignmentID", compact,
+                    packFlags)
+            con = sql.connect(mergedDb)
+            self.assertEqual(con.execute("SELECT * FROM attributes ORDER BY TranscriptID").fetchall(),
+                    [("T{}".format(i), "G{}".format(i), "gene{}".format(i), "protein_coding",
+                    "nonsense_mediated_decay") for i in xrange(3)])
+            columns = [x[1] for x in con.execute("PRAGMA table_info(g1_view)")]
+            self.assertEqual(columns[-4:], ["GeneID", "GeneName", "GeneType", "TranscriptType"])
+            self.assertIn("EndStop", columns)
+            self.assertEqual(con.execute("""SELECT AlignmentID, EndStop, GeneID, GeneName, GeneType,
+                    TranscriptType FROM g1_view ORDER BY AlignmentID""").fetchall(),
+                    [("T0-0", 1, "G0", "gene0", "protein_coding", "nonsense_mediated_decay"),
+                    ("T2-0", 0, "G2", "gene2", "protein_coding", "nonsense_mediated_decay"),
+                    ("T2-1", None if not packFlags else 0, "G2", "gene2", "protein_coding",
+                    "nonsense_mediated_decay"), ("X-0", 1, None, None, None, None)])
+            con.close()
+
+
+
+@unittest.skipIf(endStop is None, "the scripts need jobTree")
+class MigrateTypesTests(unittest.TestCase):
+    """
+    Runs src/migrate_types.py on databases written by the old str(value) write path.
+    """
+
+    def setUp(self):
+        self.tmp = makeTempDir('migrate_types')
+        self.addCleanup(removeDir, self.tmp)
+        self.dbs = [os.path.join(self.tmp, "results.db"), os.path.join(self.tmp, "g1.db")]
+        for db in self.dbs:
+            con = sql.connect(db)
+            with con:
+                con.execute("CREATE TABLE g1 (AlignmentID TEXT PRIMARY KEY, N INTEGER, R REAL, T TEXT)")
+                con.executemany("INSERT INTO g1 VALUES (?, CAST(? AS TEXT), CAST(? AS TEXT), ?)",
+                        [("x", "3", "0.5", "None"), ("y", "None", "nan", ""), ("z", "", "1e3", "chr1")])
+                #leave free pages behind for --vacuum to reclaim
+                con.execute("CREATE TABLE junk (x TEXT)")
+                con.executemany("INSERT INTO junk VALUES (?)", (("x" * 1000,) for i in xrange(200)))
+                con.execute("DELETE FROM junk")
+            con.close()
+        self.script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src",
+                "migrate_types.py")
+        self.env = dict(os.environ, PYTHONPATH=os.pathsep.join(os.path.abspath(x) for x in sys.path))
+
+    def run_script(self, args):
+        return subprocess.check_output([sys.executable, self.script] + args, env=self.env,
+                stderr=subprocess.STDOUT)
+
+    def test_help(self):
+        self.assertIn("empty strings become NULL in INTEGER and REAL columns only",
+                " ".join(self.run_script(["--help"]).split()))
+
+    def test_migrate(self):
+        output = self.run_script(self.dbs[:1])
+        self.assertIn("{}: converted 4 values in g1".format(self.dbs[0]), output)
+        self.assertNotIn("Vacuumed", output)
+        output = self.run_script(self.dbs + ["--vacuum"])
+        self.assertIn("{}: converted 0 values in g1".format(self.dbs[0]), output)
+        self.assertIn("{}: converted 4 values in g1".format(self.dbs[1]), output)
+        for db in self.dbs:
+            self.assertIn("Vacuumed {}".format(db), output)
+            con = sql.connect(db)
+            self.assertEqual(con.execute("SELECT N, R, T, typeof(N), typeof(R) FROM g1 ORDER BY AlignmentID")
+                    .fetchall(), [(3, 0.5, None, "integer", "real"), (None, None, "", "null", "null"),
+                    (None, 1000.0, "chr1", "null", "real")])
+            self.assertEqual(con.execute("PRAGMA freelist_count").fetchone()[0], 0)
+            con.close()
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
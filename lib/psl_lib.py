@@ -6,7 +6,17 @@ Modified by Ian Fiddes
 """
 
 
+import os
+import re
+import gc
+import marshal
 from collections import defaultdict, Counter
+from itertools import izip
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from lib.compression_lib import openInput, BgzfReader
 
 class PslRow(object):
     """ Represents a single row in a PSL file.
@@ -58,18 +68,15 @@ class PslRow(object):
         if p >= self.tEnd: return None
         if self.strand not in ['+', '-']:
             raise RuntimeError('Unanticipated strand: %s' % self.strand)
-        for i, t in enumerate(self.tStarts):
-            if p < t:
-                continue
-            if p >= t + self.blockSizes[i]:
-                continue
-            # p must be in block
-            offset = p - t
-            if self.strand == '+':
-                return self.qStarts[i] + offset
-            else:
-                return self.qSize - (self.qStarts[i] + offset) - 1
-        return None
+        #blocks are sorted and do not overlap, so p can only be in the last block starting at or before it
+        i = bisect_right(self.tStarts, p) - 1
+        if i < 0 or p >= self.tStarts[i] + self.blockSizes[i]:
+            return None
+        offset = p - self.tStarts[i]
+        if self.strand == '+':
+            return self.qStarts[i] + offset
+        else:
+            return self.qSize - (self.qStarts[i] + offset) - 1
 
     def queryCoordinateToTarget(self, p):
         """ Take position P in query coordinates (positive) and convert it
@@ -85,15 +92,39 @@ class PslRow(object):
             raise RuntimeError('Unanticipated strand: %s' % self.strand)
         if p < self.qStart: return None
         if p >= self.qEnd: return None
-        for i, q in enumerate(self.qStarts):
-            if p < q:
-                continue
-            if p >= q + self.blockSizes[i]:
-                continue
-            # p must be in block
-            offset = p - q
-            return self.tStarts[i] + offset
-        return None
+        i = bisect_right(self.qStarts, p) - 1
+        if i < 0 or p >= self.qStarts[i] + self.blockSizes[i]:
+            return None
+        return self.tStarts[i] + p - self.qStarts[i]
+
+    def targetCoordinatesToQuery(self, positions):
+        """ Batch version of targetCoordinateToQuery. Takes a sorted list of target
+        positions and returns a list of query positions, with None for the positions
+        that do not map. Walks the blocks once instead of searching for each position.
+        """
+        if self.strand not in ['+', '-']:
+            raise RuntimeError('Unanticipated strand: %s' % self.strand)
+        result = mapSortedPositions(positions, self.tStarts, self.blockSizes, self.qStarts, self.tStart,
+                self.tEnd)
+        if self.strand == '-':
+            result = [None if x is None else self.qSize - x - 1 for x in result]
+        return result
+
+    def queryCoordinatesToTarget(self, positions):
+        """ Batch version of queryCoordinateToTarget. Takes a sorted list of query
+        positions and returns a list of target positions, with None for the positions
+        that do not map.
+        """
+        if self.strand == '+':
+            return mapSortedPositions(positions, self.qStarts, self.blockSizes, self.tStarts, self.qStart,
+                    self.qEnd)
+        elif self.strand == '-':
+            #on the negative strand descending positive positions are ascending in qStarts
+            positions = [self.qSize - p - 1 for p in reversed(positions)]
+            return mapSortedPositions(positions, self.qStarts, self.blockSizes, self.tStarts, self.qStart,
+                    self.qEnd)[::-1]
+        else:
+            raise RuntimeError('Unanticipated strand: %s' % self.strand)
 
     def pslString(self):
         """ return SELF as a psl formatted line.
@@ -124,16 +155,671 @@ class PslRow(object):
         return s
 
 
-def readPsl(infile, uniqify=False):
-    """ read a PSL file and return a list of PslRow objects
+def mapSortedPositions(positions, starts, blockSizes, destStarts, start, stop):
+    """ Maps a ascending list of positions through the blocks <starts>/<blockSizes> onto
+    <destStarts> in one merge-walk over positions and blocks. Positions outside every
+    block or outside [start, stop) map to None.
+    """
+    result = []
+    i, n = 0, len(starts)
+    last = None
+    for p in positions:
+        if last is not None and p < last:
+            raise RuntimeError("Positions are not sorted: {} after {}".format(p, last))
+        last = p
+        while i < n and p >= starts[i] + blockSizes[i]:
+            i += 1
+        if start <= p < stop and i < n and p >= starts[i]:
+            result.append(destStarts[i] + p - starts[i])
+        else:
+            result.append(None)
+    return result
+
+
+#integer columns of a PSL, in file order. strand, qName and tName are the text columns.
+psl_int_columns = ('matches', 'misMatches', 'repMatches', 'nCount', 'qNumInsert', 'qBaseInsert',
+        'tNumInsert', 'tBaseInsert', 'qSize', 'qStart', 'qEnd', 'tSize', 'tStart', 'tEnd',
+        'blockCount')
+#field number of each column in a PSL line
+psl_int_fields = (0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 12, 14, 15, 16, 17)
+psl_block_fields = (('blockSizes', 18), ('qStarts', 19), ('tStarts', 20))
+#bytes read at a time by the bulk parser
+psl_chunk_size = 1 << 22
+#extension of the qName offset index stored next to a PSL file
+psl_index_extension = ".qidx"
+#extension of the target interval index stored next to a PSL file
+psl_interval_index_extension = ".tidx"
+#UCSC bin scheme: first bin of each level from the smallest (128kb) to the largest (512Mb)
+#bins, with the shift taking a position to its bin at each level
+bin_offsets = (512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0)
+bin_shifts = (17, 20, 23, 26, 29)
+
+
+class PslTable(object):
+    """ Column store of a whole PSL file. Each scalar column is a typed numpy array
+    of length len(table). The three block columns are flat concatenated arrays with an
+    offsets array, so the blocks for row i are blockSizes[offsets[i]:offsets[i+1]].
+    tName is dictionary encoded as tNameCodes into the list tNames.
+
+    Indexing a PslTable returns a PslTableRow, a light view that behaves like a PslRow.
+    """
+    def __init__(self, columns, strand, qName, tNameCodes, tNames, blockSizes, qStarts, tStarts,
+                offsets):
+        for name in psl_int_columns:
+            setattr(self, name, columns[name])
+        self.strand = strand
+        self.qName = qName
+        self.tNameCodes = tNameCodes
+        self.tNames = tNames
+        self.blockSizes = blockSizes
+        self.qStarts = qStarts
+        self.tStarts = tStarts
+        self.offsets = offsets
+
+    @classmethod
+    def fromColumns(cls, chunks):
+        """ Builds a PslTable from a iterable of column dicts made by parsePslLines.
+        """
+        columns = dict((name, []) for name in psl_int_columns)
+        strand, qName, tNameCodes, tNames, tNameIndex = [], [], [], [], {}
+        blocks = dict((name, []) for name, field in psl_block_fields)
+        for c in chunks:
+            for name in psl_int_columns:
+                columns[name].append(c[name])
+            strand.extend(c['strand'])
+            qName.extend(c['qName'])
+            tNameCodes.extend(tNameIndex.setdefault(x, len(tNameIndex)) for x in c['tName'])
+            for name, field in psl_block_fields:
+                blocks[name].append(c[name])
+        tNames = sorted(tNameIndex, key=tNameIndex.get)
+        for name in psl_int_columns:
+            columns[name] = np.concatenate(columns[name] or [[]]).astype(np.int32)
+        for name, field in psl_block_fields:
+            blocks[name] = np.concatenate(blocks[name] or [[]]).astype(np.int32)
+        offsets = np.zeros(len(qName) + 1, dtype=np.int64)
+        np.cumsum(columns['blockCount'], out=offsets[1:])
+        return cls(columns, np.array(strand, dtype=str), np.array(qName, dtype=str),
+                np.array(tNameCodes, dtype=np.int32), tNames, blocks['blockSizes'], blocks['qStarts'],
+                blocks['tStarts'], offsets)
+
+    @classmethod
+    def fromRows(cls, alignments):
+        """ Builds a PslTable from a iterable of PslRow objects. The rows are not kept.
+        """
+        columns = dict((name, []) for name in psl_int_columns)
+        strand, qName, tNameCodes, tNames, tNameIndex = [], [], [], [], {}
+        blockSizes, qStarts, tStarts, blockCounts = [], [], [], []
+        for a in alignments:
+            for name in psl_int_columns:
+                columns[name].append(getattr(a, name))
+            strand.append(a.strand)
+            qName.append(a.qName)
+            if a.tName not in tNameIndex:
+                tNameIndex[a.tName] = len(tNames)
+                tNames.append(a.tName)
+            tNameCodes.append(tNameIndex[a.tName])
+            blockSizes.extend(a.blockSizes)
+            qStarts.extend(a.qStarts)
+            tStarts.extend(a.tStarts)
+            blockCounts.append(len(a.blockSizes))
+        offsets = np.zeros(len(blockCounts) + 1, dtype=np.int64)
+        np.cumsum(blockCounts, out=offsets[1:])
+        for name in psl_int_columns:
+            columns[name] = np.array(columns[name], dtype=np.int32)
+        return cls(columns, np.array(strand, dtype=str), np.array(qName, dtype=str),
+                np.array(tNameCodes, dtype=np.int32), tNames, np.array(blockSizes, dtype=np.int32),
+                np.array(qStarts, dtype=np.int32), np.array(tStarts, dtype=np.int32), offsets)
+
+    def __len__(self):
+        return len(self.qName)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("PslTable index out of range")
+        return PslTableRow(self, i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield PslTableRow(self, i)
+
+    @property
+    def tName(self):
+        """ tName column decoded to a array of strings.
+        """
+        return np.array(self.tNames, dtype=str)[self.tNameCodes]
+
+    def nbytes(self):
+        """ Total size of the arrays held by this table.
+        """
+        arrays = [getattr(self, name) for name in psl_int_columns]
+        arrays += [self.strand, self.qName, self.tNameCodes, self.blockSizes, self.qStarts,
+                self.tStarts, self.offsets]
+        return sum(x.nbytes for x in arrays)
+
+    def hasDuplicates(self):
+        """ Does any qName appear more than once?
+        """
+        return len(np.unique(self.qName)) != len(self)
+
+    def toRows(self):
+        """ Returns a list of PslRow objects holding the same alignments.
+        """
+        return [PslRow(r.pslString()) for r in self]
+
+
+def _tableColumn(name):
+    """ Builds a property that reads integer column <name> of the table behind a PslTableRow.
+    """
+    def get(self):
+        return int(getattr(self.table, name)[self.i])
+    return property(get)
+
+
+def _tableBlocks(name):
+    """ Builds a property that returns a view of block column <name> for a PslTableRow.
+    """
+    def get(self):
+        offsets = self.table.offsets
+        return getattr(self.table, name)[offsets[self.i]:offsets[self.i + 1]]
+    return property(get)
+
+
+class PslTableRow(object):
+    """ View of one row of a PslTable. Has the same attributes and methods as a PslRow,
+    but the values are read from the table when accessed, and the block lists are numpy
+    views into the table rather than copies.
+    """
+    __slots__ = ('table', 'i')
+
+    def __init__(self, table, i):
+        self.table = table
+        self.i = i
+
+    blockSizes = _tableBlocks('blockSizes')
+    qStarts = _tableBlocks('qStarts')
+    tStarts = _tableBlocks('tStarts')
+
+    @property
+    def strand(self):
+        return str(self.table.strand[self.i])
+
+    @property
+    def qName(self):
+        return str(self.table.qName[self.i])
+
+    @property
+    def tName(self):
+        return self.table.tNames[self.table.tNameCodes[self.i]]
+
+    #share the PslRow methods, they only use attribute access
+    hashkey = PslRow.__dict__['hashkey']
+    targetCoordinateToQuery = PslRow.__dict__['targetCoordinateToQuery']
+    queryCoordinateToTarget = PslRow.__dict__['queryCoordinateToTarget']
+    targetCoordinatesToQuery = PslRow.__dict__['targetCoordinatesToQuery']
+    queryCoordinatesToTarget = PslRow.__dict__['queryCoordinatesToTarget']
+    pslString = PslRow.__dict__['pslString']
+
+for _name in psl_int_columns:
+    setattr(PslTableRow, _name, _tableColumn(_name))
+
+
+def pslLineChunks(infile, chunkSize=psl_chunk_size):
+    """ Reads a open PSL file <chunkSize> bytes at a time and yields lists of the
+    alignment lines in each chunk. Blank lines, psLayout headers and any other line that
+    does not start with a digit are skipped.
+    """
+    rest = ''
+    while True:
+        block = infile.read(chunkSize)
+        if block == '':
+            break
+        lines = (rest + block).split('\n')
+        rest = lines.pop()
+        yield [l.rstrip() for l in lines if l[:1].isdigit()]
+    if rest[:1].isdigit():
+        yield [rest.rstrip()]
+
+
+#integers separated by a single space or comma. Only used for columns holding a minus
+#sign, a digits and separators check followed by a length check is enough for the rest
+_int_column_re = {' ': re.compile(r'-?\d+( -?\d+)*\Z'), ',': re.compile(r'-?\d+(,-?\d+)*\Z')}
+
+
+def _intColumn(values, sep=' '):
+    """ Converts a sequence of numeric strings to a int64 array with one numpy call.
+    Returns None if any value holds anything but digits and a leading minus sign:
+    np.fromstring does not raise on those, it stops at or misreads values like 1e2.
+    It also skips empty values, so callers must check the length of the result.
+    """
+    s = sep.join(values)
+    if s.translate(None, '0123456789' + sep) != '':
+        if '-' not in s or _int_column_re[sep].match(s) is None:
+            return None
+    return np.fromstring(s, dtype=np.int64, sep=sep)
+
+
+def _blockCounts(values):
+    """ Returns the number of entries in each comma separated block list, assuming the
+    only empty entry is a trailing comma. Lists breaking that assumption get a count that
+    does not match their blockCount. Counted on the bytes of the joined lists with numpy.
+    """
+    b = np.frombuffer(';'.join(values) + ';', dtype=np.uint8)
+    ends = np.flatnonzero(b == ord(';'))
+    commas = np.diff(np.concatenate(([0], np.cumsum(b == ord(','))[ends])))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    return commas + ((ends > starts) & (b[ends - 1] != ord(',')))
+
+
+def _splitPslLines(lines):
+    """ Splits a list of PSL lines into one flat list of 21 fields per line.
+    """
+    if len(lines) > 0 and all(l.count('\t') == 20 for l in lines):
+        return '\t'.join(lines).split('\t')
+    #not strictly tab separated, split each line on any whitespace instead
+    fields = []
+    for l in lines:
+        data = l.split()
+        if len(data) != 21:
+            raise RuntimeError("PSL line does not have 21 fields: {}".format(l))
+        fields.extend(data)
+    return fields
+
+
+def _parsePslFieldsBulk(fields, n):
+    """ Converts the fields of <n> PSL lines to columns with one numpy call per column.
+    Returns None if any column does not parse to the expected number of values.
+    """
+    c = {}
+    for name, field in izip(psl_int_columns, psl_int_fields):
+        c[name] = _intColumn(fields[field::21])
+        if c[name] is None or len(c[name]) != n:
+            return None
+    c['strand'] = fields[8::21]
+    c['qName'] = fields[9::21]
+    c['tName'] = fields[13::21]
+    for name, field in psl_block_fields:
+        values = fields[field::21]
+        if not np.array_equal(_blockCounts(values), c['blockCount']):
+            return None
+        #block lists usually end with a comma, drop the resulting empty entries. Any other
+        #empty entry is left in and fails the length check below
+        blocks = ','.join(values).replace(',,', ',').rstrip(',')
+        c[name] = _intColumn([blocks], ',') if blocks != '' else np.zeros(0, dtype=np.int64)
+        if c[name] is None or len(c[name]) != c['blockCount'].sum():
+            return None
+    return c
+
+
+def _parsePslFieldsStrictly(fields, n):
+    """ Converts the fields of <n> PSL lines to columns one int() at a time, like PslRow.
+    Raises ValueError on the first field that is not a integer.
+    """
+    c = {}
+    for name, field in izip(psl_int_columns, psl_int_fields):
+        c[name] = np.array([int(x) for x in fields[field::21]], dtype=np.int64)
+    c['strand'] = fields[8::21]
+    c['qName'] = fields[9::21]
+    c['tName'] = fields[13::21]
+    for name, field in psl_block_fields:
+        blocks = [[int(x) for x in v.split(',') if x] for v in fields[field::21]]
+        for b, count, qName in izip(blocks, c['blockCount'], c['qName']):
+            if len(b) != count:
+                raise RuntimeError("{} of {} do not match blockCount".format(name, qName))
+        c[name] = np.array([x for b in blocks for x in b], dtype=np.int64)
+    return c
+
+
+def parsePslLines(lines):
+    """ Parses a list of PSL lines in bulk. Returns a dict mapping each PslRow attribute
+    to a column: int64 arrays for the integer columns, lists for strand, qName and tName
+    and flat int64 arrays holding the concatenated blocks of every row.
+    Chunks the bulk conversion can not validate are parsed again field by field, so a
+    malformed line raises instead of shifting the columns.
+    """
+    n = len(lines)
+    fields = _splitPslLines(lines)
+    c = _parsePslFieldsBulk(fields, n)
+    if c is None:
+        c = _parsePslFieldsStrictly(fields, n)
+    return c
+
+
+def pslRowsFromColumns(c):
+    """ Builds PslRow objects from the output of parsePslLines without parsing them again.
+    """
+    rows = []
+    new = PslRow.__new__
+    ints = izip(*[c[name].tolist() for name in psl_int_columns])
+    blockSizes, qStarts, tStarts = [c[name].tolist() for name, field in psl_block_fields]
+    start = 0
+    for v, strand, qName, tName in izip(ints, c['strand'], c['qName'], c['tName']):
+        a = new(PslRow)
+        (a.matches, a.misMatches, a.repMatches, a.nCount, a.qNumInsert, a.qBaseInsert,
+                a.tNumInsert, a.tBaseInsert, a.qSize, a.qStart, a.qEnd, a.tSize, a.tStart,
+                a.tEnd, a.blockCount) = v
+        a.strand, a.qName, a.tName = strand, qName, tName
+        stop = start + a.blockCount
+        a.blockSizes, a.qStarts, a.tStarts = blockSizes[start:stop], qStarts[start:stop], tStarts[start:stop]
+        start = stop
+        rows.append(a)
+    return rows
+
+
+def pslBulkIterator(infile, chunkSize=psl_chunk_size):
+    """ Faster version of pslIterator. Reads the open PSL file in large chunks, converts
+    each numeric column of a chunk in bulk and yields PslRow objects. Unlike pslIterator
+    it skips blank lines and headers instead of stopping at them.
     """
-    psls = []
-    with open(infile, 'r') as f:
-        for psl in pslIterator(f, uniqify):
-            psls.append(psl)
+    for lines in pslLineChunks(infile, chunkSize):
+        for r in pslRowsFromColumns(parsePslLines(lines)):
+            yield r
+
+
+def readPslTable(infile, threads=1):
+    """ read a PSL file, which may be gzip or BGZF compressed, and return a PslTable.
+    BGZF files are decompressed with <threads> threads.
+    """
+    with openInput(infile, threads) as f:
+        return PslTable.fromColumns(parsePslLines(lines) for lines in pslLineChunks(f))
+
+
+def readPsl(infile, uniqify=False, threads=1):
+    """ read a PSL file, which may be gzip or BGZF compressed, and return a list of
+    PslRow objects. BGZF files are decompressed with <threads> threads.
+    """
+    #the rows hold no reference cycles, so the cyclic garbage collector is paused while
+    #building them; otherwise it repeatedly rescans every row already read
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        with openInput(infile, threads) as f:
+            psls = list(pslBulkIterator(f))
+    finally:
+        if gcEnabled:
+            gc.enable()
+    if uniqify is True:
+        names = Counter()
+        for r in psls:
+            name = r.qName
+            uniqifyPslRow(r, names[name])
+            names[removeAlignmentNumber(name)] += 1
     return psls
 
 
+def pslIndexPath(infile):
+    """ Returns the path of the qName offset index of a PSL file.
+    """
+    return infile + psl_index_extension
+
+
+def pslFileKey(infile):
+    """ Returns the (size, mtime) pair a index is checked against.
+    """
+    st = os.stat(infile)
+    return st.st_size, st.st_mtime
+
+
+def _pslLineName(line):
+    """ Returns the qName of a PSL line without parsing the rest of it.
+    """
+    data = line.split('\t', 10)
+    if len(data) != 11:
+        data = line.split()
+    if len(data) < 11:
+        raise RuntimeError("PSL line does not have 21 fields: {}".format(line))
+    return data[9]
+
+
+def readPslNames(infile):
+    """ Returns the qName of every alignment in a PSL file, which may be gzip or BGZF
+    compressed, in file order. Only the qName field of each line is split out.
+    """
+    with openInput(infile) as f:
+        return [_pslLineName(l) for lines in pslLineChunks(f) for l in lines]
+
+
+def buildPslIndex(infile, chunkSize=psl_chunk_size):
+    """ Scans a PSL file once and returns its qName offset index: a sorted list of qNames
+    and a parallel list holding the byte offset of each line, so that a name is found
+    by bisection. Lines skipped by the bulk parser are skipped here too.
+    For a BGZF compressed PSL the offsets are BGZF virtual offsets. Plain gzip files
+    can not be seeked into, so they can not be indexed.
+    """
+    names, offsets = [], []
+    offset = 0
+    rest = ''
+    with openInput(infile) as f:
+        if not isinstance(f, (file, BgzfReader)):
+            raise RuntimeError("{} is gzip compressed, random access needs a plain or BGZF "
+                    "file".format(infile))
+        while True:
+            block = f.read(chunkSize)
+            if block == '':
+                break
+            lines = (rest + block).split('\n')
+            rest = lines.pop()
+            for l in lines:
+                if l[:1].isdigit():
+                    names.append(_pslLineName(l))
+                    offsets.append(offset)
+                offset += len(l) + 1
+        if rest[:1].isdigit():
+            names.append(_pslLineName(rest))
+            offsets.append(offset)
+        if isinstance(f, BgzfReader):
+            offsets = [f.virtualOffset(x) for x in offsets]
+    #sorted is stable, so the lines of a repeated name stay in file order
+    order = sorted(xrange(len(names)), key=names.__getitem__)
+    return [names[i] for i in order], [offsets[i] for i in order]
+
+
+def _readSidecar(path, key):
+    """ Returns the contents of a index file stored next to a PSL file, or None if there
+    is none or if it was built from a different version of the file.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        try:
+            if marshal.load(f) == key:
+                return marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            pass
+    return None
+
+
+def _writeSidecar(path, key, contents):
+    """ Stores a index file next to a PSL file. The index is written to a temporary file
+    and renamed so that concurrent jobs never see a partial index.
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            marshal.dump(key, f)
+            marshal.dump(contents, f)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def writePslIndex(infile, index, key):
+    """ Stores a index built by buildPslIndex next to <infile>.
+    """
+    _writeSidecar(pslIndexPath(infile), key, index)
+
+
+def loadPslIndex(infile):
+    """ Returns the qName offset index of a PSL file. The index stored next to the file is
+    used if its size and mtime still match, otherwise it is rebuilt and stored again.
+    If the directory is not writable the rebuilt index is only kept in memory.
+    Two flat lists are stored rather than a dict so that loading the index stays cheap.
+    """
+    key = pslFileKey(infile)
+    index = _readSidecar(pslIndexPath(infile), key)
+    if index is not None:
+        return index
+    index = buildPslIndex(infile)
+    try:
+        writePslIndex(infile, index, key)
+    except (IOError, OSError):
+        pass
+    return index
+
+
+def getPslRows(infile, names, index=None):
+    """ Returns the PslRow objects of every alignment whose qName is in <names>, in file
+    order, parsing only those lines. Names not in the file are ignored. <index> is a index
+    from loadPslIndex, loaded if not given.
+    """
+    if index is None:
+        index = loadPslIndex(infile)
+    indexNames, indexOffsets = index
+    offsets = set()
+    for name in names:
+        i = bisect_left(indexNames, name)
+        while i < len(indexNames) and indexNames[i] == name:
+            offsets.add(indexOffsets[i])
+            i += 1
+    with openInput(infile) as f:
+        lines = []
+        for offset in sorted(offsets):
+            f.seek(offset)
+            lines.append(f.readline().rstrip())
+    if len(lines) == 0:
+        return []
+    return pslRowsFromColumns(parsePslLines(lines))
+
+
+def getPslRowsByName(infile, name, index=None):
+    """ Returns the PslRow objects of every alignment of <name>.
+    """
+    return getPslRows(infile, [name], index)
+
+
+def binFromRanges(starts, ends):
+    """ Returns the smallest UCSC bin holding each [start, end) range, for arrays of
+    starts and ends. Ranges ending past 512Mb do not fit the bin scheme.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.maximum(np.asarray(ends, dtype=np.int64), starts + 1)
+    if len(ends) > 0 and ends.max() > 1 << 29:
+        raise RuntimeError("Alignment ends past the 512Mb covered by the bin scheme")
+    bins = np.zeros(len(starts), dtype=np.int32)
+    done = np.zeros(len(starts), dtype=np.bool_)
+    for offset, shift in zip(bin_offsets, bin_shifts):
+        fits = ~done & (starts >> shift == (ends - 1) >> shift)
+        bins[fits] = offset + (starts[fits] >> shift)
+        done |= fits
+    return bins
+
+
+class PslIntervalIndex(object):
+    """ UCSC style bin index over the target spans of a set of alignments. For every
+    tName the alignments are kept sorted by bin then tStart as numpy arrays, so that an
+    overlap query looks up a contiguous range of bins at each level by bisection and then
+    checks only the alignments in those bins. Queries return row numbers, the position
+    of each alignment in the list or PslTable the index was built from, which is also the
+    order readPsl and readPslTable return them in.
+    """
+    def __init__(self, chroms):
+        #tName -> (bins, tStarts, tEnds, rows)
+        self.chroms = chroms
+
+    @classmethod
+    def fromAlignments(cls, alignments):
+        """ Builds the index from a list of PslRow objects or a PslTable.
+        """
+        if isinstance(alignments, PslTable):
+            codes, tNames = alignments.tNameCodes, alignments.tNames
+            starts, ends = alignments.tStart, alignments.tEnd
+        else:
+            tNameIndex = {}
+            codes = np.array([tNameIndex.setdefault(a.tName, len(tNameIndex)) for a in alignments],
+                    dtype=np.int32)
+            tNames = sorted(tNameIndex, key=tNameIndex.get)
+            starts = np.array([a.tStart for a in alignments], dtype=np.int32)
+            ends = np.array([a.tEnd for a in alignments], dtype=np.int32)
+        bins = binFromRanges(starts, ends)
+        order = np.lexsort((starts, bins, codes)).astype(np.int32)
+        bounds = np.searchsorted(codes[order], np.arange(len(tNames) + 1))
+        chroms = {}
+        for code, tName in enumerate(tNames):
+            rows = order[bounds[code]:bounds[code + 1]]
+            chroms[tName] = (bins[rows], np.asarray(starts[rows], dtype=np.int32),
+                    np.asarray(ends[rows], dtype=np.int32), rows)
+        return cls(chroms)
+
+    def __len__(self):
+        return sum(len(x[3]) for x in self.chroms.itervalues())
+
+    def query(self, tName, start, end):
+        """ Returns the sorted row numbers of the alignments on <tName> whose target span
+        overlaps [start, end).
+        """
+        if tName not in self.chroms or start >= end:
+            return []
+        bins, starts, ends, rows = self.chroms[tName]
+        start, end = max(start, 0), min(end, 1 << 29)
+        hits = []
+        for offset, shift in zip(bin_offsets, bin_shifts):
+            i = np.searchsorted(bins, offset + (start >> shift), 'left')
+            j = np.searchsorted(bins, offset + ((end - 1) >> shift), 'right')
+            if i == j:
+                continue
+            #consecutive bins of one level hold consecutive start ranges, so the starts are sorted
+            #across them and the candidates end at the first alignment starting past the query
+            j = i + np.searchsorted(starts[i:j], end, 'left')
+            hit = np.nonzero((starts[i:j] < end) & (ends[i:j] > start))[0]
+            hits.extend(rows[i + hit].tolist())
+        return sorted(hits)
+
+    def queryAlignment(self, a):
+        """ Returns the row numbers of the alignments whose target span overlaps the
+        target span of <a>, including <a> itself if it was indexed.
+        """
+        return self.query(a.tName, a.tStart, a.tEnd)
+
+    def toString(self):
+        """ Serializes the index with marshal.
+        """
+        return marshal.dumps(dict((tName, tuple(x.tostring() for x in arrays))
+                for tName, arrays in self.chroms.iteritems()))
+
+    @classmethod
+    def fromString(cls, s):
+        """ Rebuilds a index from the output of toString.
+        """
+        return cls(dict((tName, tuple(np.fromstring(x, dtype=np.int32) for x in arrays))
+                for tName, arrays in marshal.loads(s).iteritems()))
+
+
+def pslIntervalIndexPath(infile):
+    """ Returns the path of the target interval index of a PSL file.
+    """
+    return infile + psl_interval_index_extension
+
+
+def loadPslIntervalIndex(infile):
+    """ Returns the PslIntervalIndex of a PSL file. Like loadPslIndex, the index stored
+    next to the file is used if its size and mtime still match, otherwise it is rebuilt
+    from readPslTable and stored again.
+    """
+    key = pslFileKey(infile)
+    path = pslIntervalIndexPath(infile)
+    s = _readSidecar(path, key)
+    if s is not None:
+        return PslIntervalIndex.fromString(s)
+    index = PslIntervalIndex.fromAlignments(readPslTable(infile))
+    try:
+        _writeSidecar(path, key, index.toString())
+    except (IOError, OSError):
+        pass
+    return index
+
+
 def pslIterator(infile, uniqify=False):
     """ Iterator to loop over psls returning PslRow objects.
     If uniqify is set, will add a number to each name starting with -0"""
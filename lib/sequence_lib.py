@@ -8,10 +8,13 @@ Modified by Ian Fiddes
 """
 
 import string
-from itertools import izip
-from math import ceil, floor
+from collections import defaultdict
+from itertools import izip, product
+
+import numpy as np
 
 from lib.twobit import TwoBitFile, TwoBitSequence
+from lib.compression_lib import openInput
 
 class Transcript(object):
     """
@@ -219,9 +222,7 @@ class Transcript(object):
             return self.mRna
         sequence = twoBitFileObj[self.chromosomeInterval.chromosome]
         assert self.chromosomeInterval.stop <= len(sequence)
-        s = []
-        for e in self.exonIntervals:
-            s.append(sequence[e.start : e.stop])
+        s = sequence.fetch_many([(e.start, e.stop) for e in self.exonIntervals])
         if self.chromosomeInterval.strand is True:
             mRna = "".join(s)
         else:
@@ -243,22 +244,23 @@ class Transcript(object):
         #make sure this isn't a non-coding gene
         if self.thickStart == self.thickStop == 0:
             return ""
-        s = []
+        intervals = []
         for e in self.exonIntervals:
             if self.thickStart < e.start and e.stop < self.thickStop:
                 # squarely in the CDS
-                s.append(sequence[e.start : e.stop])
+                intervals.append((e.start, e.stop))
             elif (e.start <= self.thickStart and e.stop < self.thickStop
                         and self.thickStart < e.stop):
                 # thickStart marks the start of the CDS
-                s.append(sequence[self.thickStart : e.stop])
+                intervals.append((self.thickStart, e.stop))
             elif e.start <= self.thickStart and self.thickStop <= e.stop:
                 # thickStart and thickStop mark the whole CDS
-                s.append(sequence[self.thickStart : self.thickStop])
+                intervals.append((self.thickStart, self.thickStop))
             elif (self.thickStart < e.start and self.thickStop <= e.stop
                         and e.start < self.thickStop):
                 # thickStop marks the end of the CDS
-                s.append(sequence[e.start : self.thickStop])
+                intervals.append((e.start, self.thickStop))
+        s = sequence.fetch_many(intervals)
         if not self.chromosomeInterval.strand:
             cds = reverseComplement("".join(s))
         else:
@@ -305,18 +307,14 @@ class Transcript(object):
         """
         sequence = twoBitFileObj[self.chromosomeInterval.chromosome]
         assert self.chromosomeInterval.stop <= len(sequence)
-        introns = []
+        intervals = []
         prevExon = self.exonIntervals[0]
         for nextExon in self.exonIntervals[1:]:
             assert nextExon.strand == prevExon.strand
             assert nextExon.start > prevExon.stop
-            start, stop = prevExon.stop, nextExon.start
-            intron = sequence[start : stop]
-            if self.strand is True:
-                introns.append(intron)
-            else:
-                introns.append(reverseComplement(intron))
+            intervals.append((prevExon.stop, nextExon.start))
             prevExon = nextExon
+        introns = sequence.fetch_many(intervals, strand=convertStrand(self.strand))
         if self.strand is True:
             return introns
         else:
@@ -386,11 +384,8 @@ class Transcript(object):
         cds = self.getCds(twoBitFileObj)
         if p >= len(cds) or p < 0:
             return None
-        #we add 0.1 to the ceiling to make multiples of 3 work
-        start, stop = int(floor(p / 3.0) * 3),  int(ceil((p + 0.1) / 3.0) * 3)
-        if stop - start != 3:
-            return None
-        codon = cds[start : stop]
+        start = p - p % 3
+        codon = cds[start : start + 3]
         return codonToAminoAcid(codon)
 
     def transcriptCoordinateToAminoAcid(self, p, twoBitFileObj):
@@ -743,6 +738,92 @@ class ChromosomeInterval(object):
         return self.stop - self.start
 
 
+class SpliceSites(object):
+    """
+    Donor and acceptor dinucleotides of every intron of a set of transcripts,
+    stored as parallel arrays with one entry per intron:
+    transcript: index into names of the transcript this intron belongs to.
+    length: length of the intron.
+    tag: CDS if both flanking exons contain CDS, UTR if neither does, otherwise NONE.
+    donor, acceptor: upper case dinucleotides in 5'->3' transcript orientation.
+    """
+    NONE, CDS, UTR = 0, 1, 2
+
+    def __init__(self, names, transcript, length, tag, donor, acceptor):
+        self.names = names
+        self.transcript = transcript
+        self.length = length
+        self.tag = tag
+        self.donor = donor
+        self.acceptor = acceptor
+
+    def __len__(self):
+        return len(self.length)
+
+    def badSplices(self, motifs, tag, minimumIntronSize=0):
+        """
+        Returns the set of transcript names with at least one intron of the given tag
+        and at least minimumIntronSize long whose donor is a key of the dict motifs
+        but whose acceptor is not the matching value. Donors that are not in motifs
+        are never reported.
+        """
+        bad = np.zeros(len(self), dtype=bool)
+        for donor, acceptor in motifs.iteritems():
+            bad |= (self.donor == donor) & (self.acceptor != acceptor)
+        bad &= (self.tag == tag) & (self.length >= minimumIntronSize)
+        return set(self.names[i] for i in np.unique(self.transcript[bad]))
+
+
+def _intronTag(prevExon, nextExon):
+    """
+    Tags a intron as CDS, UTR or NONE based on its flanking Exon objects
+    """
+    if prevExon.containsCds() is True and nextExon.containsCds() is True:
+        return SpliceSites.CDS
+    elif prevExon.containsCds() is False and nextExon.containsCds() is False:
+        return SpliceSites.UTR
+    return SpliceSites.NONE
+
+
+def getSpliceSites(transcripts, twoBitFileObj):
+    """
+    Builds a SpliceSites object for a iterable of Transcript objects. Transcripts are
+    visited in chromosome order and all of the dinucleotides for a chromosome are fetched
+    with one fetch_many call per strand.
+    """
+    byChromosome = defaultdict(list)
+    for t in transcripts:
+        byChromosome[t.chromosomeInterval.chromosome].append(t)
+    names, transcript, length, tag, donor, acceptor = [], [], [], [], [], []
+    for chrom in sorted(byChromosome):
+        sequence = twoBitFileObj[chrom]
+        for strand in (True, False):
+            donorIntervals, acceptorIntervals = [], []
+            for t in byChromosome[chrom]:
+                if t.strand is not strand or len(t.intronIntervals) == 0:
+                    continue
+                names.append(t.name)
+                #exons are in transcript order, introns in chromosome order
+                exons = t.exons if strand is True else t.exons[::-1]
+                for i, intron in enumerate(t.intronIntervals):
+                    transcript.append(len(names) - 1)
+                    length.append(len(intron))
+                    tag.append(_intronTag(exons[i], exons[i + 1]))
+                    if strand is True:
+                        donorIntervals.append((intron.start, intron.start + 2))
+                        acceptorIntervals.append((intron.stop - 2, intron.stop))
+                    else:
+                        donorIntervals.append((intron.stop - 2, intron.stop))
+                        acceptorIntervals.append((intron.start, intron.start + 2))
+            s = convertStrand(strand)
+            donor.extend(x.upper() for x in sequence.fetch_many(donorIntervals, strand=s, max_gap=256))
+            acceptor.extend(x.upper() for x in sequence.fetch_many(acceptorIntervals, strand=s,
+                    max_gap=256))
+    return SpliceSites(np.array(names, dtype=object), np.array(transcript, dtype=np.int32),
+            np.array(length, dtype=np.int32), np.array(tag, dtype=np.int8),
+            np.array(donor, dtype="S2"), np.array(acceptor, dtype="S2"))
+
+
 class Attribute(object):
     """
     Stores attributes from the gencode attribute file.
@@ -815,16 +896,29 @@ _codonTable = {
     '': ''
     }
 
+def _buildCodonLookup():
+    """
+    Expands _codonTable with every upper/lower case spelling of each codon,
+    so that codons can be looked up without calling upper() on them.
+    """
+    lookup = {}
+    for codon, aa in _codonTable.iteritems():
+        for spelling in product(*[(x.upper(), x.lower()) for x in codon]):
+            lookup["".join(spelling)] = aa
+    return lookup
+
+_codonLookup = _buildCodonLookup()
+
+_stopCodons = frozenset(c for c, aa in _codonLookup.iteritems() if aa == '*')
+
+
 def codonToAminoAcid(c):
     """
     Given a codon C, return an amino acid or ??? if codon unrecognized.
     Codons could be unrecognized due to ambiguity IUPAC characters.
     """
     if c is None: return None
-    c = c.upper()
-    if c in _codonTable:
-        return _codonTable[c]
-    return '?'
+    return _codonLookup.get(c, '?')
 
 
 def translateSequence(sequence):
@@ -833,12 +927,28 @@ def translateSequence(sequence):
     space. If the sequence is not a multiple of 3 it will be truncated
     silently.
     """
-    #truncate sequence to multiple of 3
-    sequence = sequence[:len(sequence) - len(sequence) % 3]
-    result = []
-    for i in xrange(0, len(sequence), 3):
-        result.append(codonToAminoAcid(sequence[i : i + 3]))
-    return "".join(result)
+    get = _codonLookup.get
+    return "".join([get(sequence[i : i + 3], '?') for i in
+            xrange(0, len(sequence) - len(sequence) % 3, 3)])
+
+
+def findInFrameStops(sequence, start=0, stop=None, firstOnly=False):
+    """
+    Scans a coding sequence once, codon by codon, and returns a list of the
+    positions of every in frame stop codon. Codons start at <start> and every
+    third position after it, up to but not including <stop>. Only whole codons
+    are considered. If firstOnly is set the scan ends at the first stop found.
+    """
+    if stop is None:
+        stop = len(sequence)
+    stop = min(stop, len(sequence) - 2)
+    positions = []
+    for i in xrange(start, stop, 3):
+        if sequence[i : i + 3] in _stopCodons:
+            positions.append(i)
+            if firstOnly is True:
+                break
+    return positions
 
 
 def readCodons(seq):
@@ -849,23 +959,24 @@ def readCodons(seq):
         yield seq[i:i+3]
 
 
-def readTwoBit(file_path):
+def readTwoBit(file_path, useMmap=True):
     """
     Returns a dictionary that can randomly access two bit files.
     Acts as a wrapper around the TwoBitFile class in twobitreader.py.
+    By default the file is memory mapped, see TwoBitFile.
     """
-    return TwoBitFile(file_path)
+    return TwoBitFile(file_path, use_mmap=useMmap)
 
 
-def getTranscripts(bedFile):
+def getTranscripts(bedFile, threads=1):
     """
     Given a path to a standard BED file and a details BED, return a list of
-    Transcript objects.
+    Transcript objects. The BED file may be gzip or BGZF compressed.
     """
     transcripts = []
-    bedFile = open(bedFile, 'r')
-    for t in transcriptIterator(bedFile):
-        transcripts.append(t)
+    with openInput(bedFile, threads) as f:
+        for t in transcriptIterator(f):
+            transcripts.append(t)
     return transcripts
 
 
@@ -921,10 +1032,11 @@ def transcriptIterator(transcriptsBedStream):
 def getTranscriptAttributeDict(attributeFile):
     """
     Returns a dictionary mapping the transcript ID to an Attribute object.
-    This stores all of the relevant information from the gencode attributes file.
+    This stores all of the relevant information from the gencode attributes file,
+    which may be gzip or BGZF compressed.
     """
     attribute_dict = {}
-    with open(attributeFile) as f: 
+    with openInput(attributeFile) as f: 
         for line in f:
             line = line.split("\t")
             if line[0] == "geneId": 
@@ -2,29 +2,70 @@
 Convenience library for interfacting with a sqlite database. Designed to handle concurrency
 issues when writing tons of stuff.
 
+Table and column names are formatted into the SQL statements rather than bound as
+parameters, so they must come from the pipeline itself, never from user input.
+
 Author: Ian Fiddes
 """
 
+import os
+import logging
 import sqlite3 as sql
 
+logger = logging.getLogger(__name__)
+
 
 class ExclusiveSqlConnection(object):
-    """meant to be used with a with statement to ensure proper closure"""
+    """meant to be used with a with statement to ensure proper closure.
+    journalMode (such as WAL) and synchronous (such as NORMAL or OFF) are optional
+    pragmas set on the connection before the lock is taken. attach is a optional
+    dict of schema name to database path to ATTACH, which sqlite does not allow
+    once the transaction has started. shards is a optional list of (column, shard path)
+    pairs copied into TEMP tables with stageShards before the transaction starts; the
+    staged columns are kept in self.shardColumns.
+
+    The connection is opened in autocommit mode and the transaction is managed here,
+    because the sqlite3 module otherwise commits before every DDL statement, which
+    would end the exclusive lock in the middle of a CREATE/DROP heavy block. The
+    transaction is rolled back if the block raises."""
 
-    def __init__(self, path, timeout=6000):
+    def __init__(self, path, timeout=6000, journalMode=None, synchronous=None, attach=None, shards=None):
         self.path = path
         self.timeout = timeout
+        self.journalMode = journalMode
+        self.synchronous = synchronous
+        self.attach = attach
+        self.shards = shards
+        self.shardColumns = []
 
     def __enter__(self):
-        self.con = sql.connect(self.path, timeout = self.timeout, isolation_level = "EXCLUSIVE")
+        self.con = sql.connect(self.path, timeout = self.timeout, isolation_level = None)
+        if self.journalMode is not None:
+            self.con.execute("PRAGMA journal_mode={}".format(self.journalMode))
+        if self.synchronous is not None:
+            self.con.execute("PRAGMA synchronous={}".format(self.synchronous))
+        if self.attach is not None:
+            for name, path in self.attach.iteritems():
+                self.con.execute("ATTACH DATABASE ? AS {}".format(name), (path,))
+        if self.shards is not None:
+            self.shardColumns = stageShards(self.con.cursor(), self.shards)
         try:
             self.con.execute("BEGIN EXCLUSIVE")
         except sql.OperationalError:
-            print ("Database still locked after {} seconds.".format(self.timeout))
+            logger.error("Database {} still locked after {} seconds.".format(self.path, self.timeout))
+            self.con.close()
+            raise
         return self.con.cursor()
 
     def __exit__(self, exception_type, exception_val, trace):
-        self.con.commit()
+        if exception_type is None:
+            self.con.execute("COMMIT")
+        else:
+            try:
+                self.con.execute("ROLLBACK")
+            except sql.OperationalError:
+                #sqlite already rolled back, keep the original exception
+                pass
         self.con.close()
 
 
@@ -67,6 +108,61 @@ def initializeTable(cur, table, columns, primary_key):
         cur.execute("""ALTER TABLE '{}' ADD COLUMN {} {} """.format(table, n, t))
 
 
+#python types that each declared column type is bound as
+sql_converters = {"INTEGER": int, "REAL": float, "TEXT": str}
+#text that the old str(value) write path stored in place of NULL in INTEGER and REAL columns
+null_strings = frozenset(["None", "nan", ""])
+#in TEXT columns only str(None) is a NULL, as "" and "nan" can be real values
+text_null_strings = frozenset(["None"])
+
+
+def toSqlValue(value, valueType):
+    """
+    Converts <value> to the native python type of the declared column type <valueType>
+    so that sqlite stores it as a INTEGER, REAL or TEXT instead of as a string.
+    None and float NaN become NULL.
+    """
+    if value is None or value != value:
+        return None
+    return sql_converters[valueType](value)
+
+
+def getColumnTypes(cur, table, schema="main"):
+    """
+    Returns a list of (name, declared type) pairs for the columns of <table>.
+    """
+    cur.execute("""PRAGMA {}.table_info('{}')""".format(schema, table))
+    return [(r[1], r[2].upper()) for r in cur.fetchall()]
+
+
+def convertColumnTypes(cur, table):
+    """
+    Migrates a table written by the old str(value) write path in place. Text values
+    in INTEGER and REAL columns are rebound as native numbers and the strings in
+    null_strings become NULL; in TEXT columns only the strings in text_null_strings
+    become NULL. Values that do not convert are left alone.
+    Returns the number of values changed.
+    """
+    changed = 0
+    for column, valueType in getColumnTypes(cur, table):
+        if valueType not in sql_converters:
+            continue
+        nulls = text_null_strings if valueType == "TEXT" else null_strings
+        cur.execute("""SELECT rowid, {0} FROM '{1}' WHERE typeof({0})='text'""".format(column, table))
+        updates = []
+        for rowid, value in cur.fetchall():
+            if value in nulls:
+                updates.append((None, rowid))
+            elif valueType != "TEXT":
+                try:
+                    updates.append((toSqlValue(value, valueType), rowid))
+                except ValueError:
+                    continue
+        cur.executemany("""UPDATE '{}' SET {}=? WHERE rowid=?""".format(table, column), updates)
+        changed += len(updates)
+    return changed
+
+
 def numberOfRows(cur, table):
     """
     Returns the number of rows in the provided table
@@ -80,6 +176,15 @@ def insertRow(cur, table, primary_key_column, primary_key):
     cur.execute(cmd)
 
 
+def insertRows(cur, table, primary_key_column, primary_keys):
+    """
+    Inserts a empty row for each of <primary_keys> that is not in <table> yet. The keys are
+    inserted in sorted order, which keeps the primary key index appends local.
+    """
+    cmd = """INSERT OR IGNORE INTO '{}' ({}) VALUES (?)""".format(table, primary_key_column)
+    cur.executemany(cmd, ((x,) for x in sorted(primary_keys)))
+
+
 def upsert(cur, table, primary_key_column, primary_key, col_to_change, value):
     """
     Wrapper for a 'upsert' command (which sqlite lacks). Given a table and a primary key
@@ -96,3 +201,281 @@ def upsert(cur, table, primary_key_column, primary_key, col_to_change, value):
     cmd = """UPDATE '{}' SET {}=? WHERE {}=?""".format(table, col_to_change,
             primary_key_column)
     cur.execute(cmd, (value, primary_key))
+
+
+def bulkUpsert(cur, table, primary_key_column, col_to_change, rows):
+    """
+    Set based version of upsert for a whole column. rows is a iterable of
+    (primary_key, value) pairs. They are staged into a temporary table with executemany,
+    then applied with one INSERT OR IGNORE for new primary keys and one UPDATE.
+    Returns the number of rows staged.
+    """
+    cur.execute("""CREATE TEMP TABLE IF NOT EXISTS bulk_upsert (key TEXT PRIMARY KEY, value)""")
+    cur.execute("""DELETE FROM bulk_upsert""")
+    cur.executemany("""INSERT INTO bulk_upsert (key, value) VALUES (?, ?)""", rows)
+    cur.execute("""SELECT Count(*) FROM bulk_upsert""")
+    count = cur.fetchone()[0]
+    cmd = """INSERT OR IGNORE INTO '{0}' ({1}) SELECT key FROM bulk_upsert""".format(table,
+            primary_key_column)
+    cur.execute(cmd)
+    cmd = """UPDATE '{0}' SET {2}=(SELECT value FROM bulk_upsert WHERE key='{0}'.{1})
+            WHERE {1} IN (SELECT key FROM bulk_upsert)""".format(table, primary_key_column, col_to_change)
+    cur.execute(cmd)
+    cur.execute("""DELETE FROM bulk_upsert""")
+    return count
+
+
+def bulkUpdate(cur, table, primary_key_column, col_to_change, rows):
+    """
+    Sets one column for rows that already exist, such as rows made by insertRows.
+    rows is a iterable of (primary_key, value) pairs. The UPDATEs are batched with
+    executemany in primary key order. Returns the number of rows changed; keys without
+    a row in <table> are not inserted.
+    """
+    cmd = """UPDATE '{}' SET {}=? WHERE {}=?""".format(table, col_to_change, primary_key_column)
+    cur.executemany(cmd, ((v, k) for k, v in sorted(rows)))
+    #rowcount is -1 when rows is empty
+    return max(cur.rowcount, 0)
+
+
+def writeShard(path, valueType, rows):
+    """
+    Writes a private result shard for one column. rows is a iterable of (primary_key, value)
+    pairs. A shard is written by a single job, so no locking, journal or syncing is done.
+    Any existing shard at <path> is replaced. Returns the number of rows written.
+    """
+    tmp = "{}.tmp".format(path)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    con = sql.connect(tmp)
+    con.execute("PRAGMA journal_mode=OFF")
+    con.execute("PRAGMA synchronous=OFF")
+    with con:
+        con.execute("""CREATE TABLE shard (key TEXT PRIMARY KEY, value {})""".format(valueType))
+        con.executemany("""INSERT INTO shard (key, value) VALUES (?, ?)""", rows)
+    n = con.execute("""SELECT Count(*) FROM shard""").fetchone()[0]
+    con.close()
+    os.rename(tmp, path)
+    return n
+
+
+def readShard(path):
+    """
+    Returns a dict of primary key to value stored in a shard made by writeShard.
+    """
+    con = sql.connect(path)
+    d = dict(con.execute("""SELECT key, value FROM shard"""))
+    con.close()
+    return d
+
+
+def stageShards(cur, shards):
+    """
+    Copies each result shard into a TEMP table named shard_<column>, so that assembleShards
+    can join any number of them in one transaction: sqlite allows only 10 ATTACHed
+    databases and none can be DETACHed once a transaction has read it. Must be run outside
+    a transaction. shards is a list of (column, shard path) pairs; missing shards are skipped.
+    Returns the staged columns.
+    """
+    columns = []
+    for column, path in shards:
+        if not os.path.exists(path):
+            continue
+        cur.execute("""ATTACH DATABASE ? AS shard""", (path,))
+        cur.execute("""CREATE TEMP TABLE 'shard_{}' (key TEXT PRIMARY KEY, value)""".format(column))
+        cur.execute("""INSERT INTO temp.'shard_{}' SELECT key, value FROM shard.shard""".format(column))
+        cur.execute("""DETACH DATABASE shard""")
+        columns.append(column)
+    return columns
+
+
+def assembleShards(cur, table, primary_key_column, columns):
+    """
+    Joins the shards staged by stageShards for <columns> into <table> on the primary key.
+    Keys missing from <table> are inserted, then each column is set with one UPDATE from
+    its shard, so rows a shard does not cover and columns without a shard keep their values.
+    Returns the number of distinct keys in the shards.
+    """
+    if len(columns) == 0:
+        return 0
+    for column in columns:
+        cur.execute("""INSERT OR IGNORE INTO '{0}' ({1}) SELECT key FROM temp.'shard_{2}'""".format(
+                table, primary_key_column, column))
+        cur.execute("""UPDATE '{0}' SET '{2}' = (SELECT value FROM temp.'shard_{2}' WHERE key = '{0}'.{1})
+                WHERE {1} IN (SELECT key FROM temp.'shard_{2}')""".format(table, primary_key_column, column))
+    keys = " UNION ".join("""SELECT key FROM temp.'shard_{}'""".format(column) for column in columns)
+    cur.execute("""SELECT Count(*) FROM ({})""".format(keys))
+    return cur.fetchone()[0]
+
+
+def mergeAttached(cur, source):
+    """
+    Copies every table of the database ATTACHed as <source> into the main database with
+    INSERT INTO ... SELECT. Tables that already exist in the main database are replaced.
+    Indexes of the source tables are created after their rows are loaded.
+    Returns the names of the tables copied.
+    """
+    cur.execute("""SELECT type, name, tbl_name, sql FROM {}.sqlite_master
+            WHERE sql IS NOT NULL AND type IN ('table', 'index')""".format(source))
+    schema = cur.fetchall()
+    tables = [(name, cmd) for t, name, tbl, cmd in schema if t == "table"]
+    for name, cmd in tables:
+        cur.execute("""DROP TABLE IF EXISTS main.'{}'""".format(name))
+        cur.execute(cmd)
+        cur.execute("""INSERT INTO main.'{0}' SELECT * FROM {1}.'{0}'""".format(name, source))
+    for t, name, tbl, cmd in schema:
+        if t == "index":
+            cur.execute(cmd)
+    return [name for name, cmd in tables]
+
+
+def mergeAttachedCompact(cur, source, table, primary_key_column, categorical=None, flags=None,
+            encodeKeys=True, flag_column="Flags", joinedView=None):
+    """
+    Compact version of mergeAttached for one genome <table>. The rows are stored in
+    <table>_compact, keyed by INTEGER ids from the alignment_names table that every
+    genome shares. Each <categorical> column (all TEXT columns by default) is stored as
+    INTEGER codes into a shared <column>_values lookup table. The 0/1 <flags> columns
+    are packed into one <flag_column> bitmask, with bit i holding flags[i]; NULL is
+    packed as 0. The bit of each flag is recorded in the shared flag_bits table.
+    A view named <table> decodes all of this again, so queries against <table> see
+    the same columns as before. If encodeKeys is False the TEXT primary key is kept.
+
+    joinedView is a optional (view, other, key, columns) list. It creates the view that
+    createJoinedView would over the decoded <table>, but built on <table>_compact, so
+    that a filter on a indexed column of <other> can be answered by index lookups
+    through the coded <key> instead of scanning <table>_compact.
+    """
+    columns = [(n, t) for n, t in getColumnTypes(cur, table, source) if n != primary_key_column]
+    if categorical is None:
+        categorical = [n for n, t in columns if t == "TEXT"]
+    if flags is None:
+        flags = []
+    if encodeKeys is True:
+        cur.execute("""CREATE TABLE IF NOT EXISTS alignment_names (id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL)""")
+        cur.execute("""INSERT OR IGNORE INTO alignment_names (name) SELECT {} FROM {}.'{}'""".format(
+                primary_key_column, source, table))
+    for n in categorical:
+        cur.execute("""CREATE TABLE IF NOT EXISTS '{}_values' (id INTEGER PRIMARY KEY,
+                value TEXT UNIQUE NOT NULL)""".format(n))
+        cur.execute("""INSERT OR IGNORE INTO '{0}_values' (value) SELECT DISTINCT {0} FROM {1}.'{2}'
+                WHERE {0} IS NOT NULL""".format(n, source, table))
+    if len(flags) > 0:
+        cur.execute("""CREATE TABLE IF NOT EXISTS flag_bits (name TEXT PRIMARY KEY, bit INTEGER)""")
+        cur.executemany("""INSERT OR REPLACE INTO flag_bits (name, bit) VALUES (?, ?)""",
+                [(n, i) for i, n in enumerate(flags)])
+    cur.execute("""DROP VIEW IF EXISTS main.'{}'""".format(table))
+    cur.execute("""DROP TABLE IF EXISTS main.'{}_compact'""".format(table))
+    definitions = ["{} {} PRIMARY KEY".format(primary_key_column, "INTEGER" if encodeKeys else "TEXT")]
+    definitions += ["{} {}".format(n, "INTEGER" if n in categorical else t) for n, t in columns
+            if n not in flags]
+    if len(flags) > 0:
+        definitions.append("{} INTEGER".format(flag_column))
+    cur.execute("""CREATE TABLE '{}_compact' ({})""".format(table, ", ".join(definitions)))
+    #encode: look up the ids of the primary key and of every categorical value, pack the flags
+    selects, joins = ["names.id" if encodeKeys else "source_table.{}".format(primary_key_column)], []
+    if encodeKeys is True:
+        joins.append("JOIN alignment_names AS names ON names.name = source_table.{}".format(
+                primary_key_column))
+    for n, t in columns:
+        if n in flags:
+            continue
+        elif n in categorical:
+            selects.append("{0}_values.id".format(n))
+            joins.append("LEFT JOIN '{0}_values' ON {0}_values.value = source_table.{0}".format(n))
+        else:
+            selects.append("source_table.{}".format(n))
+    if len(flags) > 0:
+        selects.append(" | ".join(["((COALESCE(source_table.{}, 0) != 0) << {})".format(n, i)
+                for i, n in enumerate(flags)]))
+    cur.execute("""INSERT INTO '{}_compact' SELECT {} FROM {}.'{}' AS source_table {}""".format(table,
+            ", ".join(selects), source, table, " ".join(joins)))
+    #decode: the view maps the ids back to the original values and unpacks the flags
+    selects, joins = _compactDecoding(primary_key_column, columns, categorical, flags, encodeKeys,
+            flag_column)
+    cur.execute("""CREATE VIEW '{0}' AS SELECT {1} FROM '{0}_compact' AS compact {2}""".format(table,
+            ", ".join(selects), " ".join(joins)))
+    if joinedView is not None:
+        view, other, key, otherColumns = joinedView
+        cur.execute("""DROP VIEW IF EXISTS '{}'""".format(view))
+        if key in categorical:
+            #a LEFT JOIN to the values table would fix the join order and force a scan of the
+            #compact table, so rows with a code are inner joined and rows without one added
+            #back, found through the index on the code
+            selects, joins = _compactDecoding(primary_key_column, columns, categorical, flags,
+                    encodeKeys, flag_column, key)
+            coded = """SELECT {0}, {1} FROM '{2}_compact' AS compact {3} LEFT JOIN '{4}' AS o
+                    ON o.{5} = {5}_values.value""".format(", ".join(selects),
+                    ", ".join(["o.{}".format(c) for c in otherColumns]), table, " ".join(joins),
+                    other, key)
+            selects, joins = _compactDecoding(primary_key_column, columns, categorical, flags,
+                    encodeKeys, flag_column)
+            uncoded = """SELECT {0}, {1} FROM '{2}_compact' AS compact {3}
+                    WHERE compact.{4} IS NULL""".format(", ".join(selects),
+                    ", ".join(["NULL AS {}".format(c) for c in otherColumns]), table, " ".join(joins), key)
+            cur.execute("""CREATE VIEW '{}' AS {} UNION ALL {}""".format(view, coded, uncoded))
+        else:
+            cur.execute("""CREATE VIEW '{0}' AS SELECT {1}, {2} FROM '{3}_compact' AS compact {4}
+                    LEFT JOIN '{5}' AS o ON o.{6} = compact.{6}""".format(view, ", ".join(selects),
+                    ", ".join(["o.{}".format(c) for c in otherColumns]), table, " ".join(joins),
+                    other, key))
+    return categorical
+
+
+def _compactDecoding(primary_key_column, columns, categorical, flags, encodeKeys, flag_column,
+            innerColumn=None):
+    """
+    Returns the select expressions and joins that decode a <table>_compact table made by
+    mergeAttachedCompact back into its original columns. The values table of
+    <innerColumn> is inner joined, so rows where it is NULL are left out.
+    """
+    selects, joins = ["names.name AS {}".format(primary_key_column) if encodeKeys else
+            "compact.{0} AS {0}".format(primary_key_column)], []
+    if encodeKeys is True:
+        joins.append("JOIN alignment_names AS names ON names.id = compact.{}".format(primary_key_column))
+    for n, t in columns:
+        if n in flags:
+            selects.append("((compact.{} >> {}) & 1) AS {}".format(flag_column, flags.index(n), n))
+        elif n in categorical:
+            selects.append("{0}_values.value AS {0}".format(n))
+            joins.append("{0} '{1}_values' ON {1}_values.id = compact.{1}".format(
+                    "JOIN" if n == innerColumn else "LEFT JOIN", n))
+        else:
+            selects.append("compact.{0} AS {0}".format(n))
+    if len(flags) > 0:
+        selects.append("compact.{0} AS {0}".format(flag_column))
+    return selects, joins
+
+
+def createJoinedView(cur, view, table, other, key, columns):
+    """
+    (Re)creates <view>, which has every column of <table> plus <columns> of <other>,
+    joined on the <key> column that both tables have. Rows of <table> without a match
+    in <other> get NULL for <columns>.
+    """
+    cur.execute("""DROP VIEW IF EXISTS '{}'""".format(view))
+    selects = ", ".join(["t.*"] + ["o.{}".format(c) for c in columns])
+    cur.execute("""CREATE VIEW '{0}' AS SELECT {1} FROM '{2}' AS t LEFT JOIN '{3}' AS o
+            ON o.{4} = t.{4}""".format(view, selects, table, other, key))
+
+
+def createIndexes(cur, table, columns):
+    """
+    Creates a index named <table>_<column> on each of <columns> of <table>, if it does
+    not exist yet.
+    """
+    for c in columns:
+        cur.execute("""CREATE INDEX IF NOT EXISTS '{0}_{1}' ON '{0}' ({1})""".format(table, c))
+
+
+def createUnionView(cur, view, tables, label_column):
+    """
+    (Re)creates <view> as the UNION ALL of <tables>, which must have the same columns.
+    tables is a list of (label, table) pairs, and each row is tagged with its label in
+    a new first column named <label_column>.
+    """
+    cur.execute("""DROP VIEW IF EXISTS '{}'""".format(view))
+    selects = ["""SELECT '{}' AS {}, * FROM '{}'""".format(label, label_column, table)
+            for label, table in tables]
+    cur.execute("""CREATE VIEW '{}' AS {}""".format(view, " UNION ALL ".join(selects)))
@@ -9,6 +9,11 @@ This code is part of the bx-python project and is governed by its license.
 
 import _twobit
 
+import mmap
+import string
+import threading
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
 from struct import unpack, calcsize
 from UserDict import DictMixin
 
@@ -17,6 +22,8 @@ TWOBIT_MAGIC_NUMBER_SWAP = 0x4327411A
 TWOBIT_MAGIC_SIZE = 4
 TWOBIT_VERSION = 0
 
+_complement = string.maketrans("ATGC", "TACG")
+
 class TwoBitSequence(object):
     """Store index, length, and other information for a twobit sequence"""
     def __init__(self, twobit_file, header_offset=None):
@@ -27,6 +34,7 @@ class TwoBitSequence(object):
         self.n_blocks = None
         self.masked_blocks = None
         self.loaded = False
+        self.n_index = None
         
     def __getitem__(self, slice_data):
         """
@@ -56,11 +64,162 @@ class TwoBitSequence(object):
         dna = _twobit.read(self.twobit_file, self, start, end, False)
         # Return
         return dna
+
+    def fetch_many(self, intervals, strand="+", max_gap=4096):
+        """
+        Fetch many (start, end) regions of this sequence at once. Intervals are
+        sorted and any that are within max_gap bases of each other are merged
+        into a single read, so a whole transcript is usually one read. The
+        sequences are returned in the order of intervals. Starts below 0 are
+        clamped to 0 and ends to the sequence size; unlike a slice, negative
+        coordinates are not counted from the end. Empty or inverted intervals
+        give "". If strand is "-" each one is reverse complemented.
+        """
+        result = [""] * len(intervals)
+        clipped = [(max(start, 0), min(end, self.size)) for start, end in intervals]
+        order = sorted((x for x in xrange(len(clipped)) if clipped[x][1] > clipped[x][0]),
+                key=lambda x: clipped[x])
+        i = 0
+        while i < len(order):
+            # grow a group of intervals that can be read together
+            group_start, group_end = clipped[order[i]]
+            j = i + 1
+            while j < len(order) and clipped[order[j]][0] <= group_end + max_gap:
+                group_end = max(group_end, clipped[order[j]][1])
+                j += 1
+            dna = _twobit.read(self.twobit_file, self, group_start, group_end, False)
+            for x in order[i:j]:
+                start, end = clipped[x]
+                result[x] = dna[start - group_start : end - group_start]
+            i = j
+        if strand == "-":
+            result = [x.translate(_complement)[::-1] for x in result]
+        return result
+
+    def build_n_index(self):
+        """
+        Merge the N blocks into sorted, non-adjacent runs and store their
+        starts, ends and the cumulative number of N bases before each run
+        """
+        starts, ends, cumulative = [], [], [0]
+        for s, size in sorted(zip(self.n_block_starts, self.n_block_sizes)):
+            if size <= 0:
+                continue
+            if len(ends) > 0 and s <= ends[-1]:
+                e = max(ends[-1], s + size)
+                cumulative[-1] += e - ends[-1]
+                ends[-1] = e
+            else:
+                starts.append(s)
+                ends.append(s + size)
+                cumulative.append(cumulative[-1] + size)
+        self.n_index = (starts, ends, cumulative)
+
+    def n_runs(self, start, end):
+        """
+        Return the clipped start, end and the index range [i, j) of the N runs
+        overlapping [start, end)
+        """
+        if self.n_index is None:
+            self.build_n_index()
+        starts, ends, cumulative = self.n_index
+        start, end = max(start, 0), min(end, self.size)
+        if end <= start:
+            return start, end, 0, 0
+        i = bisect_right(ends, start)
+        j = bisect_left(starts, end)
+        return start, end, i, j
+
+    def n_runs_many(self, intervals):
+        """
+        n_runs for a list of (start, end) intervals. The intervals are visited in
+        order of start and merge-walked against the N runs, so the first run of
+        each interval is found by moving forward from the previous one instead of
+        bisecting all runs again. Returns the results in the order of intervals.
+        """
+        if self.n_index is None:
+            self.build_n_index()
+        starts, ends, cumulative = self.n_index
+        result = [None] * len(intervals)
+        i, n = 0, len(starts)
+        for k in sorted(xrange(len(intervals)), key=lambda x: intervals[x][0]):
+            start, end = max(intervals[k][0], 0), min(intervals[k][1], self.size)
+            if end <= start:
+                result[k] = (start, end, 0, 0)
+                continue
+            while i < n and ends[i] <= start:
+                i += 1
+            result[k] = (start, end, i, bisect_left(starts, end, i))
+        return result
+
+    def count_in_runs(self, start, end, i, j):
+        """
+        Number of N bases in the clipped [start, end) overlapping runs [i, j)
+        """
+        if i >= j:
+            return 0
+        starts, ends, cumulative = self.n_index
+        count = cumulative[j] - cumulative[i]
+        count -= max(0, start - starts[i])
+        count -= max(0, ends[j - 1] - end)
+        return count
+
+    def has_run_in_runs(self, start, end, i, j, min_size):
+        """
+        Is one of the runs [i, j), clipped to [start, end), at least min_size long?
+        """
+        starts, ends, cumulative = self.n_index
+        for k in xrange(i, j):
+            if min(ends[k], end) - max(starts[k], start) >= min_size:
+                return True
+        return False
+
+    def count_n(self, start, end):
+        """
+        Number of N bases in [start, end), answered from the N block index
+        without reading any sequence. Coordinates are clipped like a slice.
+        """
+        return self.count_in_runs(*self.n_runs(start, end))
+
+    def has_n_run(self, start, end, min_size):
+        """
+        Is there a run of at least min_size N bases inside [start, end)? Runs
+        are clipped to the interval, so this matches searching seq[start:end]
+        for min_size Ns in a row.
+        """
+        return self.has_run_in_runs(*(self.n_runs(start, end) + (min_size,)))
+
+    def count_n_many(self, intervals):
+        """
+        count_n for a list of (start, end) intervals, using n_runs_many.
+        Returns a list of counts.
+        """
+        return [self.count_in_runs(*x) for x in self.n_runs_many(intervals)]
+
+    def has_n_run_many(self, intervals, min_size):
+        """
+        has_n_run for a list of (start, end) intervals, using n_runs_many.
+        Returns a list of bools.
+        """
+        return [self.has_run_in_runs(*(x + (min_size,))) for x in self.n_runs_many(intervals)]
         
 class TwoBitFile(DictMixin):
-    """Open and keep track of twobit genome file"""
+    """
+    Open and keep track of twobit genome file
+
+    With use_mmap the file is memory mapped read-only and sequence is decoded
+    straight from the mapping. There is then no file position shared between
+    reads, so sequences can be read from several threads at once, and processes
+    on one node reading the same 2bit share its pages in the page cache.
 
-    def __init__(self, src, do_mask=False):
+    At most max_loaded sequence headers are kept loaded. When another one is
+    needed the least recently used is unloaded. hits and misses count how
+    often a requested header was already loaded.
+    """
+
+    def __init__(self, src, do_mask=False, use_mmap=False, max_loaded=100):
+        if max_loaded < 1:
+            raise ValueError("max_loaded must be at least 1, got %s" % max_loaded)
         # Try to open the file, in case we're given a path
         try:
             twobit_file = open(src)
@@ -68,6 +227,18 @@ class TwoBitFile(DictMixin):
         except TypeError:
             twobit_file = src
         self.do_mask = do_mask
+        self.handle = None
+        if use_mmap:
+            # mmap objects support seek/read/tell, so headers are read the same way
+            self.handle = twobit_file
+            twobit_file = mmap.mmap(twobit_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Loading headers moves the file position, so it is done under a lock
+        self.lock = threading.Lock()
+        # LRU of loaded sequence names, least recently used first
+        self.max_loaded = max_loaded
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
         # Read magic and determine byte order
         self.byte_order = ">"
         magic = unpack(">L", twobit_file.read(TWOBIT_MAGIC_SIZE))[0]
@@ -97,12 +268,18 @@ class TwoBitFile(DictMixin):
     
     def __getitem__(self, name):
         """Return sequence region requested, load index data if necessary"""
-        seq = self.index[name]
-        if not seq.loaded:
-            for item in self.index:
-                if self.index[item].loaded:
-                    self.unload_sequence(item)
-            self.load_sequence(name)
+        with self.lock:
+            seq = self.index[name]
+            if seq.loaded:
+                self.hits += 1
+                del self.lru[name]
+            else:
+                self.misses += 1
+                self.load_sequence(name)
+                if len(self.lru) >= self.max_loaded:
+                    oldest, _ = self.lru.popitem(last=False)
+                    self.unload_sequence(oldest)
+            self.lru[name] = True
         return seq
     
     def close(self):
@@ -110,6 +287,9 @@ class TwoBitFile(DictMixin):
         assert (self.twobit_file is not None)
         self.twobit_file.close()
         self.twobit_file = None
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
     
     def keys(self):
         """Report sequence names"""
@@ -140,8 +320,8 @@ class TwoBitFile(DictMixin):
         """
         Attempt to remove stored data when done with a chromosome
 
-        We can do this because we've presorted files in analysis, 
-        we shouldn't see that sequence again. Unfortunately, using del 
+        Called when a sequence falls off the end of the LRU. Callers still
+        holding the old TwoBitSequence can keep using it. Unfortunately, using del 
         doesn't seem to be freeing the memory with python.
         """
         offset = self.index[name].header_offset
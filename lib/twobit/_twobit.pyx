@@ -1,7 +1,7 @@
 # Filename: _twobit.pyx
 
 # C-portion of Python-based 2bit parser (works with Pyrex or Cython)
-# extracted from the bx-python project without modifications
+# extracted from the bx-python project with minor modifications
 # ---
 # This code is part of the bx-python project and is governed by its license.
 
@@ -16,7 +16,7 @@ cdef extern from "ctype.h":
 cdef extern from "string.h":
     void * memset(void *, int, int)
 
-import struct, sys
+import mmap, struct, sys
 
 from bisect import bisect
 
@@ -26,6 +26,9 @@ valToNt = "TCAG"
 def read(file, seq, int fragStart, int fragEnd, do_mask=False):
     """
     Stolen directly from Jim Kent's twoBit.c
+
+    file may be a file object or a mmap of the 2bit file. A mmap is sliced
+    directly, so there is no shared file position and no syscall per read.
     """
     cdef int packedStart, packedEnd, packByteCount
     cdef int pOff, pStart, pEnd
@@ -40,8 +43,11 @@ def read(file, seq, int fragStart, int fragEnd, do_mask=False):
     dna_py = PyString_FromStringAndSize(NULL, fragEnd - fragStart)
     dna = PyString_AsString(dna_py)
     # Read it
-    file.seek(seq.sequence_offset + packedStart)
-    packed_py = file.read(packByteCount)
+    if isinstance(file, mmap.mmap):
+        packed_py = file[seq.sequence_offset + packedStart : seq.sequence_offset + packedStart + packByteCount]
+    else:
+        file.seek(seq.sequence_offset + packedStart)
+        packed_py = file.read(packByteCount)
     packed = PyString_AsString(packed_py)
     # Handle case where everything is in one packed byte 
     if packByteCount == 1:
@@ -1,14 +1,22 @@
 import os
+import time
 
 from jobTree.scriptTree.target import Target
 from sonLib.bioio import logger
 import lib.sequence_lib as seq_lib
 import lib.psl_lib as psl_lib
 import lib.sqlite_lib as sql_lib
+import lib.cache_lib as cache_lib
+
+#attributes filled in by the get_* methods that can be shared between classifiers
+shared_inputs = ['alignment_ids', 'alignments', 'alignment_dict', 'transcripts', 'transcript_dict',
+        'original_transcripts', 'original_transcript_dict', 'attribute_dict', 'seq_dict',
+        'alignment_table', 'splice_sites']
 
 class AbstractClassifier(Target):
     def __init__(self, genome, alnPsl, seqFasta, annotationBed, gencodeAttributeMap,  
-                geneCheckBed, outDir, refGenome, primaryKey):
+                geneCheckBed, outDir, refGenome, primaryKey, cacheDir=None, journalMode=None,
+                synchronous=None, shardDir=None):
         #initialize the Target
         Target.__init__(self)
 
@@ -21,53 +29,115 @@ class AbstractClassifier(Target):
         self.gencodeAttributeMap = gencodeAttributeMap
         self.geneCheckBed = geneCheckBed
         self.primary_key = primaryKey
+        self.cache_dir = cacheDir
+        self.journal_mode = journalMode
+        self.synchronous = synchronous
+        self.shard_dir = shardDir
         self.db = os.path.join(outDir, self.genome + ".db")
 
     def get_alignment_ids(self):
-        self.alignment_ids = set(x.split()[9] for x in open(self.alnPsl))
+        if not hasattr(self, 'alignment_ids'):
+            self.alignment_ids = set(psl_lib.readPslNames(self.alnPsl))
 
     def get_original_transcripts(self):
-        self.original_transcripts = seq_lib.getTranscripts(self.annotationBed)
+        if not hasattr(self, 'original_transcripts'):
+            self.original_transcripts = cache_lib.getTranscripts(self.annotationBed, self.cache_dir)
 
     def get_transcript_attributes(self):
-        self.attribute_dict = seq_lib.getTranscriptAttributeDict(self.gencodeAttributeMap)
+        if not hasattr(self, 'attribute_dict'):
+            self.attribute_dict = cache_lib.getTranscriptAttributeDict(self.gencodeAttributeMap,
+                    self.cache_dir)
 
     def get_original_transcript_dict(self):
-        if not hasattr(self, 'original_transcripts'):
-            self.original_transcripts = seq_lib.getTranscripts(self.annotationBed)
-        self.original_transcript_dict = seq_lib.transcriptListToDict(self.original_transcripts, noDuplicates=True)
+        if not hasattr(self, 'original_transcript_dict'):
+            self.get_original_transcripts()
+            self.original_transcript_dict = seq_lib.transcriptListToDict(self.original_transcripts, noDuplicates=True)
 
     def get_transcripts(self):
-        self.transcripts = seq_lib.getTranscripts(self.geneCheckBed)
+        if not hasattr(self, 'transcripts'):
+            self.transcripts = cache_lib.getTranscripts(self.geneCheckBed, self.cache_dir)
 
     def get_transcript_dict(self):
-        if not hasattr(self, 'transcripts'):
-            self.transcripts = seq_lib.getTranscripts(self.geneCheckBed)
-        self.transcript_dict = seq_lib.transcriptListToDict(self.transcripts, noDuplicates=True)
+        if not hasattr(self, 'transcript_dict'):
+            self.get_transcripts()
+            self.transcript_dict = seq_lib.transcriptListToDict(self.transcripts, noDuplicates=True)
 
     def get_seq_dict(self):
-        self.seq_dict = seq_lib.readTwoBit(self.seqFasta)
+        if not hasattr(self, 'seq_dict'):
+            self.seq_dict = seq_lib.readTwoBit(self.seqFasta)
 
     def get_alignments(self):
-        self.alignments = psl_lib.readPsl(self.alnPsl)
+        if not hasattr(self, 'alignments'):
+            self.alignments = cache_lib.readPsl(self.alnPsl, self.cache_dir)
 
     def get_alignment_dict(self):
-        if not hasattr(self, 'alignments'):
+        if not hasattr(self, 'alignment_dict'):
             self.get_alignments()
-        self.alignment_dict = psl_lib.getPslDict(self.alignments, noDuplicates=True)
+            self.alignment_dict = psl_lib.getPslDict(self.alignments, noDuplicates=True)
+
+    def get_splice_sites(self):
+        if not hasattr(self, 'splice_sites'):
+            self.get_transcript_dict()
+            self.get_seq_dict()
+            self.splice_sites = seq_lib.getSpliceSites(self.transcript_dict.itervalues(), self.seq_dict)
+
+    def get_alignment_table(self):
+        if not hasattr(self, 'alignment_table'):
+            #with a cache directory the rows are read through the input cache
+            if hasattr(self, 'alignments') or self.cache_dir is not None:
+                self.get_alignments()
+                self.alignment_table = psl_lib.PslTable.fromRows(self.alignments)
+            else:
+                self.alignment_table = psl_lib.readPslTable(self.alnPsl)
+            if self.alignment_table.hasDuplicates():
+                raise RuntimeError("get_alignment_table found duplicate alignments in {}".format(
+                        self.alnPsl))
+
+    def share_inputs(self, other):
+        """Takes every input that has already been loaded by another classifier
+        for this genome so that the get_* methods above don't parse it again.
+        """
+        for name in shared_inputs:
+            if hasattr(other, name):
+                setattr(self, name, getattr(other, name))
 
     def upsert_wrapper(self, alignmentName, value):
         """convenience wrapper for upserting into a column in the sql lib.
         So you don't have to call __name__, self.primaryKey, etc each time"""
-        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
+        with sql_lib.ExclusiveSqlConnection(self.db, journalMode=self.journal_mode,
+                synchronous=self.synchronous) as cur:
             sql_lib.upsert(cur, self.genome, self.primary_key, alignmentName, 
-                    self.__class__.__name__, str(value))
+                    self.__class__.__name__, sql_lib.toSqlValue(value, self.__type__()))
 
     def upsert_dict_wrapper(self, d):
         """even more convenient wrapper for upserting. Assumes input is a dict 
-        mapping alignment names to a value.
+        mapping alignment names to a value. Values are stored as the native type
+        given by __type__(). The rows are normally pre-inserted by the genome setup,
+        so the dict is written with batched UPDATEs; if some alignments have no row yet
+        it falls back to one set based bulk upsert. If this classifier has a shard
+        directory, the dict is instead written to its own shard without taking the
+        genome database lock.
         """
-        with sql_lib.ExclusiveSqlConnection(self.db) as cur:
-            for aln, value in d.iteritems():
-                sql_lib.upsert(cur, self.genome, self.primary_key, aln,
-                        self.__class__.__name__, str(value))
\ No newline at end of file
+        start = time.time()
+        valueType = self.__type__()
+        rows = [(aln, sql_lib.toSqlValue(value, valueType)) for aln, value in d.iteritems()]
+        n = len(rows)
+        if self.shard_dir is not None:
+            target = self.shard_path()
+            sql_lib.writeShard(target, valueType, rows)
+        else:
+            target = self.db
+            with sql_lib.ExclusiveSqlConnection(self.db, journalMode=self.journal_mode,
+                    synchronous=self.synchronous) as cur:
+                updated = sql_lib.bulkUpdate(cur, self.genome, self.primary_key, self.__class__.__name__, rows)
+                if updated < n:
+                    logger.info("{} of {} rows for {} were not pre-inserted".format(n - updated, n,
+                            self.__class__.__name__))
+                    sql_lib.bulkUpsert(cur, self.genome, self.primary_key, self.__class__.__name__, rows)
+        elapsed = time.time() - start
+        logger.info("{} wrote {} rows to {} in {:.2f}s ({:.0f} rows/sec)".format(
+                self.__class__.__name__, n, target, elapsed, n / max(elapsed, 1e-6)))
+
+    def shard_path(self):
+        """path to the private result shard of this classifier"""
+        return os.path.join(self.shard_dir, self.__class__.__name__ + ".db")
\ No newline at end of file
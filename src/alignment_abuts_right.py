@@ -1,5 +1,3 @@
-from collections import defaultdict
-
 from src.abstract_classifier import AbstractClassifier
 import lib.sequence_lib as seq_lib
 
@@ -21,14 +19,17 @@ class AlignmentAbutsRight(AbstractClassifier):
     def __type__():
         return "INTEGER"
 
+    @staticmethod
+    def batch(alignment_table):
+        """returns a boolean array marking the alignments in a PslTable that abut the right edge"""
+        t = alignment_table
+        return (((t.strand == "+") & (t.tEnd == t.tSize) & (t.qEnd != t.qSize)) |
+                ((t.strand == "-") & (t.tStart == 0) & (t.qStart != 0)))
+
     def run(self):
-        self.get_alignment_dict()
+        self.get_alignment_table()
 
-        s_dict = defaultdict(int)
-        for a_id, aln in self.alignment_dict.iteritems():
-            if aln.strand == "+" and aln.tEnd == aln.tSize and aln.qEnd != aln.qSize:
-                s_dict[a_id] = 1
-            elif aln.strand == "-" and aln.tStart == 0 and aln.qStart != 0:
-                s_dict[a_id] = 1
+        hits = self.batch(self.alignment_table)
+        s_dict = dict.fromkeys(self.alignment_table.qName[hits].tolist(), 1)
 
-        self.upsert_dict_wrapper(s_dict)
\ No newline at end of file
+        self.upsert_dict_wrapper(s_dict)
@@ -1,5 +1,9 @@
+from itertools import izip
+
+import numpy as np
+
 from src.abstract_classifier import AbstractClassifier
-from lib.general_lib import formatRatio
+from lib.general_lib import formatRatioArray
 import lib.sequence_lib as seq_lib
 
 class AlignmentCoverage(AbstractClassifier):
@@ -17,13 +21,18 @@ class AlignmentCoverage(AbstractClassifier):
     def __type__():
         return "REAL"
 
+    @staticmethod
+    def batch(alignment_table):
+        """computes the coverage of every alignment in a PslTable as a array"""
+        t = alignment_table
+        return formatRatioArray(t.matches + t.misMatches, t.matches + t.misMatches + t.qNumInsert)
+
     def run(self):
-        self.get_alignment_dict()
+        self.get_alignment_table()
+
+        r = self.batch(self.alignment_table)
+        assert np.all((r >= 0) & (r <= 1))
 
-        s_dict = {}
-        for a_id, aln in self.alignment_dict.iteritems():
-            r = formatRatio(aln.matches + aln.misMatches, aln.matches + aln.misMatches + aln.qNumInsert)
-            assert r >= 0 and r <= 1
-            s_dict[a_id] = r
+        s_dict = dict(izip(self.alignment_table.qName.tolist(), r.tolist()))
 
-        self.upsert_dict_wrapper(s_dict)
\ No newline at end of file
+        self.upsert_dict_wrapper(s_dict)
@@ -1,5 +1,3 @@
-from collections import defaultdict
-
 from src.abstract_classifier import AbstractClassifier
 import lib.sequence_lib as seq_lib
 
@@ -18,12 +16,16 @@ class AlignmentPartialMap(AbstractClassifier):
     def __type__():
         return "INTEGER"
 
+    @staticmethod
+    def batch(alignment_table):
+        """returns a boolean array marking the partially mapped alignments in a PslTable"""
+        t = alignment_table
+        return t.qSize != t.qEnd - t.qStart
+
     def run(self):
-        self.get_alignment_dict()
+        self.get_alignment_table()
 
-        s_dict = defaultdict(int)
-        for a_id, aln in self.alignment_dict.iteritems():
-            if aln.qSize != aln.qEnd - aln.qStart:
-                s_dict[a_id] = 1
+        hits = self.batch(self.alignment_table)
+        s_dict = dict.fromkeys(self.alignment_table.qName[hits].tolist(), 1)
 
-        self.upsert_dict_wrapper(s_dict)
\ No newline at end of file
+        self.upsert_dict_wrapper(s_dict)
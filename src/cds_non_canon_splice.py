@@ -1,5 +1,3 @@
-from collections import defaultdict
-
 from src.abstract_classifier import AbstractClassifier
 import lib.sequence_lib as seq_lib
 
@@ -20,29 +18,13 @@ class CdsNonCanonSplice(AbstractClassifier):
     def __type__():
         return "INTEGER"
 
-    def bad_splice(self, donor, acceptor):
-        m = {"GT":"AG"}
-        d = donor.upper()
-        a = acceptor.upper()
-        if d in m and m[d] != a:
-            return True
-        else:
-            return False
+    #donor motifs mapped to the acceptor they must be paired with
+    motifs = {"GT":"AG"}
 
     def run(self, minimum_intron_size=30):
-        self.get_transcript_dict()
-        self.get_seq_dict()
-
-        s_dict = defaultdict(int)
-        for a, t in self.transcript_dict.iteritems():
-            chrom_seq = self.seq_dict[t.chromosomeInterval.chromosome]
-            for i in xrange(len(t.intronIntervals)):
-                if t.exons[i].containsCds() is True and t.exons[i+1].containsCds() is True:
-                    if len(t.intronIntervals[i]) >= minimum_intron_size:
-                        donor = chrom_seq[t.intronIntervals[i].start : t.intronIntervals[i].start + 2]
-                        acceptor = chrom_seq[t.intronIntervals[i].stop - 2 : t.intronIntervals[i].start]
-                        if self.bad_splice(donor, acceptor) is True:
-                            s_dict[a] = 1
-                            break
-
-        self.upsert_dict_wrapper(s_dict)
\ No newline at end of file
+        self.get_splice_sites()
+
+        bad = self.splice_sites.badSplices(self.motifs, seq_lib.SpliceSites.CDS, minimum_intron_size)
+        s_dict = dict.fromkeys(bad, 1)
+
+        self.upsert_dict_wrapper(s_dict)
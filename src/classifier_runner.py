@@ -0,0 +1,40 @@
+from sonLib.bioio import logger
+
+from src.abstract_classifier import AbstractClassifier
+
+
+class ClassifierRunner(AbstractClassifier):
+    """
+    Runs every classifier for one genome inside of a single target.
+
+    The alignment PSL, gene-check BED, annotation BED, attribute map and 2bit are
+    loaded once here and handed to each classifier, instead of every classifier
+    being its own target that parses all of them again.
+    """
+
+    def __init__(self, classifiers, genome, alnPsl, seqFasta, annotationBed, gencodeAttributeMap,
+                geneCheckBed, outDir, refGenome, primaryKey, cacheDir=None, journalMode=None,
+                synchronous=None, shardDir=None):
+        AbstractClassifier.__init__(self, genome, alnPsl, seqFasta, annotationBed, gencodeAttributeMap,
+                geneCheckBed, outDir, refGenome, primaryKey, cacheDir, journalMode, synchronous,
+                shardDir)
+        self.classifiers = classifiers
+        self.classifier_args = (genome, alnPsl, seqFasta, annotationBed, gencodeAttributeMap,
+                geneCheckBed, outDir, refGenome, primaryKey, cacheDir, journalMode, synchronous,
+                shardDir)
+
+    def run(self):
+        self.get_alignment_dict()
+        self.get_alignment_table()
+        self.get_transcript_dict()
+        self.get_original_transcript_dict()
+        self.get_seq_dict()
+        self.get_splice_sites()
+
+        for classifier in self.classifiers:
+            logger.info("Running {} on {}".format(classifier.__name__, self.genome))
+            c = classifier(*self.classifier_args)
+            c.share_inputs(self)
+            c.run()
+            #keep anything the classifier loaded itself, such as the attribute map
+            self.share_inputs(c)
@@ -19,8 +19,10 @@ class EndStop(AbstractClassifier):
 
         s_dict = {}
         for a, t in self.transcript_dict.iteritems():
-            s = t.getProteinSequence(self.seq_dict)
-            if len(s) > 0 and s[-1] != "*":
+            cds = t.getCds(self.seq_dict)
+            #last whole codon of the CDS
+            end = len(cds) - len(cds) % 3
+            if end > 0 and seq_lib.codonToAminoAcid(cds[end - 3 : end]) != "*":
                 s_dict[a] = 1
             else:
                 s_dict[a] = 0
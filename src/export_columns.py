@@ -0,0 +1,166 @@
+"""
+Exports the classification tables of a merged results database as compressed columnar
+NumPy files, one <genome>.npz per genome plus a manifest.json describing them.
+
+Rows are streamed from sqlite in chunks into one memory mapped .npy file per column,
+so a genome is never held in memory. Every column has a <column>.mask boolean array
+that is True where the value is NULL. INTEGER columns are int64 (NULL stored as 0) and
+REAL columns are float64 (NULL stored as NaN). TEXT columns with at most maxCategories
+distinct values, and no more than half as many as there are rows, are dictionary encoded
+as int32 codes into a <column>.categories array (NULL stored as -1). Other TEXT columns,
+such as the primary key, are stored as fixed width UTF-8 byte strings (NULL stored as "").
+
+Usage: python src/export_columns.py results.db exportDir [--genomes C57B6J ...]
+"""
+
+import os
+import json
+import shutil
+import logging
+import zipfile
+import argparse
+import sqlite3 as sql
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from sonLib.bioio import logger
+import lib.sqlite_lib as sql_lib
+
+#numpy type and NULL fill value of each declared column type. Columns without a declared
+#type, such as the unpacked flags of a packFlags view, are treated as INTEGER. TEXT is the
+#dictionary encoding; plain TEXT columns are fixed width byte strings filled with ""
+column_dtypes = {"INTEGER": (np.int64, 0), "REAL": (np.float64, np.nan), "TEXT": (np.int32, -1)}
+#default bound on the number of categories of a dictionary encoded TEXT column
+max_categories = 65536
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mergedDb')
+    parser.add_argument('exportDir')
+    parser.add_argument('--genomes', nargs="+", default=None,
+            help="Genomes to export. Defaults to every genome with a <genome>_view in mergedDb")
+    parser.add_argument('--chunkSize', type=int, default=50000)
+    parser.add_argument('--maxCategories', type=int, default=max_categories,
+            help="TEXT columns with more distinct values than this are stored as plain strings")
+    return parser
+
+
+def find_genomes(cur):
+    cur.execute("SELECT name FROM sqlite_master WHERE type='view' AND name LIKE '%\\_view' ESCAPE '\\'")
+    return sorted(x[0][:-len("_view")] for x in cur.fetchall())
+
+
+def text_column_stats(cur, table, columns):
+    """
+    Returns the number of distinct values and the longest UTF-8 length in bytes of each
+    of <columns> of <table>, counted by sqlite so that no values are held here.
+    """
+    if len(columns) == 0:
+        return {}
+    cur.execute("SELECT {} FROM '{}'".format(", ".join("Count(DISTINCT {0}), Max(Length(CAST({0} AS BLOB)))".format(
+            c) for c in columns), table))
+    r = cur.fetchone()
+    return dict((c, (r[2 * i], r[2 * i + 1] or 0)) for i, c in enumerate(columns))
+
+
+def export_table(cur, table, path, chunkSize=50000, maxCategories=max_categories):
+    """
+    Streams <table> into the .npz archive <path>. Returns the manifest entry for it.
+    """
+    columns = [(n, t if t in column_dtypes else "INTEGER") for n, t in sql_lib.getColumnTypes(cur, table)]
+    cur.execute("SELECT Count(*) FROM '{}'".format(table))
+    n = cur.fetchone()[0]
+    stats = text_column_stats(cur, table, [name for name, t in columns if t == "TEXT"])
+    tmpDir = path + ".tmp"
+    if os.path.exists(tmpDir):
+        shutil.rmtree(tmpDir)
+    os.mkdir(tmpDir)
+    values, masks, categories, fills = [], [], [], []
+    for name, t in columns:
+        dtype, fill = column_dtypes[t]
+        categories.append(None)
+        if t == "TEXT":
+            distinct, width = stats[name]
+            if distinct <= min(maxCategories, n // 2):
+                categories[-1] = {}
+            else:
+                dtype, fill = "S{}".format(max(width, 1)), ""
+        fills.append(fill)
+        values.append(open_memmap(os.path.join(tmpDir, name + ".npy"), mode="w+", dtype=dtype, shape=(n,)))
+        masks.append(open_memmap(os.path.join(tmpDir, name + ".mask.npy"), mode="w+", dtype=np.bool_,
+                shape=(n,)))
+    cur.execute("SELECT {} FROM '{}'".format(", ".join(x[0] for x in columns), table))
+    start = 0
+    while True:
+        rows = cur.fetchmany(chunkSize)
+        if len(rows) == 0:
+            break
+        stop = start + len(rows)
+        for i, column in enumerate(zip(*rows)):
+            mask = np.fromiter((x is None for x in column), dtype=np.bool_, count=len(rows))
+            fill = fills[i]
+            if categories[i] is not None:
+                codes = categories[i]
+                column = [fill if x is None else codes.setdefault(x, len(codes)) for x in column]
+            elif columns[i][1] == "TEXT":
+                column = [fill if x is None else unicode(x).encode("utf-8") for x in column]
+            else:
+                column = [fill if x is None else x for x in column]
+            values[i][start:stop] = column
+            masks[i][start:stop] = mask
+        start = stop
+    entry = {"file": os.path.basename(path), "table": table, "rows": n, "columns": []}
+    for i, (name, t) in enumerate(columns):
+        values[i].flush()
+        masks[i].flush()
+        column = {"name": name, "type": t, "dtype": values[i].dtype.name, "nulls": int(masks[i].sum()),
+                "encoding": "plain"}
+        if categories[i] is not None:
+            codes = categories[i]
+            labels = sorted(codes, key=codes.get)
+            np.save(os.path.join(tmpDir, name + ".categories.npy"),
+                    np.array([x.encode("utf-8") for x in labels], dtype=str))
+            column["encoding"] = "dictionary"
+            column["categories"] = len(labels)
+        entry["columns"].append(column)
+    del values, masks
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+        for f in sorted(os.listdir(tmpDir)):
+            z.write(os.path.join(tmpDir, f), f)
+    shutil.rmtree(tmpDir)
+    return entry
+
+
+def export_database(mergedDb, exportDir, genomes=None, chunkSize=50000, maxCategories=max_categories):
+    """
+    Exports the <genome>_view of each genome of mergedDb, every genome by default, to
+    <exportDir>/<genome>.npz and writes <exportDir>/manifest.json. Returns the manifest.
+    """
+    if not os.path.exists(exportDir):
+        os.mkdir(exportDir)
+    con = sql.connect(mergedDb)
+    cur = con.cursor()
+    if genomes is None:
+        genomes = find_genomes(cur)
+    manifest = {"database": os.path.abspath(mergedDb), "genomes": {}}
+    for genome in genomes:
+        path = os.path.join(exportDir, genome + ".npz")
+        manifest["genomes"][genome] = export_table(cur, genome + "_view", path, chunkSize, maxCategories)
+        logger.info("Exported {} rows of {} to {}".format(manifest["genomes"][genome]["rows"], genome, path))
+    con.close()
+    with open(os.path.join(exportDir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    return manifest
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+    export_database(args.mergedDb, args.exportDir, args.genomes, args.chunkSize, args.maxCategories)
+
+
+if __name__ == '__main__':
+    from src.export_columns import *
+    main()
@@ -25,10 +25,10 @@ class InFrameStop(AbstractClassifier):
             #and more than 2 codons - can't have in frame stop without that
             cds_size = t.getCdsLength()
             if cds_size >= 9:
-                for i in xrange(3, cds_size - 3, 3):
-                    c = t.cdsCoordinateToAminoAcid(i, self.seq_dict)
-                    if c == "*":
-                        s_dict[a] = i
+                #skip the first and last codons, record the last stop found
+                stops = seq_lib.findInFrameStops(t.getCds(self.seq_dict), 3, cds_size - 3)
+                if len(stops) > 0:
+                    s_dict[a] = stops[-1]
             else:
                 s_dict[a] = -1
 
@@ -1,11 +1,15 @@
 import os
+import shutil
 import argparse
 import sqlite3 as sql
 from jobTree.scriptTree.target import Target
 from jobTree.scriptTree.stack import Stack
-from jobTree.src.bioio import getLogLevelString, isNewer, logger, setLoggingFromOptions, system
-from lib.sqlite_lib import initializeTable, insertRow
+from jobTree.src.bioio import getLogLevelString, isNewer, logger, setLoggingFromOptions
+from lib.sqlite_lib import initializeTable, insertRows, assembleShards, mergeAttached, mergeAttachedCompact, \
+        createJoinedView, createIndexes, createUnionView, getColumnTypes, ExclusiveSqlConnection
 from lib.general_lib import FileType, DirType, FullPaths
+import lib.cache_lib as cache_lib
+import lib.psl_lib as psl_lib
 
 #basic_attributes has many basic classes stuck together that are not really classifiers
 from src.basic_attributes import *
@@ -32,23 +36,46 @@ from src.alignment_partial_map import AlignmentPartialMap
 from src.alignment_abuts_right import AlignmentAbutsRight
 from src.alignment_abuts_left import AlignmentAbutsLeft
 
+from src.classifier_runner import ClassifierRunner
+
 #classifiers we are currently working with
 classifiers = [EndStop, UnknownBases, BeginStart, InFrameStop, BadFrame, NoCds, CdsMult3Gap, 
         UtrGap, CdsUnknownSplice, CdsNonCanonSplice, UtrUnknownSplice, UtrNonCanonSplice,
         NumberScaffoldGap, AlignmentIdentity, AlignmentCoverage, AlignmentPartialMap, 
         AlignmentAbutsRight, AlignmentAbutsLeft]
 
-#add in all of the basic attribute columns
-classifiers = classifiers + [TranscriptID, GeneID, GeneName, GeneType, TranscriptType]
+#TranscriptID is the key into the shared attributes table, which holds the other basic attributes
+classifiers = classifiers + [TranscriptID]
 #add in all of the psl attribute columns
 classifiers = classifiers + [SourceChrom, SourceStart, SourceStop, SourceStrand,
                             DestChrom, DestStart, DestStop, DestStrand]
 
 
+#boolean classifiers that --packFlags stores as bits of flag_column, in bit order
+flag_classifiers = [EndStop, BadFrame, NoCds, CdsMult3Gap, UtrGap, CdsUnknownSplice, CdsNonCanonSplice,
+        UtrUnknownSplice, UtrNonCanonSplice, NumberScaffoldGap, AlignmentPartialMap,
+        AlignmentAbutsRight, AlignmentAbutsLeft]
+flag_column = "Flags"
+
+#columns of the attributes table in the merged database, with the Attribute field each comes from
+attribute_columns = [["GeneID", "TEXT", "geneID"], ["GeneName", "TEXT", "geneName"],
+                    ["GeneType", "TEXT", "geneType"], ["TranscriptType", "TEXT", "transcriptType"]]
+attribute_table = "attributes"
+attribute_key = TranscriptID.__name__
+
+#classifier columns that are indexed in each genome table of the merged database
+indexed_classifiers = [TranscriptID, AlignmentIdentity, AlignmentCoverage, AlignmentPartialMap, DestChrom]
+#attribute columns that are indexed in the attributes table
+indexed_attributes = ["GeneID", "GeneName", "GeneType"]
+#view in the merged database with every genome, keyed by (Genome, primary key)
+all_genomes_view = "all_genomes"
+
+
 #hard coded file extension types that we are looking for
 alignment_ext = ".filtered.psl"
 sequence_ext = ".2bit"
 gene_check_ext = ".bed"
+compressed_ext = ".gz"
 #gene_check_details_ext = ".coding-gene-check-details.bed"
 
 def build_parser():
@@ -65,13 +92,36 @@ def build_parser():
     parser.add_argument('--primaryKey', type=str, default="AlignmentID")
     parser.add_argument('--overwriteDb', action="store_true")
     parser.add_argument('--mergedDb', type=str, default="results.db")
+    parser.add_argument('--singleLoad', action="store_true",
+            help="Run all classifiers for a genome in one target that loads the inputs once")
+    parser.add_argument('--cacheDir', type=str, default=None,
+            help="Directory to keep pre-parsed copies of the PSL, BED and attribute inputs in")
+    parser.add_argument('--prebuildCache', action="store_true",
+            help="Fill --cacheDir for every input in --dataDir before starting the jobTree")
+    parser.add_argument('--journalMode', type=str, default=None, choices=["DELETE", "WAL"],
+            help="sqlite journal_mode for the genome databases")
+    parser.add_argument('--synchronous', type=str, default=None, choices=["OFF", "NORMAL", "FULL"],
+            help="sqlite synchronous setting for the genome databases")
+    parser.add_argument('--shards', action="store_true",
+            help="Have each classifier write a private shard that is joined into the genome table at the end")
+    parser.add_argument('--compact', action="store_true",
+            help="Store the merged genome tables with integer keys and dictionary encoded text columns")
+    parser.add_argument('--packFlags', action="store_true",
+            help="Store the boolean classifiers of the merged genome tables as one Flags bitmask")
     return parser
 
 
-def parse_dir(genomes, targetDir, ext):
+def parse_dir(genomes, targetDir, ext, compressedExt=None):
+    """
+    Finds the input with extension <ext> for each genome. If <compressedExt> is given, a
+    gzip or BGZF compressed input with that extension is used when there is no plain one.
+    """
     pathDict = {}
     for g in genomes:
         path = os.path.join(targetDir, g + ext)
+        if not os.path.exists(path) and compressedExt is not None and \
+                os.path.exists(path + compressedExt):
+            path += compressedExt
         if not os.path.exists(path):
             raise RuntimeError("{} does not exist".format(path))
         pathDict[g] = path
@@ -79,14 +129,72 @@ def parse_dir(genomes, targetDir, ext):
 
 
 def build_analysis(target, alnPslDict, seqTwoBitDict, geneCheckBedDict, gencodeAttributeMap,
-            genomes, annotationBed, outDir, primaryKeyColumn, refGenome):
+            genomes, annotationBed, outDir, primaryKeyColumn, refGenome, singleLoad=False,
+            cacheDir=None, journalMode=None, synchronous=None, shards=False, mergedDb=None,
+            compact=False, packFlags=False):
     for genome in genomes:
-        alnPsl, seqFasta = alnPslDict[genome], seqTwoBitDict[genome]
-        geneCheckBed = geneCheckBedDict[genome]
-        initialize_sql_columns(genome, outDir, primaryKeyColumn)
-        for classifier in classifiers:
-            target.addChildTarget(classifier(genome, alnPsl, seqFasta, annotationBed,
-                    gencodeAttributeMap, geneCheckBed, outDir, refGenome, primaryKeyColumn))
+        target.addChildTargetFn(build_genome_analysis, args=(genome, alnPslDict[genome],
+                seqTwoBitDict[genome], geneCheckBedDict[genome], gencodeAttributeMap, annotationBed,
+                outDir, primaryKeyColumn, refGenome, singleLoad, cacheDir, journalMode, synchronous,
+                shards, mergedDb, compact, packFlags))
+    if mergedDb is not None:
+        target.setFollowOnTargetFn(finalize_merged_database, args=(mergedDb, genomes, compact,
+                packFlags))
+
+
+def build_genome_analysis(target, genome, alnPsl, seqFasta, geneCheckBed, gencodeAttributeMap,
+            annotationBed, outDir, primaryKeyColumn, refGenome, singleLoad=False, cacheDir=None,
+            journalMode=None, synchronous=None, shards=False, mergedDb=None, compact=False,
+            packFlags=False):
+    """
+    Sets up the database for one genome and adds the classifiers for it as children.
+    If shards is set, each classifier writes to a private shard that the follow on
+    joins into the genome table. If mergedDb is set, the follow on then merges the
+    genome into it, without waiting for the other genomes.
+    """
+    initialize_sql_columns(genome, outDir, primaryKeyColumn)
+    initialize_sql_rows(genome, outDir, alnPsl, primaryKeyColumn, cacheDir)
+    shardDir = None
+    if shards is True:
+        shardDir = os.path.join(outDir, genome + "_shards")
+        if not os.path.exists(shardDir):
+            os.mkdir(shardDir)
+    target.setFollowOnTargetFn(finish_genome_analysis, args=(genome, outDir, primaryKeyColumn,
+            shardDir, mergedDb, journalMode, synchronous, compact, packFlags))
+    if singleLoad is True:
+        target.addChildTarget(ClassifierRunner(classifiers, genome, alnPsl, seqFasta, annotationBed,
+                gencodeAttributeMap, geneCheckBed, outDir, refGenome, primaryKeyColumn, cacheDir,
+                journalMode, synchronous, shardDir))
+        return
+    for classifier in classifiers:
+        target.addChildTarget(classifier(genome, alnPsl, seqFasta, annotationBed,
+                gencodeAttributeMap, geneCheckBed, outDir, refGenome, primaryKeyColumn, cacheDir,
+                journalMode, synchronous, shardDir))
+
+
+def finish_genome_analysis(target, genome, outDir, primaryKeyColumn, shardDir=None, mergedDb=None,
+            journalMode=None, synchronous=None, compact=False, packFlags=False):
+    """
+    Runs once every classifier of a genome is done.
+    """
+    if shardDir is not None:
+        assemble_shards(genome, outDir, primaryKeyColumn, shardDir, journalMode, synchronous)
+    if mergedDb is not None:
+        merge_genome(os.path.join(outDir, genome + ".db"), mergedDb, genome, primaryKeyColumn, compact,
+                packFlags)
+
+
+def assemble_shards(genome, outDir, primaryKeyColumn, shardDir, journalMode=None, synchronous=None):
+    """
+    Joins the classifier shards of one genome into its table in one transaction.
+    """
+    outDb = os.path.join(outDir, genome + ".db")
+    shards = [[x.__name__, os.path.join(shardDir, x.__name__ + ".db")] for x in classifiers]
+    connection = ExclusiveSqlConnection(outDb, journalMode=journalMode, synchronous=synchronous, shards=shards)
+    with connection as cur:
+        n = assembleShards(cur, genome, primaryKeyColumn, connection.shardColumns)
+    logger.info("Assembled {} rows from {} shards into {}".format(n, len(shards), outDb))
+    shutil.rmtree(shardDir)
 
 
 def initialize_sql_columns(genome, outDir, primaryKeyColumn):
@@ -97,18 +205,76 @@ def initialize_sql_columns(genome, outDir, primaryKeyColumn):
         initializeTable(con.cursor(), genome, columns, primaryKeyColumn)
 
 
-def initialize_sql_rows(genome, outDir, alnPsl, primaryKeyColumn):
+def initialize_sql_rows(genome, outDir, alnPsl, primaryKeyColumn, cacheDir=None):
+    """
+    Inserts a row for every alignment in alnPsl in one transaction, so that the
+    classifiers only have to UPDATE. With a cacheDir the PSL is read through the input
+    cache, which the classifiers then share; otherwise only the qName column is read.
+    """
     outDb = os.path.join(outDir, genome + ".db")
     con = sql.connect(outDb)
-    alnIds = set(x.split()[9] for x in open(alnPsl))
-    for alnId in alnIds:
-        insertRow(con.cursor(), genome, primaryKeyColumn, alnId)
+    if cacheDir is not None:
+        alnIds = set(x.qName for x in cache_lib.readPsl(alnPsl, cacheDir))
+    else:
+        alnIds = set(psl_lib.readPslNames(alnPsl))
+    with con:
+        insertRows(con.cursor(), genome, primaryKeyColumn, alnIds)
 
 
-def merge_databases(outDir, mergedDb, genomes):
-    dbs = [os.path.join(outDir, x + ".db") for x in genomes]
-    for db in dbs:
-        system("sqlite3 {} .dump | sqlite3 {}".format(db, mergedDb))
+def merge_genome(db, mergedDb, genome, primaryKeyColumn, compact=False, packFlags=False):
+    """
+    Copies the tables of one genome database into mergedDb in a single transaction.
+    If compact or packFlags is set, the genome table is stored as <genome>_compact
+    behind a view named <genome>, and <genome>_view is built on <genome>_compact so
+    that filters on the attribute columns can use the attribute indexes.
+    """
+    with ExclusiveSqlConnection(mergedDb, attach={"genome": db}) as cur:
+        if compact is True or packFlags is True:
+            flags = [x.__name__ for x in flag_classifiers] if packFlags is True else None
+            categorical = None if compact is True else []
+            encoded = mergeAttachedCompact(cur, "genome", genome, primaryKeyColumn, categorical, flags,
+                    encodeKeys=compact, flag_column=flag_column, joinedView=[genome + "_view",
+                    attribute_table, attribute_key, [x[0] for x in attribute_columns]])
+            logger.info("Merged {} from {} into {} encoding {}".format(genome, db, mergedDb,
+                    ", ".join(encoded + (flags if flags is not None else []))))
+        else:
+            tables = mergeAttached(cur, "genome")
+            logger.info("Merged {} from {} into {}".format(", ".join(tables), db, mergedDb))
+            createJoinedView(cur, genome + "_view", genome, attribute_table, attribute_key,
+                    [x[0] for x in attribute_columns])
+
+
+def load_attributes(gencodeAttributeMap, mergedDb, cacheDir=None):
+    """
+    Loads the gencode attribute map once into the attributes table of mergedDb. The
+    {genome}_view views made by merge_genome join the genome tables against it.
+    """
+    attribute_dict = cache_lib.getTranscriptAttributeDict(gencodeAttributeMap, cacheDir)
+    rows = ([t] + [getattr(a, x[2]) for x in attribute_columns] for t, a in attribute_dict.iteritems())
+    with ExclusiveSqlConnection(mergedDb) as cur:
+        cur.execute("DROP TABLE IF EXISTS '{}'".format(attribute_table))
+        initializeTable(cur, attribute_table, [x[:2] for x in attribute_columns], attribute_key)
+        cur.executemany("INSERT INTO '{}' VALUES ({})".format(attribute_table,
+                ", ".join(["?"] * (len(attribute_columns) + 1))), rows)
+    logger.info("Loaded {} transcript attributes into {}".format(len(attribute_dict), mergedDb))
+
+
+def finalize_merged_database(target, mergedDb, genomes, compact=False, packFlags=False):
+    """
+    Runs once every genome is merged. Indexes the commonly filtered columns of each
+    genome table (the physical <genome>_compact table in compact or packFlags mode) and
+    the gene columns of the attributes table, builds the all_genomes view over the
+    <genome>_view views and runs ANALYZE so the query planner can use the indexes.
+    """
+    with ExclusiveSqlConnection(mergedDb) as cur:
+        for genome in genomes:
+            table = genome + "_compact" if compact is True or packFlags is True else genome
+            present = set(x[0] for x in getColumnTypes(cur, table))
+            createIndexes(cur, table, [x.__name__ for x in indexed_classifiers if x.__name__ in present])
+        createIndexes(cur, attribute_table, indexed_attributes)
+        createUnionView(cur, all_genomes_view, [[g, g + "_view"] for g in genomes], "Genome")
+        cur.execute("ANALYZE")
+    logger.info("Finalized {}".format(mergedDb))
 
 
 def main():
@@ -128,9 +294,9 @@ def main():
                 os.remove(os.path.join(args.outDir, g + ".db"))
 
     logger.info("Building paths to the required files")
-    alnPslDict = parse_dir(args.genomes, args.dataDir, alignment_ext)
+    alnPslDict = parse_dir(args.genomes, args.dataDir, alignment_ext, compressed_ext)
     seqTwoBitDict = parse_dir(args.genomes, args.dataDir, sequence_ext)
-    geneCheckBedDict = parse_dir(args.genomes, args.dataDir, gene_check_ext)
+    geneCheckBedDict = parse_dir(args.genomes, args.dataDir, gene_check_ext, compressed_ext)
     #geneCheckBedDetailsDict = parse_dir(args.genomes, args.geneCheckDir, gene_check_details_ext)
 
     refSequence = os.path.join(args.dataDir, args.refGenome + ".2bit")
@@ -138,15 +304,26 @@ def main():
         raise RuntimeError("Reference genome 2bit not present at {}".format(refSequence))
     args.refSequence = refSequence
 
+    args.mergedDb = os.path.abspath(args.mergedDb)
+
+    if args.cacheDir is not None:
+        args.cacheDir = os.path.abspath(args.cacheDir)
+        if args.prebuildCache is True:
+            logger.info("Prebuilding input cache in {}".format(args.cacheDir))
+            cache_lib.prebuildCache(args.dataDir, args.cacheDir, [(args.annotationBed, "bed"),
+                    (args.gencodeAttributeMap, "attributes")])
+
+    load_attributes(args.gencodeAttributeMap, args.mergedDb, args.cacheDir)
+
     i = Stack(Target.makeTargetFn(build_analysis, args=(alnPslDict, seqTwoBitDict, geneCheckBedDict, 
             args.gencodeAttributeMap, args.genomes, args.annotationBed, args.outDir, args.primaryKey, 
-            args.refGenome))).startJobTree(args)
+            args.refGenome, args.singleLoad, args.cacheDir, args.journalMode,
+            args.synchronous, args.shards, args.mergedDb, args.compact,
+            args.packFlags))).startJobTree(args)
 
     if i != 0:
         raise RuntimeError("Got failed jobs")
 
-    merge_databases(args.outDir, args.mergedDb, args.genomes)
-
 
 if __name__ == '__main__':
     from src.main import *
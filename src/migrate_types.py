@@ -0,0 +1,51 @@
+"""
+Converts databases written by the old str(value) write path in place, so that INTEGER
+and REAL columns hold native numbers and 'None' strings become NULL. In INTEGER and REAL
+columns 'nan' and empty strings become NULL as well; in TEXT columns they are kept.
+
+Usage: python src/migrate_types.py results.db output/C57B6J.db ...
+"""
+
+import argparse
+import logging
+import sqlite3 as sql
+from sonLib.bioio import logger
+
+import lib.sqlite_lib as sql_lib
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Converts the INTEGER and REAL columns of databases "
+            "written as str(value) to native numbers. 'None' becomes NULL in every column; 'nan' and "
+            "empty strings become NULL in INTEGER and REAL columns only.")
+    parser.add_argument('databases', nargs="+")
+    parser.add_argument('--vacuum', action="store_true",
+            help="VACUUM each database afterwards to reclaim the space freed by the conversion")
+    return parser
+
+
+def migrate_database(db, vacuum=False):
+    with sql_lib.ExclusiveSqlConnection(db) as cur:
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = [x[0] for x in cur.fetchall()]
+        for table in tables:
+            n = sql_lib.convertColumnTypes(cur, table)
+            logger.info("{}: converted {} values in {}".format(db, n, table))
+    if vacuum is True:
+        con = sql.connect(db)
+        con.execute("VACUUM")
+        con.close()
+        logger.info("Vacuumed {}".format(db))
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+    for db in args.databases:
+        migrate_database(db, args.vacuum)
+
+
+if __name__ == '__main__':
+    from src.migrate_types import *
+    main()
@@ -1,5 +1,4 @@
 from collections import defaultdict
-import re
 
 from src.abstract_classifier import AbstractClassifier
 import lib.sequence_lib as seq_lib
@@ -16,16 +15,14 @@ class NumberScaffoldGap(AbstractClassifier):
     def __type__():
         return "INTEGER"
 
-    def run(self):
+    def run(self, gap_size=100):
         self.get_alignment_dict()
         self.get_seq_dict()
 
-        r = re.compile("[N]{100}")
-
         s_dict = defaultdict(int)
-        for a_id, aln in self.alignment_dict.iteritems():
-            dest_seq = self.seq_dict[aln.tName][aln.tStart : aln.tEnd].upper()
-            if re.search(r, dest_seq) is not None:
+        #answered from the N block index of the 2bit, so no sequence is decoded
+        for a_id, aln in sorted(self.alignment_dict.iteritems(), key=lambda x: x[1].tName):
+            if self.seq_dict[aln.tName].has_n_run(aln.tStart, aln.tEnd, gap_size) is True:
                 s_dict[a_id] = 1
 
-        self.upsert_dict_wrapper(s_dict)
\ No newline at end of file
+        self.upsert_dict_wrapper(s_dict)
@@ -8,7 +8,7 @@ class SourceChrom(AbstractClassifier):
     """
     @staticmethod
     def __type__():
-        return "INTEGER"
+        return "TEXT"
 
     def run(self):
         self.get_alignments()
@@ -109,7 +109,7 @@ class DestChrom(AbstractClassifier):
     """
     @staticmethod
     def __type__():
-        return "INTEGER"
+        return "TEXT"
 
     def run(self):
         self.get_alignments()
@@ -20,16 +20,17 @@ class UnknownBases(AbstractClassifier):
         self.get_seq_dict()
 
         counts = Counter()
-        for aln in self.alignments:
+        #counts come from the N block index of the 2bit, so no sequence is decoded.
+        #go chromosome by chromosome so each sequence header is loaded once
+        for aln in sorted(self.alignments, key=lambda x: x.tName):
             if aln.strand == "+":
-                for tStart, blockSize in izip(aln.tStarts, aln.blockSizes):
-                    seq = self.seq_dict[aln.tName][tStart : tStart + blockSize]
-                    counts[aln.qName] += seq.count("N")
+                intervals = [(tStart, tStart + blockSize) for tStart, blockSize in
+                        izip(aln.tStarts, aln.blockSizes)]
             else:
                 #on negative strand the tStarts are (+) strand but blockSizes are in
                 #transcript orientation
-                for tStart, blockSize in izip(aln.tStarts, reversed(aln.blockSizes)):
-                    seq = self.seq_dict[aln.tName][tStart : tStart + blockSize]
-                    counts[aln.qName] += seq.count("N")
+                intervals = [(tStart, tStart + blockSize) for tStart, blockSize in
+                        izip(aln.tStarts, reversed(aln.blockSizes))]
+            counts[aln.qName] += sum(self.seq_dict[aln.tName].count_n_many(intervals))
 
-        self.upsert_dict_wrapper(counts)
\ No newline at end of file
+        self.upsert_dict_wrapper(counts)